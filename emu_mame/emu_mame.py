@@ -2,16 +2,124 @@ import argparse
 import asyncio
 import base64
 import io
+import mmap
 import os
 import re
 import shutil
 import struct
 import tempfile
-from typing import Tuple
+import time
+from typing import List, Optional, Tuple, Union
 import PIL.Image
+import PIL.ImageChops
 
 QUERY_RE = re.compile("(E?)R([0-7])\\?")
 SET_RE = re.compile("(E?)R([0-7])=([0-9A-F]{2})")
+WAIT_RE = re.compile("WAIT\\?([0-9]+)")
+TEXT_RE = re.compile("TEXT=((?:[0-9A-F]{2})*)")
+VRAM_QUERY_RE = re.compile(
+    "VRAM\\?([0-9A-F]{2}),([0-9A-F]{2}),((?:[0-9A-F]{2})*),"
+    "((?:[0-9A-F]{2})*),([1-7]*)"
+)
+VRAM_SET_RE = re.compile(
+    "VRAM=([0-9A-F]{2}),([0-9A-F]{2}),((?:[0-9A-F]{2})*),"
+    "((?:[0-9A-F]{2})*),([1-7]*),((?:[0-9A-F]{2})*)"
+)
+PROGRAM_RE = re.compile("PROGRAM=((?:[0-9A-F]{2})*)")
+SCREENSHOT_PACKED_RE = re.compile(
+    "SCREENSHOT\\?PACKED=([0-9]+),([0-9]+),([0-9]+),([0-9]+)"
+)
+
+# Protocol extensions supported by this server, as reported by "FEATURES?".
+# "SHARED_FRAMES" is added if the shared-memory ring of frames is enabled.
+FEATURES = [
+    "WAIT",
+    "TEXT",
+    "VRAM",
+    "BINARY",
+    "PACKED",
+    "SUBSCRIBE",
+    "CROP",
+    "PROGRAM",
+]
+
+# Binary protocol, enabled by the "BINARY=1" request: each frame consists of a
+# header (opcode, tag, payload size) followed by the payload. The reply to each
+# request carries the same opcode and tag (or OP_ERROR).
+FRAME_HEADER = struct.Struct("<BHI")
+VRAM_HEADER = struct.Struct("<BBBBB")
+
+# Frames pushed to subscribers start with the frame number and the capture
+# timestamp (in microseconds since the epoch), followed by the packed image,
+# which is omitted if unchanged since the previous frame.
+FRAME_PUSH_HEADER = struct.Struct("<IQ")
+
+# Maximum number of frames queued for each subscriber (one second's worth). The
+# frames of subscribers that fall further behind are dropped.
+SUBSCRIBER_QUEUE_SIZE = 50
+
+# Optional payload of packed screenshot requests: the region to be cropped
+# (left, top, right, bottom), as PIL boxes.
+REGION = struct.Struct("<HHHH")
+
+# Shared-memory ring of the latest frames, for clients running on the same host:
+# a header (magic, number of slots, size of each slot, number of the latest
+# frame) followed by the slots. Each slot starts with a sequence counter (odd
+# while the slot is being written), the frame number, an identifier that changes
+# whenever the image does, the capture timestamp (in microseconds since the
+# epoch) and the size of the packed image that follows.
+SHARED_FRAMES_MAGIC = b"EFFR"
+SHARED_FRAMES_HEADER = struct.Struct("<4sIII")
+SHARED_FRAMES_SLOT_HEADER = struct.Struct("<IIIQI")
+SHARED_FRAMES_SLOTS = 8
+SHARED_FRAMES_SLOT_SIZE = 65536
+
+# Register programs: sequences of instructions, each made of an opcode followed
+# by the operands described here. Loops repeat the instructions up to the
+# matching PROGRAM_END, incrementing their counter (start, step) at each
+# iteration.
+PROGRAM_WRITE = 0x01  # register (| 8 to execute), value
+PROGRAM_WRITE_COUNTER = 0x02  # register, loop level (0=innermost)
+PROGRAM_READ = 0x03  # register (| 8 to execute)
+PROGRAM_WAIT = 0x04  # timeout in milliseconds
+PROGRAM_SLEEP = 0x05  # duration in milliseconds
+PROGRAM_LOOP = 0x06  # count, counter's start and step
+PROGRAM_END = 0x07
+PROGRAM_OPERANDS = {
+    PROGRAM_WRITE: struct.Struct("<BB"),
+    PROGRAM_WRITE_COUNTER: struct.Struct("<BB"),
+    PROGRAM_READ: struct.Struct("<B"),
+    PROGRAM_WAIT: struct.Struct("<H"),
+    PROGRAM_SLEEP: struct.Struct("<H"),
+    PROGRAM_LOOP: struct.Struct("<HBB"),
+}
+PROGRAM_MAX_LOOP_DEPTH = 8
+
+OP_TYPE = 0x01
+OP_FEATURES = 0x02
+OP_SCREENSHOT = 0x03
+OP_SCREENSHOT_PACKED = 0x04
+OP_FRAME_NUMBER = 0x05
+OP_SUBSCRIBE = 0x06
+OP_SHARED_FRAMES = 0x07
+OP_READ_REGISTER = 0x10
+OP_WRITE_REGISTER = 0x11
+OP_WAIT = 0x12
+OP_TEXT = 0x13
+OP_VRAM_READ = 0x14
+OP_VRAM_WRITE = 0x15
+OP_PROGRAM = 0x16
+OP_ERROR = 0xFF
+
+# How long bulk requests wait for each command to complete before giving up.
+BUSY_TIMEOUT = 1.0
+
+# The BUSY flag is polled back-to-back for BUSY_SPIN seconds, then with delays
+# that double at each poll (up to BUSY_MAX_DELAY), so that long commands do not
+# flood the serial link.
+BUSY_SPIN = 0.002
+BUSY_INITIAL_DELAY = 0.0005
+BUSY_MAX_DELAY = 0.02
 
 MACHINE = "minitel2"
 BIOSFILE = "minitel2_bv4.bin"
@@ -137,25 +245,155 @@ def crop_minitel2_image(img: PIL.Image.Image) -> PIL.Image.Image:
             )
 
 
+# Lookup tables from the intensity of each channel to the corresponding bit of
+# the 0bRGBI color index. Colors with the insert bit set are rendered with
+# intensities 0x00/0xFF, the others with 0x44/0xCC (see helper.lua).
+RED_TO_INDEX = [8 if v >= 0x80 else 0 for v in range(256)]
+GREEN_TO_INDEX = [4 if v >= 0x80 else 0 for v in range(256)]
+BLUE_TO_INDEX = [2 if v >= 0x80 else 0 for v in range(256)]
+INSERT_TO_INDEX = [1 if v in (0x00, 0xFF) else 0 for v in range(256)]
+
+
+class FrameSubscriber:
+    def __init__(self):
+        self.queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+        self.has_image = False  # whether the latest image has been pushed
+
+
+class SharedFrames:
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        size = (
+            SHARED_FRAMES_HEADER.size
+            + SHARED_FRAMES_SLOTS * SHARED_FRAMES_SLOT_SIZE
+        )
+        with open(self.path, "w+b") as fp:
+            fp.truncate(size)
+            self._mm = mmap.mmap(fp.fileno(), size)
+        SHARED_FRAMES_HEADER.pack_into(
+            self._mm,
+            0,
+            SHARED_FRAMES_MAGIC,
+            SHARED_FRAMES_SLOTS,
+            SHARED_FRAMES_SLOT_SIZE,
+            0,
+        )
+
+    # Store a frame in the slot that corresponds to its number, and then
+    # publish it as the latest one.
+    def write(
+        self, number: int, image_id: int, timestamp: float, packed_image: bytes
+    ):
+        if SHARED_FRAMES_SLOT_HEADER.size + len(packed_image) > (
+            SHARED_FRAMES_SLOT_SIZE
+        ):
+            return  # does not fit (never happens with real frames)
+        offset = (
+            SHARED_FRAMES_HEADER.size
+            + (number % SHARED_FRAMES_SLOTS) * SHARED_FRAMES_SLOT_SIZE
+        )
+        data_offset = offset + SHARED_FRAMES_SLOT_HEADER.size
+        (sequence,) = struct.unpack_from("<I", self._mm, offset)
+
+        struct.pack_into("<I", self._mm, offset, sequence + 1)
+        self._mm[data_offset : data_offset + len(packed_image)] = packed_image
+        SHARED_FRAMES_SLOT_HEADER.pack_into(
+            self._mm,
+            offset,
+            sequence + 2,
+            number,
+            image_id,
+            int(timestamp * 1e6),
+            len(packed_image),
+        )
+        struct.pack_into("<I", self._mm, SHARED_FRAMES_HEADER.size - 4, number)
+
+
 class ScreenshotBroker:
-    def __init__(self, screenshot_r: asyncio.StreamReader):
+    def __init__(
+        self,
+        screenshot_r: asyncio.StreamReader,
+        shared_frames: Optional[SharedFrames] = None,
+    ):
         self._screenshot_r = screenshot_r
+        self._shared_frames = shared_frames
+        self._latest_frame = None
+        self._image_id = 0
         self._latest_image = None
+        self._latest_index_image = None
+        self._latest_packed_image = None
+        self._frame_number = 0
+        self._subscribers: List[FrameSubscriber] = []
         asyncio.create_task(self._conn_handler())
 
     async def _conn_handler(self):
         while True:
-            num_channels, frame_w, frame_h = struct.unpack(
-                "<BHH", await self._screenshot_r.readexactly(5)
-            )
-            frame_size = 4 * frame_w * frame_h
-            frame_data = await self._screenshot_r.readexactly(frame_size)
-            header = {3: "RGB", 4: "RGBI"}[num_channels]
-            self._latest_image = header, crop_minitel2_image(
-                PIL.Image.frombytes(
-                    "RGBA", (frame_w, frame_h), frame_data, "raw", "BGRA"
-                ).convert("RGB")
+            frame = await self._screenshot_r.readexactly(5)
+            num_channels, frame_w, frame_h = struct.unpack("<BHH", frame)
+            frame += await self._screenshot_r.readexactly(4 * frame_w * frame_h)
+            timestamp = time.time()
+            self._frame_number += 1
+
+            if frame != self._latest_frame:
+                self._latest_frame = frame
+                self._image_id += 1
+                header = {3: "RGB", 4: "RGBI"}[num_channels]
+                self._latest_image = header, crop_minitel2_image(
+                    PIL.Image.frombytes(
+                        "RGBA", (frame_w, frame_h), frame[5:], "raw", "BGRA"
+                    ).convert("RGB")
+                )
+                # Will be computed on demand.
+                self._latest_index_image = None
+                self._latest_packed_image = None
+                for subscriber in self._subscribers:
+                    subscriber.has_image = False
+
+            if self._shared_frames is not None:
+                self._shared_frames.write(
+                    self._frame_number,
+                    self._image_id,
+                    timestamp,
+                    self.get_latest_packed_image(),
+                )
+
+            # Push the new frame to the subscribers, omitting the image for the
+            # ones that already have it.
+            push_header = FRAME_PUSH_HEADER.pack(
+                self._frame_number, int(timestamp * 1e6)
             )
+            for subscriber in self._subscribers:
+                if subscriber.queue.full():
+                    # Drop all the queued frames, as the ones without an image
+                    # rely on the previous ones: the next one will carry it.
+                    while not subscriber.queue.empty():
+                        subscriber.queue.get_nowait()
+                    subscriber.has_image = False
+                if subscriber.has_image:
+                    subscriber.queue.put_nowait(push_header)
+                else:
+                    subscriber.queue.put_nowait(
+                        push_header + self.get_latest_packed_image()
+                    )
+                    subscriber.has_image = True
+
+    @property
+    def frame_number(self) -> int:
+        return self._frame_number
+
+    @property
+    def shared_frames_path(self) -> Optional[str]:
+        if self._shared_frames is None:
+            return None
+        return self._shared_frames.path
+
+    def subscribe(self) -> FrameSubscriber:
+        subscriber = FrameSubscriber()
+        self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: FrameSubscriber):
+        self._subscribers.remove(subscriber)
 
     def get_latest_image(self) -> Tuple[str, bytes]:
         if self._latest_image is None:
@@ -166,6 +404,132 @@ class ScreenshotBroker:
         image.save(buf, format="png")
         return header, buf.getvalue()
 
+    # Return the latest image as packed 4-bit color indices (two pixels per
+    # byte, the first one in the high nibble, each row starting on a new byte),
+    # preceded by the mask of the available channels (0bRGBI) and the size.
+    # If a region is given, only that part of the image is returned; None is
+    # returned if the region does not fit in the image.
+    def get_latest_packed_image(
+        self, region: Optional[Tuple[int, int, int, int]] = None
+    ) -> Optional[bytes]:
+        if self._latest_image is None:
+            return b""
+
+        header, image = self._latest_image
+        if self._latest_index_image is None:
+            r, g, b = image.split()
+            self._latest_index_image = PIL.ImageChops.add(
+                PIL.ImageChops.add(
+                    r.point(RED_TO_INDEX), g.point(GREEN_TO_INDEX)
+                ),
+                PIL.ImageChops.add(
+                    b.point(BLUE_TO_INDEX), r.point(INSERT_TO_INDEX)
+                ),
+            ).convert("P")
+        mask = {"RGB": 0b1110, "RGBI": 0b1111}[header]
+
+        if region is not None:
+            left, top, right, bottom = region
+            if not (0 <= left < right <= image.width):
+                return None
+            if not (0 <= top < bottom <= image.height):
+                return None
+            index = self._latest_index_image.crop(region)
+            return struct.pack(
+                "<BHH", mask, index.width, index.height
+            ) + index.tobytes("raw", "P;4")
+
+        if self._latest_packed_image is None:
+            self._latest_packed_image = struct.pack(
+                "<BHH", mask, image.width, image.height
+            ) + self._latest_index_image.tobytes("raw", "P;4")
+        return self._latest_packed_image
+
+
+# Split the complete binary frames at the beginning of the given data, returning
+# them as (opcode, tag, payload) tuples, together with the remaining data.
+def split_frames(data: bytes) -> Tuple[List[Tuple[int, int, bytes]], bytes]:
+    frames = []
+    pos = 0
+    while len(data) - pos >= FRAME_HEADER.size:
+        opcode, tag, length = FRAME_HEADER.unpack_from(data, pos)
+        end = pos + FRAME_HEADER.size + length
+        if end > len(data):
+            break
+        frames.append((opcode, tag, data[pos + FRAME_HEADER.size : end]))
+        pos = end
+    return frames, data[pos:]
+
+
+def build_frame(opcode: int, tag: int, payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(opcode, tag, len(payload)) + bytes(payload)
+
+
+# Decode the payload of a binary VRAM request into the arguments of
+# Server._read_vram (or Server._write_vram, if with_data is set). Returns None
+# if the payload is malformed.
+def parse_vram_request(payload: bytes, with_data: bool) -> Optional[tuple]:
+    if len(payload) < VRAM_HEADER.size:
+        return None
+    command, r7_base, n_rows, n_cols, n_regs = VRAM_HEADER.unpack_from(payload)
+    pos = VRAM_HEADER.size
+    rows = payload[pos : pos + n_rows]
+    cols = payload[pos + n_rows : pos + n_rows + n_cols]
+    regs = list(payload[pos + n_rows + n_cols : pos + n_rows + n_cols + n_regs])
+    data = payload[pos + n_rows + n_cols + n_regs :]
+    expected_data_size = n_rows * n_cols * n_regs if with_data else 0
+    if len(regs) != n_regs or len(data) != expected_data_size:
+        return None
+    if not all(1 <= reg <= 7 for reg in regs):
+        return None
+    if with_data:
+        return command, r7_base, rows, cols, regs, data
+    return command, r7_base, rows, cols, regs
+
+
+# Decode a register program into a list of (opcode, *operands) tuples, in which
+# loops are followed by the list of the instructions in their body. Returns None
+# if the program is malformed.
+def parse_program(payload: bytes) -> Optional[list]:
+    program = []
+    open_loops = [program]
+    pos = 0
+    while pos < len(payload):
+        opcode = payload[pos]
+        pos += 1
+        if opcode == PROGRAM_END:
+            if len(open_loops) == 1:
+                return None
+            open_loops.pop()
+            continue
+
+        operands_struct = PROGRAM_OPERANDS.get(opcode)
+        if operands_struct is None or pos + operands_struct.size > len(payload):
+            return None
+        operands = operands_struct.unpack_from(payload, pos)
+        pos += operands_struct.size
+
+        if opcode in (PROGRAM_WRITE, PROGRAM_WRITE_COUNTER, PROGRAM_READ):
+            if operands[0] > 0xF:
+                return None
+        if (
+            opcode == PROGRAM_WRITE_COUNTER
+            and operands[1] >= len(open_loops) - 1
+        ):
+            return None
+        if opcode == PROGRAM_LOOP:
+            if len(open_loops) > PROGRAM_MAX_LOOP_DEPTH:
+                return None
+            body = []
+            open_loops[-1].append((opcode, *operands, body))
+            open_loops.append(body)
+        else:
+            open_loops[-1].append((opcode, *operands))
+
+    if len(open_loops) != 1:
+        return None  # unterminated loop
+    return program
+
 
 class Server:
     def __init__(
@@ -178,48 +542,410 @@ class Server:
         self._serial_r = serial_r
         self._serial_w = serial_w
         self._screenshot_broker = screenshot_broker
+        self._features = FEATURES.copy()
+        if screenshot_broker.shared_frames_path is not None:
+            self._features.append("SHARED_FRAMES")
 
     async def handle_client(
         self, client_r: asyncio.StreamReader, client_w: asyncio.StreamWriter
     ):
-        while request_bytes := await client_r.readline():
+        # Clients may send many requests without waiting for the replies: handle
+        # all the ones that have been received so far in one go, and send all
+        # the responses together.
+        pending = b""
+        binary = False
+        while request_bytes := await client_r.read(65536):
+            pending += request_bytes
+            response = b""
+            if not binary:
+                *lines, pending = pending.split(b"\n")
+                for i, line in enumerate(lines):
+                    if line.strip() == b"BINARY=1":
+                        # Switch to binary frames for all the remaining data.
+                        response += await self._handle_requests(lines[:i])
+                        response += b"OK\n"
+                        pending = b"\n".join([*lines[i + 1 :], pending])
+                        binary = True
+                        break
+                else:
+                    response += await self._handle_requests(lines)
+            if binary:
+                frames, pending = split_frames(pending)
+                for i, (opcode, tag, _) in enumerate(frames):
+                    if opcode == OP_SUBSCRIBE:
+                        # From now on, only push frames to this client.
+                        response += await self._handle_frames(frames[:i])
+                        client_w.write(response)
+                        await self._push_frames(client_w, tag)
+                        return
+                response += await self._handle_frames(frames)
+            client_w.write(response)
+            await client_w.drain()
+
+    # Push each new frame to the client, until it disconnects.
+    async def _push_frames(self, client_w: asyncio.StreamWriter, tag: int):
+        subscriber = self._screenshot_broker.subscribe()
+        try:
+            while not client_w.is_closing():
+                payload = await subscriber.queue.get()
+                client_w.write(build_frame(OP_SUBSCRIBE, tag, payload))
+                await client_w.drain()
+        except ConnectionError:
+            pass  # the client disconnected
+        finally:
+            self._screenshot_broker.unsubscribe(subscriber)
+
+    async def _handle_requests(self, lines: List[bytes]) -> bytes:
+        response = b""
+        register_requests = []
+        for request_bytes in lines:
             request_str = request_bytes.decode().strip()
-            if request_str == "TYPE?":
-                response = b"TS9347\n"
-            elif request_str == "SCREENSHOT?":
-                header, image_bytes = self._screenshot_broker.get_latest_image()
-                response = header.encode() + b"\n"
-                response += base64.b64encode(image_bytes) + b"\n"
-            elif query_match := QUERY_RE.fullmatch(request_str):
-                # Build and execute a read register request.
+            if query_match := QUERY_RE.fullmatch(request_str):
+                # Build a read register request.
                 exec_bit, reg = query_match.groups()
                 if not exec_bit:
-                    request = bytes([0x10 + int(reg)])
+                    register_requests.append(bytes([0x10 + int(reg)]))
                 else:
-                    request = bytes([0x18 + int(reg)])
-                async with self._transaction_lock:
-                    self._serial_w.write(request)
-                    await self._serial_w.drain()
-                    reply = await self._serial_r.read(1)
-                    response = b"%02x\n" % reply[0]
+                    register_requests.append(bytes([0x18 + int(reg)]))
+                continue
             elif set_match := SET_RE.fullmatch(request_str):
-                # Build and execute a write register request.
+                # Build a write register request.
                 exec_bit, reg, value = set_match.groups()
                 if not exec_bit:
                     request = bytes([0x20 + int(reg), int(value, 16)])
                 else:
                     request = bytes([0x28 + int(reg), int(value, 16)])
+                register_requests.append(request)
+                continue
+
+            # Execute the register requests that precede this one, so that
+            # responses are sent in the same order as the requests.
+            replies = await self._execute_register_requests(register_requests)
+            response += b"".join(b"%02x\n" % reply for reply in replies)
+            register_requests = []
+
+            if request_str == "TYPE?":
+                response += b"TS9347\n"
+            elif request_str == "FEATURES?":
+                response += " ".join(self._features).encode() + b"\n"
+            elif wait_match := WAIT_RE.fullmatch(request_str):
+                timeout = int(wait_match.group(1)) / 1000
+                async with self._transaction_lock:
+                    status = await self._wait_not_busy(timeout)
+                response += b"%02x\n" % status
+            elif text_match := TEXT_RE.fullmatch(request_str):
+                text = bytes.fromhex(text_match.group(1))
+                async with self._transaction_lock:
+                    status = await self._write_text(text)
+                response += b"%02x\n" % status
+            elif vram_match := VRAM_QUERY_RE.fullmatch(request_str):
+                command, r7_base, rows, cols, regs = vram_match.groups()
                 async with self._transaction_lock:
-                    self._serial_w.write(request)
-                    await self._serial_w.drain()
-                response = b""
+                    status, data = await self._read_vram(
+                        int(command, 16),
+                        int(r7_base, 16),
+                        bytes.fromhex(rows),
+                        bytes.fromhex(cols),
+                        [int(reg) for reg in regs],
+                    )
+                response += b"%02x:%s\n" % (status, data.hex().encode())
+            elif vram_match := VRAM_SET_RE.fullmatch(request_str):
+                command, r7_base, rows, cols, regs, data = vram_match.groups()
+                rows, cols, data = map(bytes.fromhex, (rows, cols, data))
+                if len(data) != len(rows) * len(cols) * len(regs):
+                    response += b"Invalid request, ignoring\n"
+                    continue
+                async with self._transaction_lock:
+                    status = await self._write_vram(
+                        int(command, 16),
+                        int(r7_base, 16),
+                        rows,
+                        cols,
+                        [int(reg) for reg in regs],
+                        data,
+                    )
+                response += b"%02x\n" % status
+            elif program_match := PROGRAM_RE.fullmatch(request_str):
+                program = parse_program(bytes.fromhex(program_match.group(1)))
+                if program is None:
+                    response += b"Invalid request, ignoring\n"
+                    continue
+                async with self._transaction_lock:
+                    status, data = await self._run_program(program)
+                response += b"%02x:%s\n" % (status, data.hex().encode())
+            elif request_str == "SCREENSHOT?":
+                header, image_bytes = self._screenshot_broker.get_latest_image()
+                response += header.encode() + b"\n"
+                response += base64.b64encode(image_bytes) + b"\n"
+            elif request_str == "FRAME?":
+                response += b"%d\n" % await self._get_frame_number()
+            elif request_str == "SHARED_FRAMES?" and (
+                path := self._screenshot_broker.shared_frames_path
+            ):
+                response += path.encode() + b"\n"
+            elif request_str == "SCREENSHOT?PACKED":
+                image_bytes = self._screenshot_broker.get_latest_packed_image()
+                response += base64.b64encode(image_bytes) + b"\n"
+            elif crop_match := SCREENSHOT_PACKED_RE.fullmatch(request_str):
+                region = tuple(int(v) for v in crop_match.groups())
+                broker = self._screenshot_broker
+                image_bytes = broker.get_latest_packed_image(region)
+                if image_bytes is None:
+                    response += b"Invalid request, ignoring\n"
+                    continue
+                response += base64.b64encode(image_bytes) + b"\n"
             else:
-                response = b"Invalid request, ignoring\n"
-            client_w.write(response)
-            await client_w.drain()
+                response += b"Invalid request, ignoring\n"
+
+        replies = await self._execute_register_requests(register_requests)
+        response += b"".join(b"%02x\n" % reply for reply in replies)
+        return response
+
+    # Binary protocol counterpart of _handle_requests.
+    async def _handle_frames(
+        self, frames: List[Tuple[int, int, bytes]]
+    ) -> bytes:
+        response = b""
+        register_requests = []
+        register_tags = []
+        for opcode, tag, payload in frames:
+            if opcode == OP_READ_REGISTER and len(payload) == 1:
+                register_requests.append(bytes([0x10 + (payload[0] & 0xF)]))
+                register_tags.append(tag)
+                continue
+            elif opcode == OP_WRITE_REGISTER and len(payload) == 2:
+                register_requests.append(
+                    bytes([0x20 + (payload[0] & 0xF), payload[1]])
+                )
+                continue
 
+            # Execute the register requests that precede this one, so that
+            # responses are sent in the same order as the requests.
+            replies = await self._execute_register_requests(register_requests)
+            for reply_tag, reply in zip(register_tags, replies):
+                response += build_frame(OP_READ_REGISTER, reply_tag, [reply])
+            register_requests = []
+            register_tags = []
 
-def _host_and_port(text: str) -> Tuple[str, int]:
+            if opcode == OP_TYPE:
+                reply = b"TS9347"
+            elif opcode == OP_FEATURES:
+                reply = " ".join(self._features).encode()
+            elif opcode == OP_WAIT and len(payload) == 2:
+                (timeout_ms,) = struct.unpack("<H", payload)
+                async with self._transaction_lock:
+                    status = await self._wait_not_busy(timeout_ms / 1000)
+                reply = bytes([status])
+            elif opcode == OP_TEXT:
+                async with self._transaction_lock:
+                    status = await self._write_text(payload)
+                reply = bytes([status])
+            elif opcode == OP_VRAM_READ and (
+                vram_request := parse_vram_request(payload, False)
+            ):
+                async with self._transaction_lock:
+                    status, data = await self._read_vram(*vram_request)
+                reply = bytes([status]) + data
+            elif opcode == OP_VRAM_WRITE and (
+                vram_request := parse_vram_request(payload, True)
+            ):
+                async with self._transaction_lock:
+                    status = await self._write_vram(*vram_request)
+                reply = bytes([status])
+            elif (
+                opcode == OP_PROGRAM
+                and (program := parse_program(payload)) is not None
+            ):
+                async with self._transaction_lock:
+                    status, data = await self._run_program(program)
+                reply = bytes([status]) + data
+            elif opcode == OP_SCREENSHOT:
+                header, image_bytes = self._screenshot_broker.get_latest_image()
+                reply = bytes([len(header)]) + header.encode() + image_bytes
+            elif opcode == OP_FRAME_NUMBER:
+                reply = struct.pack("<I", await self._get_frame_number())
+            elif opcode == OP_SHARED_FRAMES and (
+                path := self._screenshot_broker.shared_frames_path
+            ):
+                reply = path.encode()
+            elif opcode == OP_SCREENSHOT_PACKED and len(payload) in (
+                0,
+                REGION.size,
+            ):
+                region = REGION.unpack(payload) if payload else None
+                broker = self._screenshot_broker
+                reply = broker.get_latest_packed_image(region)
+                if reply is None:
+                    opcode, reply = OP_ERROR, b"Invalid region"
+            else:
+                opcode, reply = OP_ERROR, b"Invalid request"
+            response += build_frame(opcode, tag, reply)
+
+        replies = await self._execute_register_requests(register_requests)
+        for reply_tag, reply in zip(register_tags, replies):
+            response += build_frame(OP_READ_REGISTER, reply_tag, [reply])
+        return response
+
+    # Return the number of the latest frame, after making sure that the chip has
+    # received all the register writes sent so far.
+    async def _get_frame_number(self) -> int:
+        await self._execute_register_requests([bytes([0x10])])  # read R0
+        return self._screenshot_broker.frame_number
+
+    # Send a sequence of consecutive register requests to the firmware in a
+    # single serial transaction and return the values of the reads.
+    async def _execute_register_requests(self, requests: List[bytes]) -> bytes:
+        if not requests:
+            return b""
+
+        # Only read requests (which consist of just one byte) get a reply.
+        num_replies = sum(1 for request in requests if len(request) == 1)
+        async with self._transaction_lock:
+            self._serial_w.write(b"".join(requests))
+            await self._serial_w.drain()
+            return await self._serial_r.readexactly(num_replies)
+
+    # Poll the BUSY flag until it clears or the timeout expires, and return the
+    # last value read from the status register. The transaction lock must be
+    # held by the caller.
+    async def _wait_not_busy(self, timeout: float) -> int:
+        start = time.monotonic()
+        deadline = start + timeout
+        delay = BUSY_INITIAL_DELAY
+        while True:
+            self._serial_w.write(bytes([0x10]))  # read R0
+            await self._serial_w.drain()
+            status = (await self._serial_r.readexactly(1))[0]
+            now = time.monotonic()
+            if (status & 0x80) == 0 or now >= deadline:
+                return status
+            if now - start >= BUSY_SPIN:
+                await asyncio.sleep(min(delay, deadline - now))
+                delay = min(delay * 2, BUSY_MAX_DELAY)
+
+    # Execute the command in R0 once for each character, by writing it to ER1,
+    # and wait for each execution to complete. Stop early if the chip does not
+    # become ready in time. Returns the last status register value. The
+    # transaction lock must be held by the caller.
+    async def _write_text(self, text: bytes) -> int:
+        status = 0
+        for c in text:
+            self._serial_w.write(bytes([0x29, c]))  # write ER1
+            status = await self._wait_not_busy(BUSY_TIMEOUT)
+            if status & 0x80:
+                break
+        return status
+
+    # Load R0 with the given command and, for each of the given rows (R6) and
+    # columns (R7, combined with r7_base), execute it and read the given data
+    # registers. Stops early if the chip does not become ready in time. Returns
+    # the last status register value and the data read. The transaction lock
+    # must be held by the caller.
+    async def _read_vram(
+        self,
+        command: int,
+        r7_base: int,
+        rows: bytes,
+        cols: bytes,
+        regs: List[int],
+    ) -> Tuple[int, bytes]:
+        status = 0
+        data = b""
+        self._serial_w.write(bytes([0x20, command]))  # write R0
+        for row in rows:
+            self._serial_w.write(bytes([0x26, row]))  # write R6
+            for col in cols:
+                self._serial_w.write(bytes([0x2F, r7_base | col]))  # ER7
+                status = await self._wait_not_busy(BUSY_TIMEOUT)
+                if status & 0x80:
+                    return status, data
+                self._serial_w.write(bytes(0x10 + reg for reg in regs))
+                await self._serial_w.drain()
+                data += await self._serial_r.readexactly(len(regs))
+        return status, data
+
+    # Like _read_vram, but write the data registers from the given data
+    # before each execution. Returns the last status register value.
+    async def _write_vram(
+        self,
+        command: int,
+        r7_base: int,
+        rows: bytes,
+        cols: bytes,
+        regs: List[int],
+        data: bytes,
+    ) -> int:
+        status = 0
+        values = iter(data)
+        self._serial_w.write(bytes([0x20, command]))  # write R0
+        for row in rows:
+            self._serial_w.write(bytes([0x26, row]))  # write R6
+            for col in cols:
+                for reg in regs:
+                    self._serial_w.write(bytes([0x20 + reg, next(values)]))
+                self._serial_w.write(bytes([0x2F, r7_base | col]))  # ER7
+                status = await self._wait_not_busy(BUSY_TIMEOUT)
+                if status & 0x80:
+                    return status
+        return status
+
+    # Run a register program, as decoded by parse_program. Reads are batched
+    # until the next wait or sleep, or the end of the program. Stops early if
+    # the chip does not become ready in time. Returns the last status register
+    # value read by a wait (or 0) and the data read. The transaction lock must
+    # be held by the caller.
+    async def _run_program(self, program: list) -> Tuple[int, bytes]:
+        status = 0
+        data = bytearray()
+        num_pending_reads = 0
+
+        async def collect_reads():
+            nonlocal num_pending_reads
+            await self._serial_w.drain()
+            data.extend(await self._serial_r.readexactly(num_pending_reads))
+            num_pending_reads = 0
+
+        # Returns False if the program must stop. "counters" holds the current
+        # value of the counter of each enclosing loop (innermost last).
+        async def run(instructions: list, counters: List[int]) -> bool:
+            nonlocal status, num_pending_reads
+            for opcode, *operands in instructions:
+                if opcode == PROGRAM_WRITE:
+                    reg, value = operands
+                    self._serial_w.write(bytes([0x20 + reg, value]))
+                elif opcode == PROGRAM_WRITE_COUNTER:
+                    reg, level = operands
+                    value = counters[-1 - level]
+                    self._serial_w.write(bytes([0x20 + reg, value]))
+                elif opcode == PROGRAM_READ:
+                    self._serial_w.write(bytes([0x10 + operands[0]]))
+                    num_pending_reads += 1
+                elif opcode == PROGRAM_WAIT:
+                    await collect_reads()
+                    status = await self._wait_not_busy(operands[0] / 1000)
+                    if status & 0x80:
+                        return False
+                elif opcode == PROGRAM_SLEEP:
+                    await collect_reads()
+                    await asyncio.sleep(operands[0] / 1000)
+                elif opcode == PROGRAM_LOOP:
+                    count, start, step, body = operands
+                    for i in range(count):
+                        counters.append((start + i * step) & 0xFF)
+                        if not await run(body, counters):
+                            return False
+                        counters.pop()
+            return True
+
+        await run(program, [])
+        await collect_reads()
+        return status, bytes(data)
+
+
+# Parse either "HOST:PORT" or "unix:PATH", returning a tuple or the path.
+def _listen_address(text: str) -> Union[Tuple[str, int], str]:
+    if text.startswith("unix:"):
+        return text[len("unix:") :]
     host, sep, port_str = text.rpartition(":")
     port = int(port_str)
     if port < 1 or port > 65535 or sep != ":":
@@ -231,10 +957,16 @@ async def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--listen",
-        metavar="HOST:PORT",
+        metavar="HOST:PORT|unix:PATH",
         required=True,
-        type=_host_and_port,
-        help="Address to listen on",
+        type=_listen_address,
+        help="TCP address or Unix socket path to listen on",
+    )
+    parser.add_argument(
+        "--shared-frames",
+        metavar="PATH",
+        help="Also publish frames to clients on the same host through a "
+        "shared-memory file at the given path (e.g. in /dev/shm)",
     )
     parser.add_argument(
         "--mame",
@@ -254,7 +986,6 @@ async def main():
         help="Do not hide video output",
     )
     args = parser.parse_args()
-    listen_host, listen_port = args.listen
 
     # Start two temporary TCP servers and tell MAME to connect.
     serial_conn = asyncio.Future()
@@ -285,17 +1016,27 @@ async def main():
     screenshot_serv.close()
 
     # Start receiving screenshots.
-    screenshot_broker = ScreenshotBroker(screenshot_r)
+    shared_frames = None
+    if args.shared_frames is not None:
+        shared_frames = SharedFrames(args.shared_frames)
+    screenshot_broker = ScreenshotBroker(screenshot_r, shared_frames)
 
     # Wait for the firmware running in MAME to signal readiness.
     await serial_r.readuntil(b"!")
 
     server = Server(serial_r, serial_w, screenshot_broker)
-    real_serv = await asyncio.start_server(
-        server.handle_client,
-        listen_host,
-        listen_port,
-    )
+    if isinstance(args.listen, str):
+        real_serv = await asyncio.start_unix_server(
+            server.handle_client,
+            args.listen,
+        )
+    else:
+        listen_host, listen_port = args.listen
+        real_serv = await asyncio.start_server(
+            server.handle_client,
+            listen_host,
+            listen_port,
+        )
     await real_serv.serve_forever()
 
 
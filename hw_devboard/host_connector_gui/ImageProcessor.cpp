@@ -127,6 +127,9 @@ void ImageProcessor::updateColorTables() {
         qRgb(red ? 0xCC : 0x44, green ? 0xCC : 0x44, blue ? 0xCC : 0x44);
     m_rgbInsertColorTable.append(
         (!insert && m_inputChannels.insert_mask != 0) ? colorNoInsert : color);
+    m_rgbInsertIndexTable[val] =
+        (red ? 8 : 0) | (green ? 4 : 0) | (blue ? 2 : 0) |
+        ((insert || m_inputChannels.insert_mask == 0) ? 1 : 0);
     m_rgbColorTable.append(color);
 
     uint8_t gs = rgb2grayscale(red, green, blue);
@@ -184,3 +187,22 @@ QImage ImageProcessor::insertUncroppedImage() const {
 QImage ImageProcessor::insertCroppedImage() const {
   return applyPalette(m_croppedInputImage, m_insertColorTable);
 }
+
+QByteArray
+ImageProcessor::rgbInsertCroppedPackedImage(const QRect &region) const {
+  int width = region.width();
+  int height = region.height();
+  int stride = (width + 1) / 2; // each row starts on a new byte
+  QByteArray result(stride * height, 0);
+
+  for (int y = 0; y < height; ++y) {
+    const uchar *data =
+        m_croppedInputImage.constScanLine(region.top() + y) + region.left();
+    char *out = result.data() + y * stride;
+    for (int x = 0; x < width; ++x) {
+      uint8_t index = m_rgbInsertIndexTable[data[x]];
+      out[x / 2] |= (x % 2 == 0) ? index << 4 : index;
+    }
+  }
+  return result;
+}
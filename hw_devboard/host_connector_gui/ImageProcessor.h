@@ -29,6 +29,11 @@ public:
   QImage insertUncroppedImage() const;
   QImage insertCroppedImage() const;
 
+  // The given region of the cropped image, as packed 4-bit color indices (two
+  // pixels per byte, the first one in the high nibble, each row starting on a
+  // new byte) whose bits are 0bRGBI.
+  QByteArray rgbInsertCroppedPackedImage(const QRect &region) const;
+
 private:
   void updateColorTables();
 
@@ -37,6 +42,7 @@ private:
   QList<QRgb> m_rgbColorTable;
   QList<QRgb> m_grayscaleColorTable;
   QList<QRgb> m_insertColorTable;
+  uint8_t m_rgbInsertIndexTable[256] = {};
   QImage m_inputImage, m_croppedInputImage;
 };
 
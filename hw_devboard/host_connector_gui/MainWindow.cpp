@@ -219,6 +219,7 @@ void MainWindow::processReceivedImage(QImage image) {
   m_imageProcessor->setInputImage(image, *m_usbDevice->videoChipType(),
                                   *m_usbDevice->videoChipChannels(),
                                   *m_usbDevice->videoChipMode());
+  m_tcpServer->processNewFrame();
 
   QImage (ImageProcessor::*uncropped)() const;
   QImage (ImageProcessor::*cropped)() const;
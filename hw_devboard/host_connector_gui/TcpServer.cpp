@@ -1,7 +1,442 @@
 #include "TcpServer.h"
 
 #include <QBuffer>
+#include <QDateTime>
+#include <QElapsedTimer>
 #include <QRegularExpression>
+#include <QTimer>
+#include <QtEndian>
+
+#include <algorithm>
+#include <vector>
+
+// How long bulk requests wait for each command to complete before giving up.
+static constexpr int BUSY_TIMEOUT_MS = 1000;
+
+// The BUSY flag is polled back-to-back for BUSY_SPIN_US, then with delays that
+// double at each poll (up to BUSY_MAX_DELAY_US), so that long commands do not
+// flood the USB link.
+static constexpr int BUSY_SPIN_US = 2000;
+static constexpr unsigned long BUSY_INITIAL_DELAY_US = 500;
+static constexpr unsigned long BUSY_MAX_DELAY_US = 20000;
+
+// Frames are not pushed to the subscribers that have more than this many bytes
+// still waiting to be sent, i.e. that are not keeping up with them.
+static constexpr qint64 SUBSCRIBER_MAX_PENDING_BYTES = 1024 * 1024;
+
+// Binary protocol: each frame consists of a header (opcode, tag, payload size)
+// followed by the payload. The reply to each request carries the same opcode
+// and tag (or OP_ERROR).
+static constexpr int FRAME_HEADER_SIZE = 7;
+static constexpr uint8_t OP_TYPE = 0x01;
+static constexpr uint8_t OP_FEATURES = 0x02;
+static constexpr uint8_t OP_SCREENSHOT = 0x03;
+static constexpr uint8_t OP_SCREENSHOT_PACKED = 0x04;
+static constexpr uint8_t OP_FRAME_NUMBER = 0x05;
+static constexpr uint8_t OP_SUBSCRIBE = 0x06;
+static constexpr uint8_t OP_READ_REGISTER = 0x10;
+static constexpr uint8_t OP_WRITE_REGISTER = 0x11;
+static constexpr uint8_t OP_WAIT = 0x12;
+static constexpr uint8_t OP_TEXT = 0x13;
+static constexpr uint8_t OP_VRAM_READ = 0x14;
+static constexpr uint8_t OP_VRAM_WRITE = 0x15;
+static constexpr uint8_t OP_PROGRAM = 0x16;
+static constexpr uint8_t OP_ERROR = 0xFF;
+
+// Protocol extensions supported by this server, as reported by "FEATURES?".
+static constexpr const char *FEATURES =
+    "WAIT TEXT VRAM BINARY PACKED SUBSCRIBE CROP PROGRAM";
+
+// Register programs: sequences of instructions, each made of an opcode followed
+// by its operands. Loops repeat the instructions up to the matching
+// PROGRAM_END, incrementing their counter (start, step) at each iteration.
+static constexpr uint8_t PROGRAM_WRITE = 0x01;         // register, value
+static constexpr uint8_t PROGRAM_WRITE_COUNTER = 0x02; // register, loop level
+static constexpr uint8_t PROGRAM_READ = 0x03;          // register
+static constexpr uint8_t PROGRAM_WAIT = 0x04;          // timeout in ms (u16)
+static constexpr uint8_t PROGRAM_SLEEP = 0x05;         // duration in ms (u16)
+static constexpr uint8_t PROGRAM_LOOP = 0x06; // count (u16), start, step
+static constexpr uint8_t PROGRAM_END = 0x07;
+static constexpr int PROGRAM_MAX_LOOP_DEPTH = 8;
+
+struct VramRequest {
+  uint8_t command;
+  uint8_t r7Base;
+  QByteArray rows;
+  QByteArray cols;
+  QByteArray regs;
+  QByteArray data;
+};
+
+// Decode the payload of a binary VRAM request, which starts with the command,
+// the R7 base and the number of rows, columns and data registers, followed by
+// the lists themselves and, for writes, the data.
+static std::optional<VramRequest> parseVramRequest(const QByteArray &payload,
+                                                   bool withData) {
+  if (payload.size() < 5) {
+    return std::nullopt;
+  }
+  uint8_t numRows = payload[2];
+  uint8_t numCols = payload[3];
+  uint8_t numRegs = payload[4];
+  qsizetype dataSize = withData ? numRows * numCols * numRegs : 0;
+  if (payload.size() != 5 + numRows + numCols + numRegs + dataSize) {
+    return std::nullopt;
+  }
+
+  VramRequest request;
+  request.command = payload[0];
+  request.r7Base = payload[1];
+  request.rows = payload.mid(5, numRows);
+  request.cols = payload.mid(5 + numRows, numCols);
+  request.regs = payload.mid(5 + numRows + numCols, numRegs);
+  request.data = payload.mid(5 + numRows + numCols + numRegs);
+  for (char reg : request.regs) {
+    if (reg < 1 || reg > 7) {
+      return std::nullopt;
+    }
+  }
+  return request;
+}
+
+struct ProgramInstruction {
+  uint8_t opcode;
+  uint8_t reg;   // WRITE, WRITE_COUNTER, READ (with the exec bit)
+  uint8_t value; // value (WRITE), loop level (WRITE_COUNTER), start (LOOP)
+  uint8_t step;  // LOOP
+  uint16_t arg;  // milliseconds (WAIT, SLEEP), count (LOOP)
+  size_t match;  // index of the matching END (LOOP) or LOOP (END)
+};
+
+// Decode a register program, checking that it is well formed.
+static std::optional<std::vector<ProgramInstruction>>
+parseProgram(const QByteArray &payload) {
+  std::vector<ProgramInstruction> program;
+  std::vector<size_t> openLoops;
+  qsizetype pos = 0;
+  while (pos < payload.size()) {
+    ProgramInstruction insn = {};
+    insn.opcode = payload[pos++];
+    qsizetype operandsSize;
+    switch (insn.opcode) {
+    case PROGRAM_WRITE:
+    case PROGRAM_WRITE_COUNTER:
+    case PROGRAM_WAIT:
+    case PROGRAM_SLEEP:
+      operandsSize = 2;
+      break;
+    case PROGRAM_READ:
+      operandsSize = 1;
+      break;
+    case PROGRAM_LOOP:
+      operandsSize = 4;
+      break;
+    case PROGRAM_END:
+      operandsSize = 0;
+      break;
+    default:
+      return std::nullopt;
+    }
+    if (pos + operandsSize > payload.size()) {
+      return std::nullopt;
+    }
+    const char *operands = payload.constData() + pos;
+    pos += operandsSize;
+
+    switch (insn.opcode) {
+    case PROGRAM_WRITE:
+    case PROGRAM_WRITE_COUNTER:
+      insn.value = operands[1];
+      [[fallthrough]];
+    case PROGRAM_READ:
+      insn.reg = operands[0];
+      if (insn.reg > (REG_ER0 | 7)) {
+        return std::nullopt;
+      }
+      if (insn.opcode == PROGRAM_WRITE_COUNTER &&
+          insn.value >= openLoops.size()) {
+        return std::nullopt;
+      }
+      break;
+    case PROGRAM_WAIT:
+    case PROGRAM_SLEEP:
+      insn.arg = qFromLittleEndian<uint16_t>(operands);
+      break;
+    case PROGRAM_LOOP:
+      if (openLoops.size() >= PROGRAM_MAX_LOOP_DEPTH) {
+        return std::nullopt;
+      }
+      insn.arg = qFromLittleEndian<uint16_t>(operands);
+      insn.value = operands[2];
+      insn.step = operands[3];
+      openLoops.push_back(program.size());
+      break;
+    case PROGRAM_END:
+      if (openLoops.empty()) {
+        return std::nullopt;
+      }
+      insn.match = openLoops.back();
+      program[insn.match].match = program.size();
+      openLoops.pop_back();
+      break;
+    }
+    program.push_back(insn);
+  }
+  if (!openLoops.empty()) {
+    return std::nullopt; // unterminated loop
+  }
+  return program;
+}
+
+static void writeFrame(QTcpSocket *client, uint8_t opcode, uint16_t tag,
+                       const QByteArray &payload) {
+  char header[FRAME_HEADER_SIZE];
+  header[0] = opcode;
+  qToLittleEndian<uint16_t>(tag, header + 1);
+  qToLittleEndian<uint32_t>(payload.size(), header + 3);
+  client->write(header, FRAME_HEADER_SIZE);
+  client->write(payload);
+}
+
+// A request that executes commands on the chip and waits for them to complete,
+// run as a state machine by TcpServer::runRequest, which polls the BUSY flag
+// (or sleeps) between its steps.
+class ChipRequest {
+public:
+  enum class Step { DONE, WAIT, SLEEP };
+
+  ChipRequest(uint8_t opcode, std::optional<uint16_t> tag, bool hasData)
+      : opcode(opcode), tag(tag), hasData(hasData) {
+  }
+  virtual ~ChipRequest() = default;
+
+  // Continue until the chip has to be waited for (for at most stepMs), stepMs
+  // have to pass or the request is complete (or failed, setting busError).
+  // After each wait, status holds the last value read from the status
+  // register.
+  virtual Step resume(UsbDeviceShim *usbDev) = 0;
+
+  const uint8_t opcode;
+  const std::optional<uint16_t> tag; // only for binary clients
+  const bool hasData; // whether the text reply lists data after the status
+
+  int stepMs = 0;
+  uint8_t status = 0;
+  bool busError = false;
+  QByteArray data; // sent after the status
+
+  // The current wait, or sleep.
+  bool sleeping = false;
+  QElapsedTimer timer;
+  unsigned long delayUs = BUSY_INITIAL_DELAY_US; // before the next poll
+};
+
+// Wait once for the BUSY flag to clear.
+class WaitRequest : public ChipRequest {
+public:
+  WaitRequest(std::optional<uint16_t> tag, int timeoutMs)
+      : ChipRequest(OP_WAIT, tag, false), m_timeoutMs(timeoutMs) {
+  }
+
+  Step resume(UsbDeviceShim *) override {
+    if (m_waited) {
+      return Step::DONE;
+    }
+    m_waited = true;
+    stepMs = m_timeoutMs;
+    return Step::WAIT;
+  }
+
+private:
+  int m_timeoutMs;
+  bool m_waited = false;
+};
+
+// Execute the command in R0 once for each character, by writing it to ER1, and
+// wait for each execution to complete. Stops early if the chip does not become
+// ready in time.
+class TextRequest : public ChipRequest {
+public:
+  TextRequest(std::optional<uint16_t> tag, const QByteArray &text)
+      : ChipRequest(OP_TEXT, tag, false), m_text(text) {
+  }
+
+  Step resume(UsbDeviceShim *usbDev) override {
+    if (m_pos == m_text.size() || (status & 0x80)) {
+      return Step::DONE;
+    }
+    if (!usbDev->busWrite(REG_ER1, m_text[m_pos++])) {
+      busError = true;
+      return Step::DONE;
+    }
+    stepMs = BUSY_TIMEOUT_MS;
+    return Step::WAIT;
+  }
+
+private:
+  QByteArray m_text;
+  qsizetype m_pos = 0;
+};
+
+// Load R0 with the request's command and execute it, through ER7, on each of
+// its rows (R6) and columns (R7, combined with r7Base), either writing the data
+// registers from its data before each execution or reading them after it into
+// data. Stops early if the chip does not become ready in time.
+class VramTransferRequest : public ChipRequest {
+public:
+  VramTransferRequest(uint8_t opcode, std::optional<uint16_t> tag,
+                      const VramRequest &request, bool write)
+      : ChipRequest(opcode, tag, !write), m_request(request), m_write(write) {
+  }
+
+  Step resume(UsbDeviceShim *usbDev) override {
+    if (!m_started) {
+      m_started = true;
+      if (!usbDev->busWrite(REG_R0, m_request.command)) {
+        busError = true;
+        return Step::DONE;
+      }
+    } else {
+      // The command on the current cell has been executed.
+      if (status & 0x80) {
+        return Step::DONE;
+      }
+      if (!m_write) {
+        for (char reg : m_request.regs) {
+          std::optional<uint8_t> value =
+              usbDev->busRead(static_cast<VideoChipRegister>(REG_R0 | reg));
+          if (!value.has_value()) {
+            busError = true;
+            return Step::DONE;
+          }
+          data.append(*value);
+        }
+      }
+      m_col++;
+    }
+
+    while (m_row < m_request.rows.size()) {
+      if (m_col == 0 && !usbDev->busWrite(REG_R6, m_request.rows[m_row])) {
+        busError = true;
+        return Step::DONE;
+      }
+      if (m_col == m_request.cols.size()) {
+        m_row++;
+        m_col = 0;
+        continue;
+      }
+      if (m_write) {
+        for (char reg : m_request.regs) {
+          if (!usbDev->busWrite(static_cast<VideoChipRegister>(REG_R0 | reg),
+                                m_request.data[m_pos++])) {
+            busError = true;
+            return Step::DONE;
+          }
+        }
+      }
+      if (!usbDev->busWrite(REG_ER7,
+                            m_request.r7Base | m_request.cols[m_col])) {
+        busError = true;
+        return Step::DONE;
+      }
+      stepMs = BUSY_TIMEOUT_MS;
+      return Step::WAIT;
+    }
+    return Step::DONE;
+  }
+
+private:
+  VramRequest m_request;
+  bool m_write;
+  bool m_started = false;
+  qsizetype m_row = 0;
+  qsizetype m_col = 0;
+  qsizetype m_pos = 0; // in m_request.data
+};
+
+// Run a register program, appending the values that it reads to data. Stops
+// early if a wait times out. The status is the last value read by a wait (or
+// 0).
+class ProgramRequest : public ChipRequest {
+public:
+  ProgramRequest(std::optional<uint16_t> tag,
+                 std::vector<ProgramInstruction> program)
+      : ChipRequest(OP_PROGRAM, tag, true), m_program(std::move(program)) {
+  }
+
+  Step resume(UsbDeviceShim *usbDev) override {
+    if (m_waited) {
+      m_waited = false;
+      if (status & 0x80) {
+        return Step::DONE;
+      }
+    }
+
+    for (; m_pc < m_program.size(); m_pc++) {
+      const ProgramInstruction &insn = m_program[m_pc];
+      switch (insn.opcode) {
+      case PROGRAM_WRITE:
+      case PROGRAM_WRITE_COUNTER: {
+        uint8_t value = insn.opcode == PROGRAM_WRITE
+                            ? insn.value
+                            : m_loops[m_loops.size() - 1 - insn.value].counter;
+        if (!usbDev->busWrite(static_cast<VideoChipRegister>(insn.reg),
+                              value)) {
+          busError = true;
+          return Step::DONE;
+        }
+        break;
+      }
+      case PROGRAM_READ: {
+        std::optional<uint8_t> value =
+            usbDev->busRead(static_cast<VideoChipRegister>(insn.reg));
+        if (!value.has_value()) {
+          busError = true;
+          return Step::DONE;
+        }
+        data.append(*value);
+        break;
+      }
+      case PROGRAM_WAIT:
+        m_pc++;
+        m_waited = true;
+        stepMs = insn.arg;
+        return Step::WAIT;
+      case PROGRAM_SLEEP:
+        m_pc++;
+        stepMs = insn.arg;
+        return Step::SLEEP;
+      case PROGRAM_LOOP:
+        if (insn.arg == 0) {
+          m_pc = insn.match; // skip the body
+        } else {
+          m_loops.push_back({insn.arg, insn.value});
+        }
+        break;
+      case PROGRAM_END:
+        if (--m_loops.back().remaining != 0) {
+          m_loops.back().counter += m_program[insn.match].step;
+          m_pc = insn.match; // run the body again
+        } else {
+          m_loops.pop_back();
+        }
+        break;
+      }
+    }
+    return Step::DONE;
+  }
+
+private:
+  struct Loop {
+    uint16_t remaining;
+    uint8_t counter;
+  };
+
+  std::vector<ProgramInstruction> m_program;
+  size_t m_pc = 0;
+  std::vector<Loop> m_loops;
+  bool m_waited = false;
+};
 
 TcpServer::TcpServer(UsbDeviceShim *usbDev, ImageProcessor *imgProc,
                      QObject *parent)
@@ -69,8 +504,31 @@ void TcpServer::onNewConnection() {
 }
 
 void TcpServer::onReadyRead(QTcpSocket *client) {
+  if (m_pendingRequests.contains(client)) {
+    return; // resumed by continueRequest
+  }
+  if (m_subscribers.contains(client)) {
+    client->readAll(); // subscribers cannot send any further request
+    return;
+  }
+  if (m_binaryClients.contains(client)) {
+    processFrames(client);
+    return;
+  }
+
   static const QRegularExpression query_re("^(E?)R([0-7])\\?$");
   static const QRegularExpression set_re("^(E?)R([0-7])=([0-9A-F]{2})$");
+  static const QRegularExpression wait_re("^WAIT\\?([0-9]+)$");
+  static const QRegularExpression text_re("^TEXT=((?:[0-9A-F]{2})*)$");
+  static const QRegularExpression screenshot_packed_re(
+      "^SCREENSHOT\\?PACKED=([0-9]+),([0-9]+),([0-9]+),([0-9]+)$");
+  static const QRegularExpression program_re("^PROGRAM=((?:[0-9A-F]{2})*)$");
+  static const QRegularExpression vram_query_re(
+      "^VRAM\\?([0-9A-F]{2}),([0-9A-F]{2}),((?:[0-9A-F]{2})*),"
+      "((?:[0-9A-F]{2})*),([1-7]*)$");
+  static const QRegularExpression vram_set_re(
+      "^VRAM=([0-9A-F]{2}),([0-9A-F]{2}),((?:[0-9A-F]{2})*),"
+      "((?:[0-9A-F]{2})*),([1-7]*),((?:[0-9A-F]{2})*)$");
   while (client->canReadLine()) {
     QString line = QString::fromLatin1(client->readLine()).trimmed();
     bool busError = false;
@@ -84,30 +542,42 @@ void TcpServer::onReadyRead(QTcpSocket *client) {
       } else {
         busError = true;
       }
+    } else if (line == "FEATURES?") {
+      client->write(FEATURES);
+      client->write("\n");
+    } else if (line == "BINARY=1") {
+      // Switch to binary frames for all the remaining data.
+      client->write("OK\n");
+      m_binaryClients.insert(client);
+      processFrames(client);
+      return;
     } else if (line == "SCREENSHOT?") {
-      QByteArray header;
-      if (m_imgProc->haveRed()) {
-        header.append('R');
-      }
-      if (m_imgProc->haveGreen()) {
-        header.append('G');
-      }
-      if (m_imgProc->haveBlue()) {
-        header.append('B');
-      }
-      if (m_imgProc->haveInsert()) {
-        header.append('I');
-      }
-
-      QImage image = m_imgProc->rgbInsertCroppedImage();
-      QByteArray data;
-      QBuffer buffer(&data);
-      image.save(&buffer, "PNG");
+      QByteArray header, data;
+      captureScreenshot(&header, &data);
 
       client->write(header);
       client->write("\n");
       client->write(data.toBase64());
       client->write("\n");
+    } else if (line == "FRAME?") {
+      client->write(QByteArray::number(m_frameNumber));
+      client->write("\n");
+    } else if (line == "SCREENSHOT?PACKED") {
+      client->write(capturePackedScreenshot()->toBase64());
+      client->write("\n");
+    } else if (QRegularExpressionMatch m = screenshot_packed_re.match(line);
+               m.hasMatch()) {
+      QPoint topLeft(m.capturedView(1).toInt(), m.capturedView(2).toInt());
+      QPoint bottomRight(m.capturedView(3).toInt() - 1,
+                         m.capturedView(4).toInt() - 1);
+      std::optional<QByteArray> packedImage =
+          capturePackedScreenshot(QRect(topLeft, bottomRight));
+      if (!packedImage.has_value()) {
+        client->write("Invalid request, ignoring\n");
+        continue;
+      }
+      client->write(packedImage->toBase64());
+      client->write("\n");
     } else if (QRegularExpressionMatch m = query_re.match(line); m.hasMatch()) {
       bool execBit = m.capturedLength(1) != 0;
       uint8_t regnum = m.capturedView(2).toInt();
@@ -130,6 +600,69 @@ void TcpServer::onReadyRead(QTcpSocket *client) {
                               data)) {
         busError = true;
       }
+    } else if (QRegularExpressionMatch m = wait_re.match(line); m.hasMatch()) {
+      startRequest(client, std::make_shared<WaitRequest>(
+                               std::nullopt, m.capturedView(1).toInt()));
+      if (m_pendingRequests.contains(client)) {
+        return; // resumed by continueRequest
+      }
+    } else if (QRegularExpressionMatch m = text_re.match(line); m.hasMatch()) {
+      QByteArray text = QByteArray::fromHex(m.captured(1).toLatin1());
+      startRequest(client, std::make_shared<TextRequest>(std::nullopt, text));
+      if (m_pendingRequests.contains(client)) {
+        return; // resumed by continueRequest
+      }
+    } else if (QRegularExpressionMatch m = vram_query_re.match(line);
+               m.hasMatch()) {
+      VramRequest request;
+      request.command = m.capturedView(1).toInt(nullptr, 16);
+      request.r7Base = m.capturedView(2).toInt(nullptr, 16);
+      request.rows = QByteArray::fromHex(m.captured(3).toLatin1());
+      request.cols = QByteArray::fromHex(m.captured(4).toLatin1());
+      request.regs = m.captured(5).toLatin1();
+      for (char &r : request.regs) {
+        r -= '0';
+      }
+      startRequest(client, std::make_shared<VramTransferRequest>(
+                               OP_VRAM_READ, std::nullopt, request, false));
+      if (m_pendingRequests.contains(client)) {
+        return; // resumed by continueRequest
+      }
+    } else if (QRegularExpressionMatch m = vram_set_re.match(line);
+               m.hasMatch()) {
+      VramRequest request;
+      request.command = m.capturedView(1).toInt(nullptr, 16);
+      request.r7Base = m.capturedView(2).toInt(nullptr, 16);
+      request.rows = QByteArray::fromHex(m.captured(3).toLatin1());
+      request.cols = QByteArray::fromHex(m.captured(4).toLatin1());
+      request.regs = m.captured(5).toLatin1();
+      for (char &r : request.regs) {
+        r -= '0';
+      }
+      request.data = QByteArray::fromHex(m.captured(6).toLatin1());
+      if (request.data.size() !=
+          request.rows.size() * request.cols.size() * request.regs.size()) {
+        client->write("Invalid request, ignoring\n");
+        continue;
+      }
+      startRequest(client, std::make_shared<VramTransferRequest>(
+                               OP_VRAM_WRITE, std::nullopt, request, true));
+      if (m_pendingRequests.contains(client)) {
+        return; // resumed by continueRequest
+      }
+    } else if (QRegularExpressionMatch m = program_re.match(line);
+               m.hasMatch()) {
+      std::optional<std::vector<ProgramInstruction>> program =
+          parseProgram(QByteArray::fromHex(m.captured(1).toLatin1()));
+      if (!program.has_value()) {
+        client->write("Invalid request, ignoring\n");
+        continue;
+      }
+      startRequest(client, std::make_shared<ProgramRequest>(
+                               std::nullopt, std::move(*program)));
+      if (m_pendingRequests.contains(client)) {
+        return; // resumed by continueRequest
+      }
     } else {
       client->write("Invalid request, ignoring\n");
     }
@@ -140,7 +673,290 @@ void TcpServer::onReadyRead(QTcpSocket *client) {
   }
 }
 
+void TcpServer::processFrames(QTcpSocket *client) {
+  while (client->bytesAvailable() >= FRAME_HEADER_SIZE) {
+    QByteArray header = client->peek(FRAME_HEADER_SIZE);
+    uint8_t opcode = header[0];
+    uint16_t tag = qFromLittleEndian<uint16_t>(header.constData() + 1);
+    uint32_t length = qFromLittleEndian<uint32_t>(header.constData() + 3);
+    if (client->bytesAvailable() < FRAME_HEADER_SIZE + length) {
+      break; // wait for the rest of the payload
+    }
+
+    client->skip(FRAME_HEADER_SIZE);
+    QByteArray payload = client->read(length);
+    if (opcode == OP_SUBSCRIBE) {
+      // From now on, only push frames to this client.
+      m_subscribers.insert(client, {tag, false});
+      client->readAll();
+      return;
+    }
+    handleFrame(client, opcode, tag, payload);
+    if (m_pendingRequests.contains(client)) {
+      return; // resumed by continueRequest
+    }
+  }
+}
+
+void TcpServer::processNewFrame() {
+  m_frameNumber++;
+  if (m_subscribers.isEmpty()) {
+    return;
+  }
+
+  // Push the new frame to the subscribers, omitting the image for the ones
+  // that already have it.
+  QByteArray packedImage = *capturePackedScreenshot();
+  bool changed = packedImage != m_latestPackedImage;
+  m_latestPackedImage = packedImage;
+
+  char header[12];
+  qToLittleEndian<uint32_t>(m_frameNumber, header);
+  qToLittleEndian<uint64_t>(QDateTime::currentMSecsSinceEpoch() * 1000,
+                            header + 4);
+  for (auto it = m_subscribers.begin(); it != m_subscribers.end(); ++it) {
+    if (it.key()->bytesToWrite() > SUBSCRIBER_MAX_PENDING_BYTES) {
+      // Drop this frame: the next one that is pushed will carry the image.
+      it->hasImage = false;
+      continue;
+    }
+    if (changed || !it->hasImage) {
+      writeFrame(it.key(), OP_SUBSCRIBE, it->tag,
+                 QByteArray(header, 12) + packedImage);
+      it->hasImage = true;
+    } else {
+      writeFrame(it.key(), OP_SUBSCRIBE, it->tag, QByteArray(header, 12));
+    }
+  }
+}
+
+void TcpServer::handleFrame(QTcpSocket *client, uint8_t opcode, uint16_t tag,
+                            const QByteArray &payload) {
+  std::optional<QByteArray> reply;
+  bool busError = false;
+
+  if (opcode == OP_TYPE) {
+    std::optional<VideoChipType> videoChipType = m_usbDev->videoChipType();
+    if (videoChipType == EF9345) {
+      reply = "EF9345";
+    } else if (videoChipType == TS9347) {
+      reply = "TS9347";
+    } else {
+      busError = true;
+    }
+  } else if (opcode == OP_FEATURES) {
+    reply = FEATURES;
+  } else if (opcode == OP_SCREENSHOT) {
+    QByteArray header, data;
+    captureScreenshot(&header, &data);
+    reply = QByteArray(1, header.size()) + header + data;
+  } else if (opcode == OP_FRAME_NUMBER) {
+    char number[4];
+    qToLittleEndian<uint32_t>(m_frameNumber, number);
+    reply = QByteArray(number, 4);
+  } else if (opcode == OP_SCREENSHOT_PACKED && payload.size() == 0) {
+    reply = capturePackedScreenshot();
+  } else if (opcode == OP_SCREENSHOT_PACKED && payload.size() == 8) {
+    const char *box = payload.constData(); // left, top, right, bottom
+    QPoint topLeft(qFromLittleEndian<uint16_t>(box),
+                   qFromLittleEndian<uint16_t>(box + 2));
+    QPoint bottomRight(qFromLittleEndian<uint16_t>(box + 4) - 1,
+                       qFromLittleEndian<uint16_t>(box + 6) - 1);
+    reply = capturePackedScreenshot(QRect(topLeft, bottomRight));
+    if (!reply.has_value()) {
+      writeFrame(client, OP_ERROR, tag, "Invalid region");
+      return;
+    }
+  } else if (opcode == OP_READ_REGISTER && payload.size() == 1) {
+    std::optional<uint8_t> result = m_usbDev->busRead(
+        static_cast<VideoChipRegister>(payload[0] & (REG_ER0 | 7)));
+    if (result.has_value()) {
+      reply = QByteArray(1, *result);
+    } else {
+      busError = true;
+    }
+  } else if (opcode == OP_WRITE_REGISTER && payload.size() == 2) {
+    if (!m_usbDev->busWrite(
+            static_cast<VideoChipRegister>(payload[0] & (REG_ER0 | 7)),
+            payload[1])) {
+      busError = true;
+    }
+  } else if (opcode == OP_WAIT && payload.size() == 2) {
+    startRequest(client,
+                 std::make_shared<WaitRequest>(
+                     tag, qFromLittleEndian<uint16_t>(payload.constData())));
+    return; // replied by startRequest or continueRequest
+  } else if (opcode == OP_TEXT) {
+    startRequest(client, std::make_shared<TextRequest>(tag, payload));
+    return; // replied by startRequest or continueRequest
+  } else if (std::optional<VramRequest> r = parseVramRequest(payload, false);
+             opcode == OP_VRAM_READ && r.has_value()) {
+    startRequest(client,
+                 std::make_shared<VramTransferRequest>(opcode, tag, *r, false));
+    return; // replied by startRequest or continueRequest
+  } else if (std::optional<VramRequest> r = parseVramRequest(payload, true);
+             opcode == OP_VRAM_WRITE && r.has_value()) {
+    startRequest(client,
+                 std::make_shared<VramTransferRequest>(opcode, tag, *r, true));
+    return; // replied by startRequest or continueRequest
+  } else if (std::optional<std::vector<ProgramInstruction>> program =
+                 parseProgram(payload);
+             opcode == OP_PROGRAM && program.has_value()) {
+    startRequest(client,
+                 std::make_shared<ProgramRequest>(tag, std::move(*program)));
+    return; // replied by startRequest or continueRequest
+  } else {
+    writeFrame(client, OP_ERROR, tag, "Invalid request");
+    return;
+  }
+
+  if (busError) {
+    writeFrame(client, OP_ERROR, tag, "Device not connected");
+  } else if (reply.has_value()) {
+    writeFrame(client, opcode, tag, *reply);
+  }
+}
+
+void TcpServer::captureScreenshot(QByteArray *header, QByteArray *png) {
+  if (m_imgProc->haveRed()) {
+    header->append('R');
+  }
+  if (m_imgProc->haveGreen()) {
+    header->append('G');
+  }
+  if (m_imgProc->haveBlue()) {
+    header->append('B');
+  }
+  if (m_imgProc->haveInsert()) {
+    header->append('I');
+  }
+
+  QImage image = m_imgProc->rgbInsertCroppedImage();
+  QBuffer buffer(png);
+  image.save(&buffer, "PNG");
+}
+
+std::optional<QByteArray>
+TcpServer::capturePackedScreenshot(std::optional<QRect> region) {
+  QRect imageRect = m_imgProc->rgbInsertCroppedImage().rect();
+  if (region.has_value() &&
+      (region->isEmpty() || !imageRect.contains(*region))) {
+    return std::nullopt;
+  }
+  QRect rect = region.value_or(imageRect);
+
+  char header[5];
+  header[0] =
+      (m_imgProc->haveRed() ? 8 : 0) | (m_imgProc->haveGreen() ? 4 : 0) |
+      (m_imgProc->haveBlue() ? 2 : 0) | (m_imgProc->haveInsert() ? 1 : 0);
+  qToLittleEndian<uint16_t>(rect.width(), header + 1);
+  qToLittleEndian<uint16_t>(rect.height(), header + 3);
+  return QByteArray(header, 5) + m_imgProc->rgbInsertCroppedPackedImage(rect);
+}
+
+void TcpServer::startRequest(QTcpSocket *client,
+                             std::shared_ptr<ChipRequest> request) {
+  if (runRequest(client, request.get())) {
+    m_pendingRequests.insert(client, request);
+  }
+}
+
+void TcpServer::continueRequest(QTcpSocket *client) {
+  auto it = m_pendingRequests.find(client);
+  if (it == m_pendingRequests.end()) {
+    return; // the client disconnected
+  }
+
+  std::shared_ptr<ChipRequest> request = *it;
+  if (request->sleeping) {
+    request->sleeping = false;
+  } else if (pollBusy(request.get())) {
+    scheduleWaitPoll(client, request.get());
+    return;
+  }
+  if (runRequest(client, request.get())) {
+    return;
+  }
+
+  m_pendingRequests.remove(client);
+  onReadyRead(client); // process the requests received in the meantime
+}
+
+bool TcpServer::runRequest(QTcpSocket *client, ChipRequest *request) {
+  while (!request->busError) {
+    ChipRequest::Step step = request->resume(m_usbDev);
+    if (step == ChipRequest::Step::DONE) {
+      break;
+    }
+    if (step == ChipRequest::Step::SLEEP) {
+      request->sleeping = true;
+      QTimer::singleShot(request->stepMs, Qt::PreciseTimer, client,
+                         [this, client]() { continueRequest(client); });
+      return true;
+    }
+
+    // Poll back-to-back for BUSY_SPIN_US, then from timers.
+    request->timer.start();
+    request->delayUs = BUSY_INITIAL_DELAY_US;
+    bool busy;
+    do {
+      busy = pollBusy(request);
+    } while (busy && request->timer.nsecsElapsed() / 1000 < BUSY_SPIN_US);
+    if (busy) {
+      scheduleWaitPoll(client, request);
+      return true;
+    }
+  }
+
+  replyToRequest(client, *request);
+  return false;
+}
+
+bool TcpServer::pollBusy(ChipRequest *request) {
+  std::optional<uint8_t> status = m_usbDev->busRead(REG_R0);
+  if (!status.has_value()) {
+    request->busError = true;
+    return false;
+  }
+  request->status = *status;
+  return (*status & 0x80) != 0 && !request->timer.hasExpired(request->stepMs);
+}
+
+void TcpServer::scheduleWaitPoll(QTcpSocket *client, ChipRequest *request) {
+  // The delays double at each poll, up to BUSY_MAX_DELAY_US.
+  int delayMs = (request->delayUs + 999) / 1000;
+  request->delayUs = std::min(request->delayUs * 2, BUSY_MAX_DELAY_US);
+  QTimer::singleShot(delayMs, Qt::PreciseTimer, client,
+                     [this, client]() { continueRequest(client); });
+}
+
+void TcpServer::replyToRequest(QTcpSocket *client, const ChipRequest &request) {
+  if (request.tag.has_value()) {
+    if (request.busError) {
+      writeFrame(client, OP_ERROR, *request.tag, "Device not connected");
+    } else {
+      writeFrame(client, request.opcode, *request.tag,
+                 QByteArray(1, request.status) + request.data);
+    }
+  } else {
+    if (request.busError) {
+      client->write("Device not connected, ignoring\n");
+    } else {
+      char buf[4];
+      sprintf(buf, request.hasData ? "%02X:" : "%02X\n", request.status);
+      client->write(buf);
+      if (request.hasData) {
+        client->write(request.data.toHex().toUpper());
+        client->write("\n");
+      }
+    }
+  }
+}
+
 void TcpServer::onReadChannelFinished(QTcpSocket *client) {
   m_clients.remove(client);
+  m_binaryClients.remove(client);
+  m_subscribers.remove(client);
+  m_pendingRequests.remove(client);
   client->deleteLater();
 }
@@ -4,9 +4,14 @@
 #include "ImageProcessor.h"
 #include "UsbDevice.h"
 
+#include <QHash>
 #include <QTcpServer>
 #include <QTcpSocket>
 
+#include <memory>
+
+class ChipRequest;
+
 class TcpServer : public QObject {
   Q_OBJECT
 
@@ -22,16 +27,65 @@ public:
                       QString *errorText);
   void stopListening();
 
+  // Count the latest image processed by the ImageProcessor as a new frame and
+  // push it to the subscribed clients.
+  void processNewFrame();
+
 private:
   void onNewConnection();
   void onReadyRead(QTcpSocket *client);
   void onReadChannelFinished(QTcpSocket *client);
 
+  // Handle all the complete binary frames received from a client that has
+  // switched to the binary protocol.
+  void processFrames(QTcpSocket *client);
+  void handleFrame(QTcpSocket *client, uint8_t opcode, uint16_t tag,
+                   const QByteArray &payload);
+
+  // Encode the latest image as PNG, together with the header that lists the
+  // available channels.
+  void captureScreenshot(QByteArray *header, QByteArray *png);
+
+  // Encode the latest image (or only the given region of it) as packed 4-bit
+  // color indices, preceded by the mask of the available channels (0bRGBI) and
+  // the image size. Returns nothing if the region does not fit in the image.
+  std::optional<QByteArray>
+  capturePackedScreenshot(std::optional<QRect> region = std::nullopt);
+
+  // Run a request that waits for the chip (see ChipRequest). Once the chip has
+  // been busy for BUSY_SPIN_US, the BUSY flag is polled from timers (and
+  // program sleeps are timers too), so that the event loop keeps running, and
+  // the client's next requests are left in its buffer until the reply has been
+  // sent.
+  void startRequest(QTcpSocket *client, std::shared_ptr<ChipRequest> request);
+  void continueRequest(QTcpSocket *client);
+
+  // Run the request until it completes (replying to it and returning false) or
+  // has to wait for a timer (returning true).
+  bool runRequest(QTcpSocket *client, ChipRequest *request);
+
+  // Read the status register once for the current wait of the request,
+  // returning whether the chip is still busy and the wait has not timed out.
+  bool pollBusy(ChipRequest *request);
+  void scheduleWaitPoll(QTcpSocket *client, ChipRequest *request);
+  void replyToRequest(QTcpSocket *client, const ChipRequest &request);
+
   UsbDeviceShim *m_usbDev;
   ImageProcessor *m_imgProc;
 
   QTcpServer *m_server;
   QSet<QTcpSocket *> m_clients;
+  QSet<QTcpSocket *> m_binaryClients;
+
+  struct Subscriber {
+    uint16_t tag;
+    bool hasImage; // whether the latest image has been pushed
+  };
+  QHash<QTcpSocket *, Subscriber> m_subscribers;
+
+  QHash<QTcpSocket *, std::shared_ptr<ChipRequest>> m_pendingRequests;
+  uint32_t m_frameNumber = 0;
+  QByteArray m_latestPackedImage;
 };
 
 #endif
@@ -0,0 +1,89 @@
+import argparse
+import os
+import sys
+from pathlib import Path
+import PIL.Image
+import PIL.ImageSequence
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "tests"))
+
+from testlib.channels import ChannelSet
+from testlib.frame_store import FrameStore
+from testlib.reference_archive import ReferenceArchive
+from testlib.screenshot import Screenshot
+
+
+def do_pack(args: argparse.Namespace):
+    references = []
+    for directory in args.directory:
+        # Decode the files directly, bypassing the cache of Screenshot.load,
+        # and include the references that have been moved into a store.
+        for path in sorted(directory.glob("*.png")):
+            images = PIL.ImageSequence.all_frames(PIL.Image.open(path))
+            screenshot = Screenshot(images, ChannelSet.RGBI)
+            name = f"{directory.name}/{path.name}"
+            references.append((name, screenshot._packed, screenshot.width))
+        store = FrameStore(directory)
+        for name in store.names():
+            packed, width = store.load(name)
+            references.append((f"{directory.name}/{name}", packed, width))
+    ReferenceArchive.write(args.archive, references)
+    print(
+        f"{args.archive}: {len(references)} references, "
+        f"{os.path.getsize(args.archive)} bytes"
+    )
+
+
+def do_unpack(args: argparse.Namespace):
+    archive = ReferenceArchive(args.archive)
+    names = archive.names()
+    for name in names:
+        path = args.output / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        packed, width = archive.load(name)
+        Screenshot.from_packed(packed, width, ChannelSet.RGBI).save(str(path))
+    archive.close()
+    print(f"{args.archive}: {len(names)} references unpacked")
+
+
+def do_list(args: argparse.Namespace):
+    archive = ReferenceArchive(args.archive)
+    for name in archive.names():
+        packed, width = archive.load(name)
+        n_frames, height, _ = packed.shape
+        print(f"{name}: {n_frames} frames, {width}x{height}")
+    archive.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Packs directories of reference screenshots into a single "
+        "archive file, and back."
+    )
+
+    command = parser.add_subparsers(metavar="COMMAND", required=True)
+
+    pack = command.add_parser(
+        "pack", help="write the references of the given directories"
+    )
+    pack.add_argument("archive", type=Path)
+    pack.add_argument("directory", type=Path, nargs="+")
+    pack.set_defaults(func=do_pack)
+
+    unpack = command.add_parser(
+        "unpack", help="write the references in an archive as PNG files"
+    )
+    unpack.add_argument("archive", type=Path)
+    unpack.add_argument("output", type=Path)
+    unpack.set_defaults(func=do_unpack)
+
+    list_ = command.add_parser("list")
+    list_.add_argument("archive", type=Path)
+    list_.set_defaults(func=do_list)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
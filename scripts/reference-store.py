@@ -0,0 +1,113 @@
+import argparse
+import sys
+from pathlib import Path
+import numpy as np
+import PIL.Image
+import PIL.ImageSequence
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "tests"))
+
+from testlib.channels import ChannelSet
+from testlib.frame_store import FrameStore
+from testlib.screenshot import Screenshot
+
+
+def do_migrate(args: argparse.Namespace):
+    store = FrameStore(args.directory)
+    paths = sorted(args.directory.glob("*.png"))
+    migrated = {}
+    for path in paths:
+        # Decode the files directly, bypassing the cache of Screenshot.load.
+        images = PIL.ImageSequence.all_frames(PIL.Image.open(path))
+        screenshot = Screenshot(images, ChannelSet.RGBI)
+        store.add(path.name, screenshot._packed, screenshot.width)
+        migrated[path.name] = screenshot
+    store.save()
+
+    # Read the references back from the saved store before deleting anything.
+    saved = FrameStore(args.directory)
+    mismatching = []
+    for name, screenshot in migrated.items():
+        packed, width = saved.load(name)
+        if width != screenshot.width or not np.array_equal(
+            packed, screenshot._packed
+        ):
+            mismatching.append(name)
+    if mismatching:
+        sys.exit(
+            f"{args.directory}: {len(mismatching)} references differ once "
+            f"stored, the PNG files have been kept: {', '.join(mismatching)}"
+        )
+
+    if not args.keep:
+        for path in paths:
+            path.unlink()
+    print(
+        f"{args.directory}: {len(paths)} references migrated, "
+        f"{len(store.strip_digests())} unique strips in the store"
+    )
+
+
+def do_export(args: argparse.Namespace):
+    store = FrameStore(args.directory)
+    names = store.names()
+    for name in names:
+        packed, width = store.load(name)
+        Screenshot.from_packed(packed, width, ChannelSet.RGBI).save(
+            str(args.directory / name)
+        )
+        if not args.keep:
+            store.remove(name)
+    if not args.keep:
+        store.save()
+        store.prune()
+    print(f"{args.directory}: {len(names)} references exported")
+
+
+def do_info(args: argparse.Namespace):
+    for directory in args.directory:
+        store = FrameStore(directory)
+        names = store.names()
+        n_frames = sum(len(store.load(name)[0]) for name in names)
+        print(
+            f"{directory}: {len(names)} references, {n_frames} frames, "
+            f"{len(store.strip_digests())} unique strips"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Converts directories of reference screenshots into "
+        "content-addressed stores, and back."
+    )
+
+    command = parser.add_subparsers(metavar="COMMAND", required=True)
+
+    migrate = command.add_parser(
+        "migrate", help="move the PNG files of a directory into its store"
+    )
+    migrate.add_argument("directory", type=Path)
+    migrate.add_argument(
+        "-k", "--keep", action="store_true", help="keep the PNG files"
+    )
+    migrate.set_defaults(func=do_migrate)
+
+    export = command.add_parser(
+        "export", help="write the references in a store back as PNG files"
+    )
+    export.add_argument("directory", type=Path)
+    export.add_argument(
+        "-k", "--keep", action="store_true", help="keep the store"
+    )
+    export.set_defaults(func=do_export)
+
+    info = command.add_parser("info")
+    info.add_argument("directory", type=Path, nargs="*")
+    info.set_defaults(func=do_info)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
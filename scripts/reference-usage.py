@@ -0,0 +1,58 @@
+import argparse
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "tests"))
+
+from testlib.prefetch import LEARNED_MANIFEST_NAME, SEED_MANIFEST_NAME
+from testlib.video_chip import VideoChipType
+
+TESTS_DIR = Path(__file__).parent.parent / "tests"
+
+
+def do_update(args: argparse.Namespace):
+    for chip_type in VideoChipType:
+        seed_path = TESTS_DIR / (SEED_MANIFEST_NAME % chip_type.value)
+        try:
+            seed = json.loads(seed_path.read_text())
+        except FileNotFoundError:
+            seed = {}
+
+        # Replace the sections of the scripts that have been run, and drop the
+        # ones of the scripts that no longer exist.
+        updated = []
+        for script in sorted(TESTS_DIR.glob("test_*.py")):
+            path = TESTS_DIR / (
+                LEARNED_MANIFEST_NAME % (script.stem, chip_type.value)
+            )
+            if path.exists():
+                learned = json.loads(path.read_text())
+                seed[script.stem] = {
+                    name: references
+                    for name, references in learned.items()
+                    if len(references) != 0
+                }
+                updated.append(script.stem)
+        seed = {
+            name: section
+            for name, section in seed.items()
+            if (TESTS_DIR / f"{name}.py").exists() and len(section) != 0
+        }
+
+        seed_path.write_text(json.dumps(seed, indent=1, sort_keys=True) + "\n")
+        print(f"{seed_path}: updated {', '.join(updated) or 'nothing'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Copies the references used by each test, as learned by "
+        "the test runs in this checkout, into the seed manifests kept in the "
+        "repository. Run all the tests against a real chip of each type first."
+    )
+    args = parser.parse_args()
+    do_update(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -156,9 +156,7 @@ def test_40columns_attributes(video: VideoChip, pat_extra: int, pat_descr: str):
     video.R2 = 0x01  # insert
     video.R6 = 0  # y
     video.R7 = 0  # x
-    for c in pat_descr:
-        video.ER1 = ord(c)
-        video.wait_not_busy()
+    video.write_text(pat_descr)
 
     # Draw color stripes with varying attributes.
     match video.chip_type:
@@ -182,9 +180,7 @@ def test_40columns_attributes(video: VideoChip, pat_extra: int, pat_descr: str):
             video.wait_not_busy()
         video.R3 = 0x70  # white on black
         video.R2 = 0x01  # insert
-        for c in f" {description}":
-            video.ER1 = ord(c)
-            video.wait_not_busy()
+        video.write_text(f" {description}")
 
     reference = Screenshot.load(
         "test_colors_data/test_40columns_attributes_%s_pat%02x.png"
@@ -264,51 +260,21 @@ def test_40columns_cursor(
     video.ER0 = 0x84
     video.wait_not_busy()
 
-    # Clear screen.
-    video.R1 = ord(" ")
-    video.R2 = 0x01  # insert bit set
-    video.R3 = 0x00
-    video.R6 = 0  # y
-    video.R7 = 0  # x
-    video.ER0 = 0x05  # CLF/CLL
-    time.sleep(0.5)
-    video.ER0 = 0x91  # NOP to stop it.
-    video.wait_not_busy()
+    # Draw the page on a blank screen (insert bit set). Since consecutive cases
+    # differ in a few cells only, just those are rewritten.
+    page = Page(fill=(ord(" "), 0x01, 0x00))
 
-    # Draw header.
-    video.R0 = 0x01  # KRF/TLM with auto-increment.
-    video.R3 = 0x70  # white on black
-    video.R2 = 0x01  # insert
-    video.R6 = 0  # y
-    video.R7 = 0  # x
-    for c in pat_descr:
-        video.ER1 = ord(c)
-        video.wait_not_busy()
+    # Header, in white on black.
+    page.write_text(0, 0, pat_descr, a=0x70, b=0x01)
 
-    # Draw test pattern.
-    video.R0 = 0x01  # KRF/TLM with auto-increment.
-    video.R6 = 8  # y
-    video.R7 = 0  # x
-    for c in " EXAMPLE ":
-        video.R3 = a | 0x13  # red on yellow
-        video.R2 = b
-        video.ER1 = ord(c)
-        video.wait_not_busy()
-    video.R3 = 0x70  # white on black
-    video.R2 = 0x01  # insert
-    for c in f" {attr_descr}":
-        video.ER1 = ord(c)
-        video.wait_not_busy()
+    # Test pattern (red on yellow), followed by its description.
+    page.write_text(8, 0, " EXAMPLE ", a=a | 0x13, b=b)
+    page.write_text(8, 9, f" {attr_descr}", a=0x70, b=0x01)
 
-    # Draw cursor type description.
-    video.R0 = 0x01  # KRF/TLM with auto-increment.
-    video.R6 = 9  # y
-    video.R7 = 3  # x
-    video.R3 = 0x70  # white on black
-    video.R2 = 0x01  # insert
-    for c in f"\x5E {mat_descr}"[:31]:
-        video.ER1 = ord(c)
-        video.wait_not_busy()
+    # Cursor type description.
+    page.write_text(9, 3, f"\x5E {mat_descr}"[:31], a=0x70, b=0x01)
+
+    video.render_page(page)
 
     # Position the cursor on the "A" of "EXAMPLE".
     video.R6 = 8  # y
@@ -318,17 +284,18 @@ def test_40columns_cursor(
         "test_colors_data/test_40columns_cursor_%s_pat%02xmat%02xa%02xb%02x.png"
         % (video.chip_type.value, pat_extra, mat_extra, a, b)
     )
+    cursor_row = reference.rows_region(8, 8)
     if tgs_bgr == tgs_bir:
-        video.expect_screenshot(reference, ChannelSet.RGBI)
+        video.expect_screenshot(reference, ChannelSet.RGBI, cursor_row)
     else:
         video.R1 = tgs_bir
         video.ER0 = 0x81
         video.wait_not_busy()
-        video.expect_screenshot(reference, ChannelSet.RBI)
+        video.expect_screenshot(reference, ChannelSet.RBI, cursor_row)
         video.R1 = tgs_bgr
         video.ER0 = 0x81
         video.wait_not_busy()
-        video.expect_screenshot(reference, ChannelSet.RGB)
+        video.expect_screenshot(reference, ChannelSet.RGB, cursor_row)
 
 
 def test_80columns_attributes_generator(video: VideoChip):
@@ -394,9 +361,7 @@ def test_80columns_attributes(video: VideoChip, pat_extra: int, pat_descr: str):
     video.R3 = 0x11  # c1
     video.R6 = 0  # y
     video.R7 = 0  # x
-    for c in pat_descr:
-        video.ER1 = ord(c)
-        video.wait_not_busy()
+    video.write_text(pat_descr)
 
     # Draw color stripes with varying attributes.
     for row, (a, description) in enumerate(
@@ -410,9 +375,7 @@ def test_80columns_attributes(video: VideoChip, pat_extra: int, pat_descr: str):
         video.wait_not_busy()
         video.R7 = 0x81  # column 3
         video.R3 = 0x11  # c1
-        for c in description:
-            video.ER1 = ord(c)
-            video.wait_not_busy()
+        video.write_text(description)
 
     reference = Screenshot.load(
         "test_colors_data/test_80columns_attributes_pat%02x.png" % pat_extra
@@ -505,30 +468,22 @@ def test_80columns_cursor(
     video.R3 = 0x11  # c1
     video.R6 = 0  # y
     video.R7 = 0  # x
-    for c in pat_descr:
-        video.ER1 = ord(c)
-        video.wait_not_busy()
+    video.write_text(pat_descr)
 
     # Draw test pattern.
     video.R6 = 8  # y
     video.R7 = 0  # x
     video.R3 = a * 0x11
-    for c in " EXAMPLE ":
-        video.ER1 = ord(c)
-        video.wait_not_busy()
+    video.write_text(" EXAMPLE ")
     video.R7 = 5  # x
     video.R3 = 0x11  # c1
-    for c in attr_descr:
-        video.ER1 = ord(c)
-        video.wait_not_busy()
+    video.write_text(attr_descr)
 
     # Draw cursor type description.
     video.R6 = 9  # y
     video.R7 = 0x81  # x
     video.R3 = 0x11  # c1
-    for c in f"\x5E {mat_descr}"[:31]:
-        video.ER1 = ord(c)
-        video.wait_not_busy()
+    video.write_text(f"\x5E {mat_descr}"[:31])
 
     # Position the cursor on the "A" of "EXAMPLE".
     video.R6 = 8  # y
@@ -25,26 +25,13 @@ def test_read_ind(video: VideoChip, b: int):
     video.ER0 = 0x81
     video.wait_not_busy()
 
-    bits = []
-    video.R0 = 0x88  # IND from ROM
-    for c in range(0, 128, 4):
-        video.R6 = (0x20 if (b & 4) else 0) | ((c & 0x7C) >> 2)
-        for sn_and_low_c in range(16 * 4):
-            video.ER7 = (
-                (0x80 if (b & 1) else 0)
-                | (0x40 if (b & 2) else 0)
-                | sn_and_low_c
-            )
-            video.wait_not_busy()
-            bits.append(video.R1)
-
-    reference = PIL.Image.open(
-        "test_font_data/test_read_ind_%s_b%d.png" % (video.chip_type.value, b),
-        formats=["png"],
-    ).convert("1")
-    actual = PIL.Image.frombytes(
-        "1", (32, len(bits) // 4), bytes(bits), "raw", "1;R"
+    bits = video.dump_font_rom(b)
+
+    screenshot = Screenshot.load(
+        "test_font_data/test_read_ind_%s_b%d.png" % (video.chip_type.value, b)
     )
+    reference = screenshot.images[0].convert("1")
+    actual = PIL.Image.frombytes("1", (32, len(bits) // 4), bits, "raw", "1;R")
     assert test_images_equal(actual, reference)
 
 
@@ -108,21 +95,15 @@ def test_render_40columns(video: VideoChip, b: int):
     video.R3 = 0x70  # A
     video.R6 = 0  # y
     video.R7 = 0  # x
-    for c in "Font with B=0x%x_" % b:
-        video.ER1 = ord(c)
-        video.wait_not_busy()
+    video.write_text("Font with B=0x%x_" % b)
 
     # Show header at lines 10-11.
     video.R6 = 10  # y
     video.R7 = 0  # x
-    for c in "       _0  _1  _2  _3  _4  _5  _6  _7":
-        video.ER1 = ord(c)
-        video.wait_not_busy()
+    video.write_text("       _0  _1  _2  _3  _4  _5  _6  _7")
     video.R6 += 1  # y
     video.R7 = 0  # x
-    for c in "       _8  _9  _A  _B  _C  _D  _E  _F":
-        video.ER1 = ord(c)
-        video.wait_not_busy()
+    video.write_text("       _8  _9  _A  _B  _C  _D  _E  _F")
     video.R6 += 1  # y
 
     # Fill rows.
@@ -130,9 +111,7 @@ def test_render_40columns(video: VideoChip, b: int):
         video.R7 = 0  # x
 
         video.R2 = 0x00  # alphanumeric text
-        for c in "C=%x_ \x0e " % top_bits:
-            video.ER1 = ord(c)
-            video.wait_not_busy()
+        video.write_text("C=%x_ \x0e " % top_bits)
 
         init_x = video.R7
         video.R2 = b << 4
@@ -292,9 +271,7 @@ def test_render_80columns(video: VideoChip):
 
         video.R6 = 0 if row == 0 else (row + 7)
         video.R7 = 0
-        for c in (text + b" " * 80)[:80]:
-            video.ER1 = c
-            video.wait_not_busy()
+        video.write_text((text + b" " * 80)[:80])
 
     reference = Screenshot.load(
         "test_font_data/test_render_80columns_%s.png" % video.chip_type.value
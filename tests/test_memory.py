@@ -30,22 +30,16 @@ def test_address_transcoding(video: VideoChip, tested_b: int, tested_y: int):
     video.R0 = 0x31  # OCT/TBM with auto-increment
     video.R6 = tested_y
     video.R7 = (0x80 if (tested_b & 1) else 0) | (0x40 if (tested_b & 2) else 0)
-    for x in range(40):
-        video.ER1 = 0x30 + x
-        video.wait_not_busy()
+    video.write_text(bytes(0x30 + x for x in range(40)))
 
     # Read back all of blocks 0 and 1.
-    video.R0 = 0x39  # OCT/TBM (read) with auto-increment
     output = "B  Y DATA...\n"
     for b in [0, 1]:
+        data = video.read_vram(b, range(32), range(40), command=0x30)  # OCT/TBM
         for y in range(32):
             output += "%d %2d" % (b, y)
-            video.R6 = y
-            r7_base = (0x80 if (b & 1) else 0) | (0x40 if (b & 2) else 0)
             for x in range(40):
-                video.ER7 = r7_base | x
-                video.wait_not_busy()
-                output += " %02x" % video.R1
+                output += " %02x" % data[y * 40 + x]
             output += "\n"
 
     # Compare against the expected memory dump.
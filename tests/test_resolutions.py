@@ -151,9 +151,7 @@ def test_areas_40columns(video: VideoChip):
     for y in [0, *range(8, 32)]:
         video.R6 = y
         video.R7 = 0  # x
-        for c in str(y):
-            video.ER1 = ord(c)
-            video.wait_not_busy()
+        video.write_text(str(y))
 
     # Draw a double-height unique character at each boundary crossing, on a
     # "background" of normal-sized Xs (to detect unwanted attribute "leakage").
@@ -241,9 +239,7 @@ def test_areas_80columns(video: VideoChip):
     for y in [0, *range(8, 32)]:
         video.R6 = y
         video.R7 = 0  # x
-        for c in str(y):
-            video.ER1 = ord(c)
-            video.wait_not_busy()
+        video.write_text(str(y))
 
     for ref_name, pat_extra, tgs_extra, mat_extra in test_areas_generator(
         video.chip_type
@@ -24,5 +24,26 @@ def test_not_busy(video: VideoChip):
         assert (video.R0 & 0x80) == 0
 
 
+# Same as test_not_busy, through the asynchronous client.
+@test()
+async def test_not_busy_async(video: AsyncVideoChip):
+    # tgs
+    video.R1 = 0xD0
+    video.ER0 = 0x81
+    await video.wait_not_busy()
+
+    # pat
+    video.R1 = 0x00
+    video.ER0 = 0x83
+    await video.wait_not_busy()
+
+    video.ER0 = 0x91  # NOP
+    await video.wait_not_busy()
+
+    start = time.monotonic_ns()
+    while time.monotonic_ns() - start < 500000000:  # 500 ms
+        assert (await video.R0 & 0x80) == 0
+
+
 if __name__ == "__main__":
     test_main()
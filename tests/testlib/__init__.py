@@ -1,5 +1,16 @@
+from .async_video_chip import AsyncVideoChip
+from .busy_wait import BusyWaitPolicy, CommandDurations
+from .cell_grid import (
+    CellFlags,
+    CellGrid,
+    DecodedCell,
+    GlyphTable,
+    decode_cells,
+)
 from .channels import PALETTE_IMAGE, ChannelSet
 from .image_utils import test_images_equal, vertical_concat
-from .screenshot import Screenshot, ScreenshotMatcher
+from .page import Page
+from .program import Program
+from .screenshot import Region, Screenshot, ScreenshotMatcher
 from .test_framework import test, test_main
-from .video_chip import VideoChip, VideoChipType
+from .video_chip import PendingReply, VideoChip, VideoChipType
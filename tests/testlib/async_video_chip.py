@@ -0,0 +1,480 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import struct
+import time
+from typing import (
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    FrozenSet,
+    Optional,
+    Tuple,
+    Union,
+)
+import PIL.Image
+
+from .busy_wait import BusyWaitPolicy
+from .channels import ChannelSet
+from .frame_subscription import _MAX_RETAINED_FRAMES, Frame, parse_frame_push
+from .protocol import (
+    _NO_REPLY_OPCODES,
+    BINARY_PROTOCOL_VERSION,
+    FRAME_HEADER,
+    Address,
+    Opcode,
+    RequestError,
+)
+from .screenshot import Region, Screenshot
+from .shared_frames import POLL_INTERVAL, SharedFrames
+from .video_chip import (
+    _FRAME_TIMEOUT,
+    _SCREENSHOT_FRAME_SPACING,
+    VideoChip,
+    VideoChipType,
+    _can_subscribe,
+    _FrameTimeline,
+    _NotBusyWait,
+    _open_shared_frames,
+    _screenshot_request,
+    _ScreenshotCollector,
+    _ScreenshotExpectation,
+    _text_registers,
+)
+
+
+class _AsyncTransport:
+    """
+    The binary protocol, on top of asyncio streams.
+
+    A background task receives the replies and matches them to the requests by
+    their tag, so that any number of requests can be in flight at once.
+    """
+
+    def __init__(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        self._reader = reader
+        self._writer = writer
+        self._next_tag = 0
+        self._pending: Dict[
+            int, Tuple[Opcode, asyncio.Future, Callable[[bytes], object]]
+        ] = {}
+        self._push_handlers: Dict[int, Callable[[Optional[bytes]], None]] = {}
+        self._error: Optional[Exception] = None
+        self._receive_task = asyncio.create_task(self._receive_loop())
+
+    @classmethod
+    async def open(cls, address: Address) -> _AsyncTransport:
+        if isinstance(address, str):
+            reader, writer = await asyncio.open_unix_connection(address)
+        else:
+            reader, writer = await asyncio.open_connection(*address)
+
+        # Switch to the binary protocol (servers that do not support it reply
+        # with an error message instead).
+        writer.write(b"BINARY=%d\n" % BINARY_PROTOCOL_VERSION)
+        if (await reader.readline()).strip() != b"OK":
+            writer.close()
+            raise ConnectionError("The server refused the binary protocol")
+        return cls(reader, writer)
+
+    def send(
+        self,
+        opcode: Opcode,
+        payload: bytes = b"",
+        parse: Callable[[bytes], object] = bytes,
+    ) -> Optional[asyncio.Future]:
+        """
+        Send a request, returning a future for its parsed reply (or None if it
+        does not get a reply).
+        """
+        if self._error is not None:
+            raise ConnectionError("Connection lost") from self._error
+
+        tag = self._next_tag
+        self._next_tag = (tag + 1) & 0xFFFF
+        self._writer.write(FRAME_HEADER.pack(opcode, tag, len(payload)))
+        self._writer.write(payload)
+        if opcode in _NO_REPLY_OPCODES:
+            return None
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[tag] = (opcode, future, parse)
+        return future
+
+    def subscribe(
+        self, opcode: Opcode, handler: Callable[[Optional[bytes]], None]
+    ):
+        """
+        Send a request that keeps getting replies, passing each of them to the
+        given handler (or None, if the connection is lost).
+        """
+        tag = self._next_tag
+        self._next_tag = (tag + 1) & 0xFFFF
+        self._writer.write(FRAME_HEADER.pack(opcode, tag, 0))
+        self._push_handlers[tag] = handler
+
+    async def drain(self):
+        await self._writer.drain()
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+        self._receive_task.cancel()
+
+    async def _receive_loop(self):
+        try:
+            while True:
+                opcode, tag, length = FRAME_HEADER.unpack(
+                    await self._reader.readexactly(FRAME_HEADER.size)
+                )
+                payload = await self._reader.readexactly(length)
+
+                if tag in self._push_handlers:
+                    self._push_handlers[tag](payload)
+                    continue
+
+                expected_opcode, future, parse = self._pending.pop(tag)
+                if future.cancelled():
+                    continue
+                if opcode == Opcode.ERROR:
+                    future.set_exception(
+                        RequestError(payload.decode(errors="replace"))
+                    )
+                elif opcode != expected_opcode:
+                    future.set_exception(
+                        RequestError(
+                            "Unexpected reply %02x/%d to request %02x/%d"
+                            % (opcode, tag, expected_opcode, tag)
+                        )
+                    )
+                else:
+                    try:
+                        future.set_result(parse(payload))
+                    except Exception as e:
+                        future.set_exception(e)
+        except Exception as e:
+            self._error = e
+            for _, future, _ in self._pending.values():
+                if not future.done():
+                    future.set_exception(
+                        ConnectionError("Connection lost: %s" % e)
+                    )
+            self._pending.clear()
+            for handler in self._push_handlers.values():
+                handler(None)
+
+
+class _AsyncFrameSubscription:
+    # Counterpart of FrameSubscription, receiving frames in the event loop
+    # instead of in a thread.
+
+    def __init__(self, transport: _AsyncTransport):
+        self._transport = transport
+        self._frames: Deque[Frame] = collections.deque(
+            maxlen=_MAX_RETAINED_FRAMES
+        )
+        self._last_frame: Optional[Frame] = None
+        self._lost = False
+        self._changed = asyncio.Event()
+        transport.subscribe(Opcode.SUBSCRIBE, self._on_push)
+
+    def _on_push(self, payload: Optional[bytes]):
+        if payload is None:
+            self._lost = True
+        else:
+            self._last_frame = parse_frame_push(payload, self._last_frame)
+            self._frames.append(self._last_frame)
+        self._changed.set()
+
+    async def frames(self, after: int, timeout: float) -> AsyncIterator[Frame]:
+        while True:
+            frame = next((f for f in self._frames if f.number > after), None)
+            if frame is None:
+                if self._lost:
+                    raise ConnectionError("Subscription lost")
+                self._changed.clear()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout)
+                except TimeoutError:
+                    raise TimeoutError("No frame received") from None
+                continue
+            after = frame.number
+            yield frame
+
+    async def close(self):
+        await self._transport.close()
+
+
+class _AsyncSharedFrames:
+    # Polls a SharedFrames ring without blocking the event loop.
+
+    def __init__(self, shared_frames: SharedFrames):
+        self._shared_frames = shared_frames
+
+    async def frames(self, after: int, timeout: float) -> AsyncIterator[Frame]:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            frame = self._shared_frames.next_frame(after)
+            if frame is None:
+                if loop.time() > deadline:
+                    raise TimeoutError("No frame received")
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            yield frame
+            deadline = loop.time() + timeout
+            after = frame.number
+
+    async def close(self):
+        self._shared_frames.close()
+
+
+class _AsyncVideoChipRegisterDescriptor:
+    def __init__(self, regnum: int, execute: bool) -> None:
+        self._regnum = regnum
+        self._execute = execute
+
+    def __get__(
+        self, obj: AsyncVideoChip, _objtype: type = None
+    ) -> asyncio.Future:
+        return obj.read_register(self._regnum, self._execute)
+
+    def __set__(self, obj: AsyncVideoChip, value: int):
+        obj.write_register(self._regnum, value, self._execute)
+
+
+class AsyncVideoChip:
+    """
+    The asyncio counterpart of VideoChip, for keeping several requests (or
+    several chips) busy from a single event loop.
+
+    Reading a register sends the request immediately, in order with all the
+    others, and returns a future for its value (e.g. "status = await video.R0").
+    Register writes do not get any reply. Only servers that support the binary
+    protocol can be used.
+    """
+
+    R0 = _AsyncVideoChipRegisterDescriptor(0, False)
+    R1 = _AsyncVideoChipRegisterDescriptor(1, False)
+    R2 = _AsyncVideoChipRegisterDescriptor(2, False)
+    R3 = _AsyncVideoChipRegisterDescriptor(3, False)
+    R4 = _AsyncVideoChipRegisterDescriptor(4, False)
+    R5 = _AsyncVideoChipRegisterDescriptor(5, False)
+    R6 = _AsyncVideoChipRegisterDescriptor(6, False)
+    R7 = _AsyncVideoChipRegisterDescriptor(7, False)
+    ER0 = _AsyncVideoChipRegisterDescriptor(0, True)
+    ER1 = _AsyncVideoChipRegisterDescriptor(1, True)
+    ER2 = _AsyncVideoChipRegisterDescriptor(2, True)
+    ER3 = _AsyncVideoChipRegisterDescriptor(3, True)
+    ER4 = _AsyncVideoChipRegisterDescriptor(4, True)
+    ER5 = _AsyncVideoChipRegisterDescriptor(5, True)
+    ER6 = _AsyncVideoChipRegisterDescriptor(6, True)
+    ER7 = _AsyncVideoChipRegisterDescriptor(7, True)
+
+    def __init__(
+        self,
+        transport: _AsyncTransport,
+        address: Address,
+        features: FrozenSet[str],
+        busy_policy: Optional[BusyWaitPolicy],
+    ):
+        # Use AsyncVideoChip.connect instead.
+        self._transport = transport
+        self._address = address
+        self._features = features
+        self.busy_policy = busy_policy or BusyWaitPolicy()
+        self._r0: Optional[int] = None
+        self._running_command: Optional[Tuple[Optional[int], float]] = None
+        self._frame_source: Union[
+            _AsyncSharedFrames, _AsyncFrameSubscription, None
+        ] = None
+
+    @classmethod
+    async def connect(
+        cls, address: Address, busy_policy: Optional[BusyWaitPolicy] = None
+    ) -> AsyncVideoChip:
+        transport = await _AsyncTransport.open(address)
+        features = await transport.send(
+            Opcode.FEATURES,
+            b"",
+            lambda payload: frozenset(payload.decode().split()),
+        )
+        return cls(transport, address, features, busy_policy)
+
+    async def close(self):
+        if self._frame_source is not None:
+            await self._frame_source.close()
+        await self._transport.close()
+
+    async def _query(
+        self,
+        opcode: Opcode,
+        payload: bytes,
+        parse: Callable[[bytes], object],
+    ):
+        reply = self._transport.send(opcode, payload, parse)
+        await self._transport.drain()
+        return await reply
+
+    @property
+    def features(self) -> FrozenSet[str]:
+        """The protocol extensions supported by the server."""
+        return self._features
+
+    async def chip_type(self) -> VideoChipType:
+        return await self._query(
+            Opcode.TYPE,
+            b"",
+            lambda payload: VideoChipType(payload.decode()),
+        )
+
+    def read_register(self, regnum: int, execute: bool) -> asyncio.Future:
+        assert regnum < 8
+
+        return self._transport.send(
+            Opcode.READ_REGISTER,
+            bytes([regnum | (8 if execute else 0)]),
+            VideoChip._parse_byte,
+        )
+
+    def write_register(self, regnum: int, value: int, execute: bool):
+        assert regnum < 8
+        assert 0 <= value < 256
+
+        self._transport.send(
+            Opcode.WRITE_REGISTER,
+            bytes([regnum | (8 if execute else 0), value]),
+        )
+
+        if regnum == 0:
+            self._r0 = value
+        if execute:
+            self._running_command = (self._r0, time.monotonic())
+
+    async def wait_not_busy(self):
+        """See VideoChip.wait_not_busy."""
+        wait = _NotBusyWait(self.busy_policy, self._running_command)
+        self._running_command = None
+
+        while True:
+            if "WAIT" in self.features:
+                status = await self._query(
+                    Opcode.WAIT, wait.wait_request, VideoChip._parse_byte
+                )
+            else:
+                status = await self.R0
+            delay = wait.advance(status)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+        wait.record()
+
+    async def write_text(
+        self,
+        text: Union[str, bytes],
+        *,
+        a: Optional[int] = None,
+        b: Optional[int] = None,
+        y: Optional[int] = None,
+        x: Optional[int] = None,
+        command: Optional[int] = None,
+    ):
+        """See VideoChip.write_text."""
+        if isinstance(text, str):
+            text = text.encode("latin-1")
+
+        for regnum, value in _text_registers(a, b, y, x, command):
+            self.write_register(regnum, value, False)
+
+        if "TEXT" not in self.features:
+            for c in text:
+                self.ER1 = c
+                await self.wait_not_busy()
+            return
+
+        await self._query(
+            Opcode.TEXT,
+            text,
+            VideoChip._wait_reply_parser(self._r0, time.monotonic()),
+        )
+
+    async def frame_number(self) -> int:
+        """See VideoChip.frame_number."""
+        return await self._query(
+            Opcode.FRAME_NUMBER,
+            b"",
+            lambda payload: struct.unpack("<I", payload)[0],
+        )
+
+    async def expect_screenshot(
+        self,
+        reference: Screenshot,
+        channels: ChannelSet,
+        region: Optional[Region] = None,
+        mask: Optional[PIL.Image.Image] = None,
+    ):
+        """See VideoChip.expect_screenshot."""
+        expectation = _ScreenshotExpectation(reference, channels, region, mask)
+        async for elapsed, channels, image in self._frames(region):
+            if expectation.advance(elapsed, channels, image):
+                return
+
+    async def screenshot(
+        self, n_frames: int = 1, region: Optional[Region] = None
+    ) -> Screenshot:
+        collector = _ScreenshotCollector(n_frames)
+        async for elapsed, channels, image in self._frames(region):
+            if collector.advance(elapsed, channels, image):
+                return collector.screenshot
+
+    async def _frames(
+        self, region: Optional[Region]
+    ) -> AsyncIterator[Tuple[float, ChannelSet, PIL.Image.Image]]:
+        # See VideoChip._frames.
+        frame_source = await self._get_frame_source()
+        if frame_source is None:
+            loop = asyncio.get_running_loop()
+            await asyncio.sleep(0.5)
+            start = loop.time()
+            while True:
+                channels, image = await self._take_screenshot(region)
+                yield loop.time() - start, channels, image
+                await asyncio.sleep(_SCREENSHOT_FRAME_SPACING)
+
+        timeline = _FrameTimeline(region)
+        async for frame in frame_source.frames(
+            await self.frame_number() + 1, _FRAME_TIMEOUT
+        ):
+            yield timeline.advance(frame)
+
+    async def _get_frame_source(
+        self,
+    ) -> Union[_AsyncSharedFrames, _AsyncFrameSubscription, None]:
+        # See VideoChip._get_frame_source.
+        if self._frame_source is None and "SHARED_FRAMES" in self.features:
+            shared_frames = await self._query(
+                Opcode.SHARED_FRAMES, b"", _open_shared_frames
+            )
+            if shared_frames is not None:
+                self._frame_source = _AsyncSharedFrames(shared_frames)
+        if self._frame_source is None and _can_subscribe(self.features):
+            self._frame_source = _AsyncFrameSubscription(
+                await _AsyncTransport.open(self._address)
+            )
+        return self._frame_source
+
+    async def _take_screenshot(
+        self, region: Optional[Region]
+    ) -> Tuple[ChannelSet, PIL.Image.Image]:
+        # See VideoChip._take_screenshot.
+        request = _screenshot_request(self.features, region)
+        channels, image = await self._query(
+            request.opcode, request.payload, request.parse
+        )
+        if request.crop is not None:
+            image = image.crop(request.crop)
+        return channels, image
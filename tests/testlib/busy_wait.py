@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import json
+import time
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+# Weight of each new observation in the learned duration of a command.
+_LEARNING_RATE = 0.25
+
+# Longest time that the server can be asked to poll the BUSY flag for.
+_MAX_SERVER_TIMEOUT_MS = 0xFFFF
+
+
+def busy_timeout_error(command: Optional[int], elapsed: float) -> TimeoutError:
+    """The error reported when a command keeps the chip busy for too long."""
+    return TimeoutError(
+        "The video chip was still busy after %.3f s (command %s)"
+        % (elapsed, "%02X" % command if command is not None else "?")
+    )
+
+
+class CommandDurations:
+    """
+    How long each command (keyed by the value of R0) is expected to keep the
+    chip busy, as observed by the previous waits. The table can be seeded with
+    hints and saved, so that it carries over to the next runs.
+    """
+
+    def __init__(self):
+        self._durations: Dict[int, float] = {}
+
+    @staticmethod
+    def load(path: Path) -> CommandDurations:
+        """Load a table saved by a previous run, or start from scratch."""
+        durations = CommandDurations()
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return durations
+        for command, seconds in data.items():
+            durations.hint(int(command, 16), seconds)
+        return durations
+
+    def save(self, path: Path):
+        data = {"%02X" % c: s for c, s in sorted(self._durations.items())}
+        path.write_text(json.dumps(data, indent=1) + "\n")
+
+    def expected(self, command: Optional[int]) -> Optional[float]:
+        return self._durations.get(command)
+
+    def hint(self, command: int, seconds: float):
+        """Set the expected duration of a command."""
+        self._durations[command] = seconds
+
+    def record(self, command: int, seconds: float):
+        """Refine the expected duration of a command with an observation."""
+        previous = self._durations.get(command, seconds)
+        self._durations[command] = previous + _LEARNING_RATE * (
+            seconds - previous
+        )
+
+
+class BusyWaitPolicy:
+    """
+    How often the BUSY flag is polled while waiting for a command.
+
+    Polls are sent back-to-back until the command has been running for longer
+    than expected (or, if unknown, for the spin time). After that, the delay
+    between them doubles at each poll, up to max_backoff. Waiting fails with a
+    TimeoutError once the command has been running for the deadline.
+    """
+
+    def __init__(
+        self,
+        *,
+        spin: float = 0.002,
+        slack: float = 2.0,
+        initial_backoff: float = 0.0005,
+        max_backoff: float = 0.05,
+        deadline: float = 10.0,
+        durations: Optional[CommandDurations] = None,
+    ):
+        self.spin = spin
+        self.slack = slack  # multiplier applied to the expected durations
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.durations = durations or CommandDurations()
+
+    @property
+    def server_timeout_ms(self) -> int:
+        """How long the server should poll the BUSY flag before giving up."""
+        return min(round(self.deadline * 1000), _MAX_SERVER_TIMEOUT_MS)
+
+    def delays(self, command: Optional[int], started: float) -> Iterator[float]:
+        """
+        Yield how long to sleep before each poll of the given command (None if
+        unknown), which started at the given time.monotonic() value.
+        """
+        expected = self.durations.expected(command)
+        spin_time = max(self.spin, self.slack * expected if expected else 0)
+        backoff = self.initial_backoff
+        while True:
+            elapsed = time.monotonic() - started
+            if elapsed > self.deadline:
+                raise busy_timeout_error(command, elapsed)
+            if elapsed < spin_time:
+                yield 0
+            else:
+                yield min(backoff, self.deadline - elapsed)
+                backoff = min(backoff * 2, self.max_backoff)
@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import enum
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import numpy as np
+
+from .channels import ChannelSet
+from .page import PAGE_ROWS
+from .screenshot import _BORDER, _ROW_HEIGHT, Screenshot
+
+# Width in pixels of the cells in each mode, i.e. how many of the 8 pixels of
+# each slice of the font are shown.
+_CELL_WIDTHS = {40: 8, 80: 6}
+
+# Layout of the font as returned by VideoChip.dump_font_rom: each row of 32
+# pixels (4 bytes, the leftmost pixel in the least significant bit) contains a
+# slice of 4 consecutive characters, and each group of 4 characters is 16 slices
+# high. Only the first 10 slices are shown.
+_FONT_ROW_BYTES = 4
+_FONT_GROUP_SLICES = 16
+
+
+class CellFlags(enum.IntFlag):
+    NONE = 0
+    BLANK = enum.auto()  # a single color, reported as both fg and bg
+    UNDERLINED = enum.auto()  # by the U attribute or by the cursor
+
+
+class DecodedCell(NamedTuple):
+    char: Optional[int]  # the character code, or None if not recognized
+    fg: ChannelSet
+    bg: ChannelSet
+    flags: CellFlags
+
+
+class GlyphTable:
+    """
+    The shape of each character of a block of the font, as rendered in the
+    given number of columns, indexed by its pixels.
+
+    The table is built from the contents of the character generator ROM, as
+    returned by VideoChip.dump_font_rom. Characters with the same shape are
+    represented by the lowest code among them, preferring 0x20-0x7F.
+    """
+
+    def __init__(self, font_rom: bytes, columns: int = 40):
+        assert columns in _CELL_WIDTHS
+        self.columns = columns
+        self.cell_width = _CELL_WIDTHS[columns]
+
+        rows = np.unpackbits(
+            np.frombuffer(font_rom, np.uint8).reshape(-1, _FONT_ROW_BYTES),
+            axis=1,
+            bitorder="little",
+        ).astype(bool)
+        n_chars = len(rows) // _FONT_GROUP_SLICES * 4
+
+        self._codes: Dict[bytes, int] = {}
+        for code in sorted(range(n_chars), key=lambda c: not 0x20 <= c < 0x80):
+            top = (code // 4) * _FONT_GROUP_SLICES
+            left = (code % 4) * 8
+            glyph = rows[top : top + _ROW_HEIGHT, left : left + self.cell_width]
+            self._codes.setdefault(self._key(glyph), code)
+
+        # The character shown by cells with a single color.
+        self.blank = self.lookup(np.zeros((_ROW_HEIGHT, self.cell_width), bool))
+
+    @staticmethod
+    def _key(pixels: np.ndarray) -> bytes:
+        return np.packbits(pixels).tobytes()
+
+    def lookup(self, pixels: np.ndarray) -> Optional[int]:
+        """
+        The code of the character whose foreground pixels are set in the given
+        (10, cell_width) array, if any.
+        """
+        return self._codes.get(self._key(pixels))
+
+
+class CellGrid:
+    """
+    The cells recognized in a frame, indexed by (row, column) with rows
+    numbered as in R6 (i.e. 0 for the service row and 8-31 for the others).
+    """
+
+    def __init__(self, columns: int, cells: Dict[Tuple[int, int], DecodedCell]):
+        self.columns = columns
+        self._cells = cells
+
+    def __getitem__(self, position: Tuple[int, int]) -> DecodedCell:
+        return self._cells[position]
+
+    def row(self, y: int) -> List[DecodedCell]:
+        return [self._cells[y, x] for x in range(self.columns)]
+
+    def text(self, y: int, unknown: str = "?") -> str:
+        """
+        The characters of a row, decoded as Latin-1 and with the unrecognized
+        ones replaced by the given placeholder.
+        """
+        return "".join(
+            unknown if cell.char is None else chr(cell.char)
+            for cell in self.row(y)
+        )
+
+
+def decode_cells(
+    screenshot: Screenshot, glyphs: GlyphTable, frame: int = 0
+) -> CellGrid:
+    """
+    Split a frame of the given screenshot into cells and recognize each of
+    them in the glyph table, assuming that the first displayed row is the
+    service row and that ROR does not scroll the others.
+    """
+    width = glyphs.cell_width
+    assert screenshot.width == 2 * _BORDER + glyphs.columns * width
+    n_rows = len(PAGE_ROWS)
+
+    # Reshape the frame into a (rows, columns, pixels) array.
+    indices = screenshot.arrays[frame][
+        _BORDER : _BORDER + n_rows * _ROW_HEIGHT, _BORDER:-_BORDER
+    ]
+    cells = indices.reshape(n_rows, _ROW_HEIGHT, glyphs.columns, width)
+    cells = cells.transpose(0, 2, 1, 3).reshape(n_rows, glyphs.columns, -1)
+    lows = cells.min(axis=2)
+    highs = cells.max(axis=2)
+    two_colors = (
+        (cells == lows[:, :, np.newaxis]) | (cells == highs[:, :, np.newaxis])
+    ).all(axis=2)
+
+    result = {}
+    for row, y in enumerate(PAGE_ROWS):
+        for x in range(glyphs.columns):
+            low, high = int(lows[row, x]), int(highs[row, x])
+            if low == high:
+                cell = DecodedCell(
+                    glyphs.blank,
+                    ChannelSet(low),
+                    ChannelSet(low),
+                    CellFlags.BLANK,
+                )
+            elif two_colors[row, x]:
+                pixels = cells[row, x].reshape(_ROW_HEIGHT, width)
+                cell = _decode_two_colors(pixels, low, high, glyphs)
+            else:
+                cell = DecodedCell(
+                    None, ChannelSet(high), ChannelSet(low), CellFlags.NONE
+                )
+            result[y, x] = cell
+    return CellGrid(glyphs.columns, result)
+
+
+def _decode_two_colors(
+    pixels: np.ndarray, low: int, high: int, glyphs: GlyphTable
+) -> DecodedCell:
+    # Try both colors as the foreground, with and without the bottom slice (in
+    # case it is only lit by the underline).
+    for fg, bg in ((high, low), (low, high)):
+        foreground = pixels == fg
+        code = glyphs.lookup(foreground)
+        flags = CellFlags.NONE
+        if code is None and foreground[-1].all():
+            foreground[-1] = False
+            code = glyphs.lookup(foreground)
+            flags = CellFlags.UNDERLINED
+        if code is not None:
+            return DecodedCell(code, ChannelSet(fg), ChannelSet(bg), flags)
+    return DecodedCell(None, ChannelSet(high), ChannelSet(low), CellFlags.NONE)
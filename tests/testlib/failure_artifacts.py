@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import concurrent.futures
+import html
+import os
+import re
+import sys
+import traceback
+from pathlib import Path
+from typing import List, Optional, Tuple
+import numpy as np
+import PIL.Image
+
+from .channels import PALETTE_IMAGE, ChannelSet
+from .screenshot import Screenshot
+
+INDEX_NAME = "index.html"
+
+# Colors of the pixels of the heatmap in which only the I channel differs, and
+# of the pixels that match (scaled by their brightness in the reference).
+_INSERT_ONLY_COLOR = (255, 0, 255)
+_MATCHING_SCALE = 0.25
+
+# The RGB color of each palette index.
+_PALETTE_RGB = np.reshape(PALETTE_IMAGE.getpalette()[: 16 * 3], (16, 3))
+
+# The channels that are counted separately in the index, in order.
+_COUNTED_CHANNELS = (ChannelSet.R, ChannelSet.G, ChannelSet.B, ChannelSet.I)
+
+
+def diff_heatmap(
+    actual: np.ndarray, reference: np.ndarray, selector: np.ndarray
+) -> Tuple[PIL.Image.Image, List[int]]:
+    """
+    Compare two arrays of palette indices in the bits that are set in the
+    selector (see ScreenshotMatcher.selector) and return an RGB image in which
+    each differing pixel is lit in the R, G and B channels that differ (or in
+    _INSERT_ONLY_COLOR if only I differs), and the number of differing pixels
+    in each of _COUNTED_CHANNELS.
+    """
+    differences = (actual ^ reference) & selector
+    rgb = np.stack(
+        [(differences & c.value) != 0 for c in _COUNTED_CHANNELS[:3]], axis=-1
+    ).astype(np.uint8) * np.uint8(255)
+    insert_only = differences == ChannelSet.I.value
+    rgb[insert_only] = _INSERT_ONLY_COLOR
+
+    # Show the matching pixels dimmed, to locate the differences.
+    matching = differences == 0
+    rgb[matching] = _PALETTE_RGB[reference[matching]] * _MATCHING_SCALE
+
+    counts = [
+        int(np.count_nonzero(differences & c.value)) for c in _COUNTED_CHANNELS
+    ]
+    return PIL.Image.fromarray(rgb, "RGB"), counts
+
+
+class FailureArtifacts:
+    """
+    Saves the frames involved in each failed expect_screenshot into a
+    directory, instead of showing them, so that unattended runs do not stop.
+
+    For each failure, the unique frames that were received, the reference and
+    a heatmap of the differences between the last received frame and the
+    closest frame of the reference are encoded by a background thread, which
+    then rewrites an index of all the failures recorded so far. Errors while
+    saving are printed and do not affect the other failures nor the tests.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix="artifacts"
+        )
+        self._current_test: Optional[str] = None
+        self._n_failures = 0
+        self._index_rows: List[str] = []  # only used by the worker
+
+    @property
+    def n_failures(self) -> int:
+        return self._n_failures
+
+    def start_test(self, name: str):
+        """Set the test that the next failures belong to."""
+        self._current_test = name
+
+    def record(
+        self,
+        actual: Screenshot,
+        reference: Screenshot,
+        channels: ChannelSet,
+        selector: np.ndarray,
+    ):
+        """Save the given screenshots in the background."""
+        self._n_failures += 1
+        slug = re.sub(r"[^\w.-]+", "_", self._current_test or "unknown")
+        prefix = "%03d_%s" % (self._n_failures, slug)
+        self._executor.submit(
+            self._write,
+            self._current_test,
+            prefix,
+            actual,
+            reference,
+            channels,
+            selector,
+        )
+
+    def close(self):
+        """Wait until all the artifacts have been written."""
+        self._executor.shutdown()
+
+    def _write(
+        self,
+        test_name: Optional[str],
+        prefix: str,
+        actual: Screenshot,
+        reference: Screenshot,
+        channels: ChannelSet,
+        selector: np.ndarray,
+    ):
+        try:
+            self._write_failure(
+                test_name, prefix, actual, reference, channels, selector
+            )
+        except Exception:
+            print(
+                "Failed to save the screenshots of %s:" % prefix,
+                file=sys.stderr,
+            )
+            traceback.print_exc(file=sys.stderr)
+
+    def _write_failure(
+        self,
+        test_name: Optional[str],
+        prefix: str,
+        actual: Screenshot,
+        reference: Screenshot,
+        channels: ChannelSet,
+        selector: np.ndarray,
+    ):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        actual.save(str(self.directory / f"{prefix}_actual.png"))
+        reference.save(str(self.directory / f"{prefix}_reference.png"))
+
+        # Diff the last received frame against the closest reference frame.
+        last = actual.arrays[-1]
+        heatmaps = [
+            diff_heatmap(last, indices, selector)
+            for indices in reference.arrays
+        ]
+        closest = min(range(len(heatmaps)), key=lambda i: sum(heatmaps[i][1]))
+        heatmap, counts = heatmaps[closest]
+        heatmap.save(self.directory / f"{prefix}_diff.png")
+
+        summary = ", ".join(
+            f"{c.name}: {n}" for c, n in zip(_COUNTED_CHANNELS, counts)
+        )
+        self._index_rows.append(
+            "<tr><td>%s<br>channels: %s<br>%d received frames, closest "
+            "reference frame: %d/%d<br>differing pixels: %s</td>%s</tr>"
+            % (
+                html.escape(test_name or "unknown"),
+                channels.name,
+                actual.n_frames,
+                closest + 1,
+                reference.n_frames,
+                summary,
+                "".join(
+                    f'<td><img src="{prefix}_{kind}.png" '
+                    f'width="{2 * actual.width}"></td>'
+                    for kind in ("actual", "reference", "diff")
+                ),
+            )
+        )
+        self._write_index()
+
+    def _write_index(self):
+        lines = [
+            "<!DOCTYPE html>",
+            "<title>Failed screenshots</title>",
+            "<style>img { image-rendering: pixelated; }</style>",
+            "<table>",
+            "<tr><th>Test</th><th>Received</th><th>Reference</th>"
+            "<th>Differences</th></tr>",
+            *self._index_rows,
+            "</table>",
+        ]
+        path = self.directory / INDEX_NAME
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import functools
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import PIL.Image
+
+from .image_utils import (
+    from_palette_indices,
+    pack_indices,
+    to_palette_indices,
+    unpack_indices,
+)
+
+# A directory of references can be converted into a store (see
+# scripts/reference-store.py), made of an index and of the strips of pixels
+# that its frames are cut into, each saved once as a PNG file named after the
+# digest of its contents.
+INDEX_NAME = "references.json"
+STRIPS_DIRNAME = "strips"
+
+# Frames are cut into strips of this height (the last one may be shorter), so
+# that the character rows that are shared by many references are stored once.
+STRIP_HEIGHT = 10
+
+_INDEX_VERSION = 1
+
+
+def _digest(strip: np.ndarray) -> str:
+    height, width = strip.shape
+    data = (
+        b"%dx%d:" % (width, height) + pack_indices(strip[np.newaxis]).tobytes()
+    )
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+class FrameStore:
+    """
+    A content-addressed store of reference screenshots, in which each reference
+    is a list of frames and each frame a list of strips. The index lists the
+    digests of the strips once, and frames refer to them by position.
+
+    Each strip is decoded at most once and then shared by all the frames that
+    contain it.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._references: Dict[str, dict] = {}
+        self._digests: List[str] = []
+        self._numbers: Dict[str, int] = {}  # the inverse of _digests
+        self._strips: Dict[str, np.ndarray] = {}
+        try:
+            index = json.loads((directory / INDEX_NAME).read_text())
+        except FileNotFoundError:
+            return
+        if index.get("version") != _INDEX_VERSION:
+            raise ValueError("Unsupported reference store version")
+        self._references = index["references"]
+        self._digests = index["strips"]
+        self._numbers = {d: i for i, d in enumerate(self._digests)}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._references
+
+    def names(self) -> List[str]:
+        return sorted(self._references)
+
+    def strip_digests(self) -> List[str]:
+        return list(self._digests)
+
+    def load(self, name: str) -> Tuple[np.ndarray, int]:
+        """Return the frames of a reference, packed, and their width."""
+        reference = self._references[name]
+        frames = [
+            np.concatenate([self._strip(self._digests[n]) for n in frame])
+            for frame in reference["frames"]
+        ]
+        return pack_indices(np.stack(frames)), reference["width"]
+
+    def add(self, name: str, packed: np.ndarray, width: int):
+        """
+        Add a reference, given its packed frames, writing the strips that are
+        not stored yet. The index is only written by save.
+        """
+        frames = []
+        for indices in unpack_indices(packed, width):
+            numbers = []
+            for top in range(0, indices.shape[0], STRIP_HEIGHT):
+                strip = indices[top : top + STRIP_HEIGHT]
+                digest = _digest(strip)
+                path = self._strip_path(digest)
+                if digest not in self._strips and not path.exists():
+                    path.parent.mkdir(exist_ok=True)
+                    from_palette_indices(strip).save(path, "png", bits=4)
+                self._strips[digest] = np.ascontiguousarray(strip)
+                if digest not in self._numbers:
+                    self._numbers[digest] = len(self._digests)
+                    self._digests.append(digest)
+                numbers.append(self._numbers[digest])
+            frames.append(numbers)
+        self._references[name] = {"width": width, "frames": frames}
+
+    def remove(self, name: str):
+        """Remove a reference from the index (see prune)."""
+        del self._references[name]
+
+    def prune(self) -> int:
+        """Delete the strips that are no longer used and return how many."""
+        used = sorted(
+            {
+                n
+                for reference in self._references.values()
+                for frame in reference["frames"]
+                for n in frame
+            }
+        )
+        renumbering = {n: i for i, n in enumerate(used)}
+        for reference in self._references.values():
+            reference["frames"] = [
+                [renumbering[n] for n in frame] for frame in reference["frames"]
+            ]
+        self._digests = [self._digests[n] for n in used]
+        self._numbers = {d: i for i, d in enumerate(self._digests)}
+
+        removed = 0
+        strips_dir = self.directory / STRIPS_DIRNAME
+        if strips_dir.exists():
+            for path in strips_dir.glob("*.png"):
+                if path.stem not in self._numbers:
+                    path.unlink()
+                    self._strips.pop(path.stem, None)
+                    removed += 1
+            if not any(strips_dir.iterdir()):
+                strips_dir.rmdir()
+        return removed
+
+    def save(self):
+        path = self.directory / INDEX_NAME
+        if not self._references:
+            path.unlink(missing_ok=True)
+            return
+        # One strip and one reference per line, to keep diffs readable.
+        lines = ["{", f'"version": {_INDEX_VERSION},', '"strips": [']
+        lines += [f'"{digest}",' for digest in self._digests]
+        lines[-1] = lines[-1].rstrip(",")
+        lines += ["],", '"references": {']
+        lines += [
+            "%s: %s," % (json.dumps(name), json.dumps(reference))
+            for name, reference in sorted(self._references.items())
+        ]
+        lines[-1] = lines[-1].rstrip(",")
+        lines += ["}", "}"]
+
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+    def _strip_path(self, digest: str) -> Path:
+        return self.directory / STRIPS_DIRNAME / (digest + ".png")
+
+    def _strip(self, digest: str) -> np.ndarray:
+        strip = self._strips.get(digest)
+        if strip is None:
+            strip = to_palette_indices(PIL.Image.open(self._strip_path(digest)))
+            self._strips[digest] = strip
+        return strip
+
+
+@functools.lru_cache(maxsize=None)
+def open_store(directory: Path) -> Optional[FrameStore]:
+    """The store in the given directory, if any, opened once per session."""
+    if not (directory / INDEX_NAME).exists():
+        return None
+    return FrameStore(directory)
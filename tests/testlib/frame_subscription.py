@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import collections
+import socket
+import threading
+import time
+from typing import Deque, Iterator, Optional
+import PIL.Image
+
+from .channels import ChannelSet
+from .protocol import (
+    FRAME_PUSH_HEADER,
+    Address,
+    BinaryTransport,
+    Opcode,
+    TextTransport,
+    connect,
+    parse_packed_screenshot,
+)
+
+# How many frames are retained for consumers that fall behind (about 5 seconds
+# worth of frames at 50 Hz).
+_MAX_RETAINED_FRAMES = 256
+
+
+class Frame:
+    """A frame pushed by the server."""
+
+    def __init__(
+        self,
+        number: int,
+        timestamp: float,
+        channels: ChannelSet,
+        image: PIL.Image.Image,
+    ):
+        self.number = number
+        self.timestamp = timestamp  # seconds since the epoch, server's clock
+        self.channels = channels
+        self.image = image  # shared with the previous frame if unchanged
+
+    def __repr__(self) -> str:
+        return f"Frame(#{self.number} {self.channels.name})"
+
+
+def parse_frame_push(payload: bytes, last_frame: Optional[Frame]) -> Frame:
+    """Decode a frame pushed by the server, given the previous one."""
+    number, timestamp_us = FRAME_PUSH_HEADER.unpack_from(payload)
+    if len(payload) > FRAME_PUSH_HEADER.size:
+        channels, image = parse_packed_screenshot(
+            payload[FRAME_PUSH_HEADER.size :]
+        )
+    else:  # unchanged since the previous frame
+        channels, image = last_frame.channels, last_frame.image
+    return Frame(number, timestamp_us / 1e6, channels, image)
+
+
+class FrameSubscription:
+    """
+    Receives every frame captured by the server, on a dedicated connection.
+
+    Frames are received by a background thread and retained until they are
+    consumed (or until they become too old). Frames whose contents did not
+    change share the same image object as the previous one.
+    """
+
+    def __init__(self, address: Address):
+        self._sk = connect(address)
+        if not TextTransport(self._sk).start_binary():
+            raise ConnectionError("The server refused the binary protocol")
+        self._transport = BinaryTransport(self._sk)
+        self._transport.send(Opcode.SUBSCRIBE)
+        self._transport.flush()
+
+        self._condition = threading.Condition()
+        self._frames: Deque[Frame] = collections.deque(
+            maxlen=_MAX_RETAINED_FRAMES
+        )
+        self._error: Optional[Exception] = None
+
+        self._thread = threading.Thread(target=self._receive_loop, daemon=True)
+        self._thread.start()
+
+    def _receive_loop(self):
+        last_frame = None
+        try:
+            while True:
+                payload = self._transport.receive_push(Opcode.SUBSCRIBE)
+                last_frame = parse_frame_push(payload, last_frame)
+                with self._condition:
+                    self._frames.append(last_frame)
+                    self._condition.notify_all()
+        except Exception as e:
+            with self._condition:
+                self._error = e
+                self._condition.notify_all()
+
+    def frames(self, after: int, timeout: float) -> Iterator[Frame]:
+        """
+        Yield all the frames whose number is greater than the given one, in
+        order, as they are received.
+
+        Raises TimeoutError if no new frame is received for the given number
+        of seconds.
+        """
+        while True:
+            deadline = time.monotonic() + timeout
+            with self._condition:
+                while True:
+                    frame = next(
+                        (f for f in self._frames if f.number > after), None
+                    )
+                    if frame is not None:
+                        break
+                    if self._error is not None:
+                        raise ConnectionError("Subscription lost") from (
+                            self._error
+                        )
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError("No frame received")
+                    self._condition.wait(remaining)
+            after = frame.number
+            yield frame
+
+    def close(self):
+        self._sk.shutdown(socket.SHUT_RDWR)
+        self._sk.close()
@@ -1,10 +1,84 @@
+import numpy as np
 import PIL.Image
 
+from .channels import PALETTE_IMAGE
+
+_PALETTE = PALETTE_IMAGE.getpalette()
+
+
+def _rgb_keys(rgb: np.ndarray) -> np.ndarray:
+    # Pack the last axis of an array of RGB triplets into 0xRRGGBB integers.
+    rgb = rgb.astype(np.uint32)
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+
+# The 16 colors of PALETTE_IMAGE as 0xRRGGBB integers, sorted, and the palette
+# index of each one.
+_COLOR_KEYS = _rgb_keys(np.array(_PALETTE[: 16 * 3]).reshape(16, 3))
+_SORTED_ORDER = np.argsort(_COLOR_KEYS)
+_SORTED_KEYS = _COLOR_KEYS[_SORTED_ORDER]
+_SORTED_INDICES = _SORTED_ORDER.astype(np.uint8)
+
+
+def to_palette_indices(image: PIL.Image.Image) -> np.ndarray:
+    """
+    The palette index (i.e. the ChannelSet value) of each pixel of the given
+    image, as a (height, width) array.
+
+    Unlike PIL's quantizer, colors are mapped exactly: ValueError is raised if
+    the image contains colors that are not in PALETTE_IMAGE.
+    """
+    # Images that already use PALETTE_IMAGE's palette (e.g. packed screenshots
+    # received from the server) do not need to be converted.
+    if image.mode == "P" and image.getpalette() == _PALETTE:
+        indices = np.asarray(image)
+        if indices.size and indices.max() >= 16:
+            raise ValueError("The image contains unknown colors")
+        return indices
+
+    keys = _rgb_keys(np.asarray(image.convert("RGB")))
+    positions = np.searchsorted(_SORTED_KEYS, keys).clip(max=15)
+    if not np.array_equal(_SORTED_KEYS[positions], keys):
+        unknown = keys[_SORTED_KEYS[positions] != keys][0]
+        raise ValueError("The image contains unknown colors: #%06X" % unknown)
+    return _SORTED_INDICES[positions]
+
+
+def from_palette_indices(indices: np.ndarray) -> PIL.Image.Image:
+    """The inverse of to_palette_indices."""
+    height, width = indices.shape
+    image = PIL.Image.frombytes(
+        "P", (width, height), np.ascontiguousarray(indices, np.uint8)
+    )
+    image.putpalette(_PALETTE)
+    return image
+
+
+def pack_indices(frames: np.ndarray) -> np.ndarray:
+    """
+    Pack a (n_frames, height, width) array of palette indices at two pixels per
+    byte, the first one in the high nibble, with each row padded to a whole
+    byte (like PIL's "P;4" raw mode).
+    """
+    n_frames, height, width = frames.shape
+    padded = np.zeros((n_frames, height, width + (width & 1)), np.uint8)
+    padded[:, :, :width] = frames
+    return (padded[:, :, 0::2] << 4) | padded[:, :, 1::2]
+
+
+def unpack_indices(packed: np.ndarray, width: int) -> np.ndarray:
+    """The inverse of pack_indices."""
+    n_frames, height, packed_width = packed.shape
+    unpacked = np.empty((n_frames, height, packed_width * 2), np.uint8)
+    unpacked[:, :, 0::2] = packed >> 4
+    unpacked[:, :, 1::2] = packed & 0x0F
+    return unpacked[:, :, :width]
+
 
 def test_images_equal(a: PIL.Image.Image, b: PIL.Image.Image) -> bool:
     assert a.format == b.format
     assert a.size == b.size
-    return list(a.getdata()) == list(b.getdata())
+    return np.array_equal(np.asarray(a), np.asarray(b))
 
 
 def vertical_concat(*images: PIL.Image.Image) -> PIL.Image.Image:
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+from typing import List, Optional, Sequence, Tuple
+
+from .program import Program
+from .protocol import ProgramOp
+
+# A recorded register access: (ProgramOp.WRITE, register, value) or
+# (ProgramOp.READ, register), where the register number is ORed with 8 if it
+# executes the command in R0, or (ProgramOp.WAIT,).
+Operation = Tuple
+
+# The last column that auto-increment commands move R7 to without wrapping.
+_LAST_COLUMN = 39
+
+
+def optimize(operations: Sequence[Operation]) -> List[Operation]:
+    """
+    Rewrite a stream of register accesses into a shorter one that reads the
+    same values and executes the same commands with the same register values.
+    """
+    operations = _drop_redundant_writes(operations)
+    operations = _drop_dead_writes(operations)
+    return _coalesce_waits(operations)
+
+
+def compile_program(operations: Sequence[Operation]) -> Program:
+    program = Program()
+    for opcode, *operands in operations:
+        match opcode:
+            case ProgramOp.WRITE:
+                regnum, value = operands
+                program.write(regnum & 7, value, bool(regnum & 8))
+            case ProgramOp.READ:
+                program.read(operands[0] & 7, bool(operands[0] & 8))
+            case ProgramOp.WAIT:
+                program.wait_not_busy()
+    return program
+
+
+def _executes(operation: Operation) -> bool:
+    return operation[0] != ProgramOp.WAIT and bool(operation[1] & 8)
+
+
+def _drop_redundant_writes(
+    operations: Sequence[Operation],
+) -> List[Operation]:
+    # Drop the plain writes of the value that a register is already known to
+    # hold. This includes repositioning R6 and R7 to where an auto-increment
+    # command has already moved them.
+    known: List[Optional[int]] = [None] * 8
+    result = []
+    for operation in operations:
+        opcode, *operands = operation
+        if opcode == ProgramOp.WRITE:
+            regnum, value = operands
+            if not regnum & 8 and known[regnum] == value:
+                continue
+            known[regnum & 7] = value
+        if _executes(operation):
+            _apply_command(known)
+        result.append(operation)
+    return result
+
+
+def _apply_command(known: List[Optional[int]]):
+    # Update the known register values with the effects of the command in R0.
+    command = known[0]
+    if command == 0x91 or (command is not None and command & 0xF8 == 0x80):
+        pass  # NOP or IND, write: no effect on the registers
+    elif command == 0x01:  # KRF/TLM with auto-increment: move to next column
+        x = known[7]
+        if x is not None and (x & 0x3F) < _LAST_COLUMN:
+            known[7] = x + 1
+        else:
+            known[7] = None  # wraps around
+    elif command is not None and command < 0x80 and not command & 0x09:
+        pass  # memory write without auto-increment
+    else:
+        known[1:] = [None] * 7
+
+
+def _drop_dead_writes(operations: Sequence[Operation]) -> List[Operation]:
+    # Drop the plain writes that are overwritten before the register is used,
+    # i.e. read or, like all the others, seen by an executed command.
+    result = []
+    overwritten = set()  # registers written again before being used
+    for operation in reversed(operations):
+        opcode, *operands = operation
+        if _executes(operation):
+            overwritten.clear()
+            if opcode == ProgramOp.WRITE:
+                overwritten.add(operands[0] & 7)  # written before executing
+        elif opcode == ProgramOp.READ:
+            overwritten.discard(operands[0])
+        elif opcode == ProgramOp.WRITE:
+            if operands[0] in overwritten:
+                continue
+            overwritten.add(operands[0])
+        result.append(operation)
+    result.reverse()
+    return result
+
+
+def _coalesce_waits(operations: Sequence[Operation]) -> List[Operation]:
+    # Drop the waits that follow another wait with no command executed since.
+    result = []
+    idle = False  # whether the chip is known not to be busy
+    for operation in operations:
+        if operation[0] == ProgramOp.WAIT:
+            if idle:
+                continue
+            idle = True
+        elif _executes(operation):
+            idle = False
+        result.append(operation)
+    return result
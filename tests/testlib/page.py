@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+# Rows of a page, as written to R6: the service row and the 24 other ones.
+PAGE_ROWS = [0, *range(8, 32)]
+
+# The data registers that make up each cell, as in read_vram: (C, B, A) in 40
+# columns (KRF/TLM) and (C, A) in 80 columns (KRL).
+_CELL_REGISTERS = {40: (1, 2, 3), 80: (1, 3)}
+_COMMANDS = {40: 0x00, 80: 0x50}
+
+Cell = Tuple[int, ...]
+
+
+class Page:
+    """
+    The contents of a page of text: for each row (numbered as in R6) and column
+    the values of the data registers that describe the cell, i.e. (C, B, A) in
+    40 columns and (C, A) in 80 columns.
+    """
+
+    def __init__(
+        self, columns: int = 40, block: int = 0, fill: Optional[Cell] = None
+    ):
+        assert columns in _CELL_REGISTERS
+        assert columns == 40 or block == 0  # R7 has no room for block bits
+        self.columns = columns
+        self.block = block
+        if fill is None:
+            fill = (ord(" "),) + (0,) * (len(self.registers) - 1)
+        assert len(fill) == len(self.registers)
+        self.fill = fill
+        self._cells: Dict[Tuple[int, int], Cell] = {
+            (y, x): fill for y in PAGE_ROWS for x in range(columns)
+        }
+
+    @property
+    def command(self) -> int:
+        """The memory access command that transfers a cell."""
+        return _COMMANDS[self.columns]
+
+    @property
+    def registers(self) -> Tuple[int, ...]:
+        return _CELL_REGISTERS[self.columns]
+
+    def __getitem__(self, position: Tuple[int, int]) -> Cell:
+        return self._cells[position]
+
+    def __setitem__(self, position: Tuple[int, int], cell: Cell):
+        if position not in self._cells:
+            raise IndexError("Invalid position: %r" % (position,))
+        assert len(cell) == len(self.registers)
+        self._cells[position] = tuple(cell)
+
+    def copy(self) -> Page:
+        page = Page(self.columns, self.block, self.fill)
+        page._cells = dict(self._cells)
+        return page
+
+    def write_text(
+        self,
+        y: int,
+        x: int,
+        text: Union[str, bytes],
+        *,
+        a: int,
+        b: Optional[int] = None,
+    ):
+        """
+        Store the given text starting at the given position, with the given
+        attributes (b is only meaningful in 40 columns), like
+        VideoChip.write_text would draw it with an auto-increment command.
+        """
+        if isinstance(text, str):
+            text = text.encode("latin-1")
+        assert (b is not None) == (self.columns == 40)
+        attributes = (b, a) if self.columns == 40 else (a,)
+        for i, c in enumerate(text):
+            self[y, x + i] = (c, *attributes)
+
+    def encode_column(self, x: int) -> int:
+        """
+        The value of R7 that addresses the given column, without the block
+        number.
+        """
+        if self.columns == 80:
+            return (0x80 if (x & 1) else 0) | (x >> 1)
+        return x
+
+    def runs(
+        self, other: Optional[Page]
+    ) -> Iterator[Tuple[int, int, List[Cell]]]:
+        """
+        Yield the (y, x, cells) runs of consecutive cells in the same row that
+        differ from the given page (all of them, if None).
+        """
+        for y in PAGE_ROWS:
+            run: List[Cell] = []
+            for x in range(self.columns + 1):
+                cell = self._cells.get((y, x))
+                if cell is not None and (
+                    other is None or other._cells[y, x] != cell
+                ):
+                    run.append(cell)
+                elif run:
+                    yield y, x - len(run), run
+                    run = []
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import json
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from .screenshot import Screenshot
+
+# The references used by each test are learned by the runs of each test script
+# into a gitignored manifest, named after the script and the chip type. The seed
+# manifest of each chip type, kept in the repository and only read by the tests,
+# contains the learned manifests of every script (see
+# scripts/reference-usage.py), so that a fresh checkout can prefetch too.
+LEARNED_MANIFEST_NAME = ".reference_usage_%s_%s.json"
+SEED_MANIFEST_NAME = "reference_usage_%s.json"
+
+
+class ReferencePrefetcher:
+    """
+    Loads the reference screenshots that the upcoming tests will need in
+    background threads, so that decoding them overlaps with the tests that are
+    running. Apart from the decoding, this class is only used by the main
+    thread.
+
+    Which references each test loads is learned while it runs (through
+    Screenshot.loader) and saved, so that the next runs can fetch them ahead.
+    Only the tests that succeed update the manifest.
+    At most "window" of the planned references are loaded in advance, and the
+    least recently used screenshots are evicted once twice as many are kept.
+    """
+
+    def __init__(self, window: int = 16, workers: int = 2):
+        self.window = window
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix="prefetch"
+        )
+        self._loaded: collections.OrderedDict[
+            str, concurrent.futures.Future[Screenshot]
+        ] = collections.OrderedDict()
+
+        # The references used by each test, as known from the previous runs
+        # and updated with the tests that run now.
+        self._manifest: Dict[str, List[str]] = {}
+        self._current_test: Optional[str] = None
+        self._previous_usage: Optional[List[str]] = None
+
+        # The references that the planned tests are expected to load, in order,
+        # the position of the next one and the next one to be prefetched.
+        self._planned: List[str] = []
+        self._test_offsets: Dict[str, int] = {}
+        self._position = 0
+        self._next = 0
+
+    def load_manifest(self, path: Path, section: Optional[str] = None):
+        """
+        Load the references used by each test in a previous run, if any,
+        replacing the ones already known for the same tests. If given, only
+        the manifest under the given key of the file is loaded.
+        """
+        try:
+            manifest = json.loads(path.read_text())
+            if section is not None:
+                manifest = manifest.get(section, {})
+        except (OSError, ValueError):
+            return
+        self._manifest.update(manifest)
+
+    def save_manifest(self, path: Path, test_names: Iterable[str]):
+        """Save the references used by the given tests, dropping the others."""
+        manifest = {
+            name: self._manifest[name]
+            for name in test_names
+            if name in self._manifest
+        }
+        path.write_text(json.dumps(manifest, indent=1, sort_keys=True) + "\n")
+
+    def plan(self, test_names: List[str]):
+        """Set the tests that are going to run, in order."""
+        self._planned = []
+        self._test_offsets = {}
+        for name in test_names:
+            self._test_offsets[name] = len(self._planned)
+            self._planned.extend(self._manifest.get(name, []))
+        self._position = self._next = 0
+
+    def start_test(self, name: str):
+        """Start recording the references used by the given test."""
+        self._current_test = name
+        self._previous_usage = self._manifest.get(name)
+        self._manifest[name] = []
+        self._position = self._test_offsets.get(name, self._position)
+        self._next = max(self._next, self._position)
+        self._top_up()
+
+    def finish_test(self, success: bool):
+        """
+        Stop recording. The references used by a failed test are discarded,
+        since it may have stopped before loading all of them.
+        """
+        if not success and self._current_test is not None:
+            if self._previous_usage is None:
+                del self._manifest[self._current_test]
+            else:
+                self._manifest[self._current_test] = self._previous_usage
+        self._current_test = None
+        self._previous_usage = None
+
+    def load(self, path: str) -> Screenshot:
+        """Return the given reference, loading it now if not prefetched."""
+        if self._current_test is not None:
+            self._manifest[self._current_test].append(path)
+        self._position += 1
+        self._top_up()
+
+        future = self._loaded.get(path)
+        if future is not None:
+            self._loaded.move_to_end(path)
+            return future.result()
+
+        screenshot = Screenshot.decode(path)
+        future = concurrent.futures.Future()
+        future.set_result(screenshot)
+        self._store(path, future)
+        return screenshot
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
+
+    def _top_up(self):
+        # Start loading the planned references within the window.
+        end = min(self._position + self.window, len(self._planned))
+        while self._next < end:
+            path = self._planned[self._next]
+            self._next += 1
+            if path in self._loaded:
+                self._loaded.move_to_end(path)
+                continue
+            self._store(path, self._executor.submit(Screenshot.decode, path))
+
+    def _store(self, path: str, future: concurrent.futures.Future[Screenshot]):
+        self._loaded[path] = future
+        self._loaded.move_to_end(path)
+        while len(self._loaded) > 2 * self.window:
+            _, evicted = self._loaded.popitem(last=False)
+            evicted.cancel()
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import contextlib
+import struct
+from typing import Iterator, List, Tuple
+
+from .protocol import (
+    PROGRAM_END,
+    PROGRAM_LOOP,
+    PROGRAM_READ,
+    PROGRAM_SLEEP,
+    PROGRAM_WAIT,
+    PROGRAM_WRITE,
+    PROGRAM_WRITE_COUNTER,
+    ProgramOp,
+)
+
+# Maximum nesting depth of loops.
+MAX_LOOP_DEPTH = 8
+
+# A decoded instruction: the opcode followed by its operands and, for loops, by
+# the list of instructions in the body.
+Instruction = Tuple
+
+
+class Program:
+    """
+    A sequence of register accesses that the server runs next to the chip, as a
+    single request (see VideoChip.run_program).
+
+    Instructions are appended by calling the methods of this class. Loops are
+    opened as context managers, e.g.:
+
+        program = Program()
+        program.write(0, 0x38)
+        with program.loop(32, start=8):
+            program.write_counter(6)
+            with program.loop(40):
+                program.write_counter(7, execute=True)
+                program.wait_not_busy()
+                program.read(1)
+    """
+
+    def __init__(self):
+        self._code = bytearray()
+        self.instructions: List[Instruction] = []
+        self._open_loops: List[List[Instruction]] = [self.instructions]
+        self._repeat = [1]  # how many times each open loop's body runs
+        self.n_reads = 0  # total number of values read when run
+
+    def write(self, regnum: int, value: int, execute: bool = False):
+        assert regnum < 8
+        assert 0 <= value < 256
+        self._append(
+            PROGRAM_WRITE,
+            ProgramOp.WRITE,
+            regnum | (8 if execute else 0),
+            value,
+        )
+
+    def write_counter(self, regnum: int, execute: bool = False, level: int = 0):
+        """
+        Write the current value of the counter of an enclosing loop (0 for the
+        innermost one, 1 for the one containing it and so on).
+        """
+        assert regnum < 8
+        assert 0 <= level < len(self._open_loops) - 1
+        self._append(
+            PROGRAM_WRITE_COUNTER,
+            ProgramOp.WRITE_COUNTER,
+            regnum | (8 if execute else 0),
+            level,
+        )
+
+    def read(self, regnum: int, execute: bool = False):
+        assert regnum < 8
+        self._append(
+            PROGRAM_READ, ProgramOp.READ, regnum | (8 if execute else 0)
+        )
+        self.n_reads += self._repeat[-1]
+
+    def wait_not_busy(self, timeout_ms: int = 1000):
+        """
+        Wait until the chip is not busy. If it still is after the given time,
+        the rest of the program is not run and run_program fails.
+        """
+        assert 0 <= timeout_ms < 65536
+        self._append(PROGRAM_WAIT, ProgramOp.WAIT, timeout_ms)
+
+    def sleep(self, duration_ms: int):
+        assert 0 <= duration_ms < 65536
+        self._append(PROGRAM_SLEEP, ProgramOp.SLEEP, duration_ms)
+
+    @contextlib.contextmanager
+    def loop(self, count: int, start: int = 0, step: int = 1) -> Iterator[None]:
+        """
+        Repeat the instructions appended within this context the given number
+        of times. The loop's counter starts from the given value and it is
+        incremented by step (modulo 256) at each iteration.
+        """
+        assert 0 <= count < 65536
+        assert 0 <= start < 256 and 0 <= step < 256
+        assert len(self._open_loops) <= MAX_LOOP_DEPTH
+
+        body: List[Instruction] = []
+        self._code += PROGRAM_LOOP.pack(ProgramOp.LOOP, count, start, step)
+        self._open_loops[-1].append((ProgramOp.LOOP, count, start, step, body))
+        self._open_loops.append(body)
+        self._repeat.append(self._repeat[-1] * count)
+        try:
+            yield
+        finally:
+            self._open_loops.pop()
+            self._repeat.pop()
+            self._code += PROGRAM_END.pack(ProgramOp.END)
+
+    def encode(self) -> bytes:
+        assert len(self._open_loops) == 1, "Unterminated loop"
+        return bytes(self._code)
+
+    def _append(self, encoding: struct.Struct, *fields):
+        self._code += encoding.pack(*fields)
+        self._open_loops[-1].append(fields)
@@ -0,0 +1,318 @@
+from __future__ import annotations
+
+import base64
+import collections
+import enum
+import socket
+import struct
+from typing import Deque, Tuple, Union
+import PIL.Image
+
+from .channels import PALETTE_IMAGE, ChannelSet
+
+# Version of the binary protocol requested by the client. The server advertises
+# support for it through the "BINARY" feature.
+BINARY_PROTOCOL_VERSION = 1
+
+# Each binary frame starts with the opcode, a tag (which the server copies into
+# the reply, so that replies can be matched to requests) and the payload size.
+FRAME_HEADER = struct.Struct("<BHI")
+
+# Payload header of VRAM requests: command, R7 base and the number of rows,
+# columns and data registers, followed by the list of rows, columns and data
+# registers themselves and, for writes, the data.
+VRAM_HEADER = struct.Struct("<BBBBB")
+
+# Packed screenshots start with the mask of the available channels (0bRGBI) and
+# the image size, followed by 4-bit color indices.
+PACKED_SCREENSHOT_HEADER = struct.Struct("<BHH")
+
+# Optional payload of packed screenshot requests, asking the server to only send
+# the given region (left, top, right, bottom) of the image. Supported by servers
+# that advertise the "CROP" feature.
+REGION = struct.Struct("<HHHH")
+
+# Frames pushed to subscribers start with the frame number and the capture
+# timestamp (in microseconds since the epoch), followed by the packed
+# screenshot, which is omitted if unchanged since the previous frame.
+FRAME_PUSH_HEADER = struct.Struct("<IQ")
+
+# Shared-memory ring of the latest frames, offered by servers that advertise the
+# "SHARED_FRAMES" feature to clients on the same host: a header (magic, number
+# of slots, size of each slot, number of the latest frame) followed by the
+# slots. Each slot starts with a sequence counter (odd while the slot is being
+# written), the frame number, an identifier that changes whenever the image
+# does, the capture timestamp (in microseconds since the epoch) and the size of
+# the packed screenshot that follows.
+SHARED_FRAMES_MAGIC = b"EFFR"
+SHARED_FRAMES_HEADER = struct.Struct("<4sIII")
+SHARED_FRAMES_SLOT_HEADER = struct.Struct("<IIIQI")
+
+# Register programs, run by servers that advertise the "PROGRAM" feature, are
+# sequences of instructions, each made of a ProgramOp byte and its operands.
+# The reply contains the BUSY status read by the last wait (or 0) followed by
+# all the values read by the program, in order.
+PROGRAM_WRITE = struct.Struct("<BBB")  # register (| 8 to execute), value
+PROGRAM_WRITE_COUNTER = struct.Struct("<BBB")  # register, loop level
+PROGRAM_READ = struct.Struct("<BB")  # register (| 8 to execute)
+PROGRAM_WAIT = struct.Struct("<BH")  # timeout in milliseconds
+PROGRAM_SLEEP = struct.Struct("<BH")  # duration in milliseconds
+PROGRAM_LOOP = struct.Struct("<BHBB")  # count, counter's start and step
+PROGRAM_END = struct.Struct("<B")
+
+# The address of a server: either a (host, port) tuple or a Unix socket path.
+Address = Union[Tuple[str, int], str]
+
+
+class Opcode(enum.IntEnum):
+    TYPE = 0x01
+    FEATURES = 0x02
+    SCREENSHOT = 0x03
+    SCREENSHOT_PACKED = 0x04
+    FRAME_NUMBER = 0x05
+    SUBSCRIBE = 0x06
+    SHARED_FRAMES = 0x07
+    READ_REGISTER = 0x10
+    WRITE_REGISTER = 0x11
+    WAIT = 0x12
+    TEXT = 0x13
+    VRAM_READ = 0x14
+    VRAM_WRITE = 0x15
+    PROGRAM = 0x16
+    ERROR = 0xFF  # reply only, carrying the error message
+
+
+class ProgramOp(enum.IntEnum):
+    WRITE = 0x01
+    WRITE_COUNTER = 0x02  # write the counter of an enclosing loop (0=innermost)
+    READ = 0x03
+    WAIT = 0x04  # wait until not busy, stopping the program if it times out
+    SLEEP = 0x05
+    LOOP = 0x06  # repeat the instructions up to the matching END
+    END = 0x07
+
+
+# Requests that do not get any reply.
+_NO_REPLY_OPCODES = frozenset([Opcode.WRITE_REGISTER])
+
+
+class RequestError(Exception):
+    """The server could not satisfy a request."""
+
+
+def connect(address: Address) -> socket.socket:
+    if isinstance(address, str):
+        sk = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sk.connect(address)
+    else:
+        sk = socket.socket(
+            socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP
+        )
+        sk.connect(address)
+        sk.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sk
+
+
+def parse_packed_screenshot(
+    payload: bytes,
+) -> Tuple[ChannelSet, PIL.Image.Image]:
+    mask, width, height = PACKED_SCREENSHOT_HEADER.unpack_from(payload)
+    image = PIL.Image.frombytes(
+        "P",
+        (width, height),
+        bytes(payload[PACKED_SCREENSHOT_HEADER.size :]),
+        "raw",
+        "P;4",
+    )
+    image.putpalette(PALETTE_IMAGE.getpalette())
+    return ChannelSet(mask), image
+
+
+class TextTransport:
+    """
+    The original newline-terminated ASCII protocol.
+
+    Requests and replies are translated from and to the same payloads as the
+    binary protocol, so that the two can be used interchangeably.
+    """
+
+    def __init__(self, sk: socket.socket):
+        self._reader = sk.makefile("r")
+        self._writer = sk.makefile("w")
+
+    def send(self, opcode: Opcode, payload: bytes = b""):
+        match opcode:
+            case Opcode.TYPE:
+                request = "TYPE?"
+            case Opcode.FEATURES:
+                request = "FEATURES?"
+            case Opcode.SCREENSHOT:
+                request = "SCREENSHOT?"
+            case Opcode.SCREENSHOT_PACKED if payload:
+                request = "SCREENSHOT?PACKED=%d,%d,%d,%d" % REGION.unpack(
+                    payload
+                )
+            case Opcode.SCREENSHOT_PACKED:
+                request = "SCREENSHOT?PACKED"
+            case Opcode.FRAME_NUMBER:
+                request = "FRAME?"
+            case Opcode.SHARED_FRAMES:
+                request = "SHARED_FRAMES?"
+            case Opcode.READ_REGISTER:
+                request = "%sR%d?" % (
+                    "E" if payload[0] & 8 else "",
+                    payload[0] & 7,
+                )
+            case Opcode.WRITE_REGISTER:
+                request = "%sR%d=%02X" % (
+                    "E" if payload[0] & 8 else "",
+                    payload[0] & 7,
+                    payload[1],
+                )
+            case Opcode.WAIT:
+                request = "WAIT?%d" % struct.unpack("<H", payload)
+            case Opcode.TEXT:
+                request = "TEXT=%s" % payload.hex().upper()
+            case Opcode.VRAM_READ | Opcode.VRAM_WRITE:
+                command, r7_base, n_rows, n_cols, n_regs = (
+                    VRAM_HEADER.unpack_from(payload)
+                )
+                rows = payload[VRAM_HEADER.size :][:n_rows]
+                cols = payload[VRAM_HEADER.size + n_rows :][:n_cols]
+                regs = payload[VRAM_HEADER.size + n_rows + n_cols :][:n_regs]
+                data = payload[VRAM_HEADER.size + n_rows + n_cols + n_regs :]
+                request = "VRAM%s%02X,%02X,%s,%s,%s" % (
+                    "?" if opcode == Opcode.VRAM_READ else "=",
+                    command,
+                    r7_base,
+                    rows.hex().upper(),
+                    cols.hex().upper(),
+                    "".join("%d" % reg for reg in regs),
+                )
+                if opcode == Opcode.VRAM_WRITE:
+                    request += ",%s" % data.hex().upper()
+            case Opcode.PROGRAM:
+                request = "PROGRAM=%s" % payload.hex().upper()
+        self._writer.write(request + "\n")
+
+    def flush(self):
+        self._writer.flush()
+
+    def receive(self, opcode: Opcode) -> bytes:
+        line = self._reader.readline().strip()
+        if line.startswith(("Invalid request", "Device not connected")):
+            raise RequestError(line)
+
+        match opcode:
+            case Opcode.TYPE | Opcode.FEATURES | Opcode.SHARED_FRAMES:
+                return line.encode()
+            case Opcode.SCREENSHOT:
+                header = line.encode()
+                data = base64.b64decode(self._reader.readline())
+                return bytes([len(header)]) + header + data
+            case Opcode.SCREENSHOT_PACKED:
+                return base64.b64decode(line)
+            case Opcode.FRAME_NUMBER:
+                return struct.pack("<I", int(line))
+            case Opcode.VRAM_READ | Opcode.PROGRAM:
+                status, data = line.split(":")
+                return bytes([int(status, 16)]) + bytes.fromhex(data)
+            case _:
+                return bytes([int(line, 16)])
+
+    def start_binary(self) -> bool:
+        """Ask the server to switch to the binary protocol."""
+        self._writer.write("BINARY=%d\n" % BINARY_PROTOCOL_VERSION)
+        self._writer.flush()
+        return self._reader.readline().strip() == "OK"
+
+
+class BinaryTransport:
+    """
+    The binary protocol, consisting of length-prefixed frames.
+
+    Replies are received into a reusable buffer: the payloads returned by the
+    receive method are only valid until it is called again.
+    """
+
+    def __init__(self, sk: socket.socket):
+        self._sk = sk
+        self._write_buffer = bytearray()
+        self._read_buffer = bytearray(65536)
+        self._read_start = 0
+        self._read_end = 0
+        self._next_tag = 0
+        self._expected_tags: Deque[int] = collections.deque()
+
+    def send(self, opcode: Opcode, payload: bytes = b""):
+        tag = self._next_tag
+        self._next_tag = (tag + 1) & 0xFFFF
+        if opcode not in _NO_REPLY_OPCODES:
+            self._expected_tags.append(tag)
+        self._write_buffer += FRAME_HEADER.pack(opcode, tag, len(payload))
+        self._write_buffer += payload
+
+    def flush(self):
+        self._sk.sendall(self._write_buffer)
+        self._write_buffer.clear()
+
+    def receive(self, opcode: Opcode) -> memoryview:
+        reply_opcode, tag, payload = self._receive_frame()
+        expected_tag = self._expected_tags.popleft()
+        if reply_opcode == Opcode.ERROR:
+            raise RequestError(bytes(payload).decode(errors="replace"))
+        if reply_opcode != opcode or tag != expected_tag:
+            raise RequestError(
+                "Unexpected reply %02x/%d to request %02x/%d"
+                % (reply_opcode, tag, opcode, expected_tag)
+            )
+        return payload
+
+    def receive_push(self, opcode: Opcode) -> memoryview:
+        """Receive one of the replies that a request keeps getting."""
+        reply_opcode, tag, payload = self._receive_frame()
+        expected_tag = self._expected_tags[0]
+        if reply_opcode == Opcode.ERROR:
+            raise RequestError(bytes(payload).decode(errors="replace"))
+        if reply_opcode != opcode or tag != expected_tag:
+            raise RequestError(
+                "Unexpected reply %02x/%d to request %02x/%d"
+                % (reply_opcode, tag, opcode, expected_tag)
+            )
+        return payload
+
+    def _receive_frame(self) -> Tuple[int, int, memoryview]:
+        reply_opcode, tag, length = FRAME_HEADER.unpack(
+            self._read_exactly(FRAME_HEADER.size)
+        )
+        return reply_opcode, tag, self._read_exactly(length)
+
+    def _read_exactly(self, size: int) -> memoryview:
+        if self._read_end - self._read_start < size:
+            # Move the data that is already buffered to the beginning, making
+            # room for the rest. This overwrites the previous payloads, which
+            # are only valid until the next read. A buffer that is too small is
+            # replaced instead of being resized, as a bytearray cannot be
+            # resized while views of it exist.
+            buffered = self._read_end - self._read_start
+            old_buffer = self._read_buffer
+            if len(old_buffer) < size:
+                self._read_buffer = bytearray(size)
+            self._read_buffer[:buffered] = old_buffer[
+                self._read_start : self._read_end
+            ]
+            self._read_start, self._read_end = 0, buffered
+
+            view = memoryview(self._read_buffer)
+            while self._read_end < size:
+                received = self._sk.recv_into(view[self._read_end :])
+                if received == 0:
+                    raise ConnectionError("Connection closed by the server")
+                self._read_end += received
+
+        start = self._read_start
+        self._read_start += size
+        return memoryview(self._read_buffer)[start : start + size]
+
+
+Transport = Union[TextTransport, BinaryTransport]
@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+import numpy as np
+
+# Layout of an archive file, all little-endian:
+# - ARCHIVE_HEADER: magic, version, number of pools and of entries, size of the
+#   names blob;
+# - one ARCHIVE_POOL per pool: the width of its strips and their number, and
+#   the offset of their packed indices (as by image_utils.pack_indices);
+# - one ARCHIVE_ENTRY per reference, sorted by name: the offset and length of
+#   its name in the blob, its pool, width, height and number of frames, and
+#   the offset of its strip numbers;
+# - the names blob (UTF-8), then the strip numbers (u32) of each entry's
+#   frames and the pools' strips, each aligned to 8 bytes.
+#
+# Frames are cut into strips of ARCHIVE_STRIP_HEIGHT rows (the last one padded
+# with zeros) and each distinct strip is stored once in the pool of its width.
+ARCHIVE_HEADER = struct.Struct("<4sHHII")
+ARCHIVE_POOL = struct.Struct("<HHIQ")
+ARCHIVE_ENTRY = struct.Struct("<IHHHHHxxQ")
+ARCHIVE_MAGIC = b"EFRA"
+ARCHIVE_VERSION = 1
+ARCHIVE_STRIP_HEIGHT = 10
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+class ReferenceArchive:
+    """
+    A single file containing many reference screenshots, packed by
+    scripts/reference-archive.py, which is memory-mapped and read without
+    opening any other file.
+
+    References are looked up by their path relative to the tests directory,
+    e.g. "test_colors_data/test_40columns_attributes_EF9345_pat00.png".
+    """
+
+    def __init__(self, path: Path):
+        with open(path, "rb") as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_pools, n_entries, names_size = (
+            ARCHIVE_HEADER.unpack_from(self._mm)
+        )
+        if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+            self._mm.close()
+            raise ValueError("Not a reference archive")
+
+        # Views of each pool's strips, as (n_strips, height, packed width).
+        offset = ARCHIVE_HEADER.size
+        self._pools: List[np.ndarray] = []
+        for _ in range(n_pools):
+            width, height, n_strips, data_offset = ARCHIVE_POOL.unpack_from(
+                self._mm, offset
+            )
+            packed_width = (width + 1) // 2
+            self._pools.append(
+                np.frombuffer(
+                    self._mm,
+                    np.uint8,
+                    n_strips * height * packed_width,
+                    data_offset,
+                ).reshape(n_strips, height, packed_width)
+            )
+            offset += ARCHIVE_POOL.size
+
+        names_offset = offset + n_entries * ARCHIVE_ENTRY.size
+        self._entries: Dict[str, Tuple[int, ...]] = {}
+        for _ in range(n_entries):
+            name_offset, name_length, *entry = ARCHIVE_ENTRY.unpack_from(
+                self._mm, offset
+            )
+            start = names_offset + name_offset
+            name = self._mm[start : start + name_length].decode()
+            self._entries[name] = tuple(entry)
+            offset += ARCHIVE_ENTRY.size
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._entries
+
+    def names(self) -> List[str]:
+        return list(self._entries)
+
+    def load(self, name: str) -> Tuple[np.ndarray, int]:
+        """Return the frames of a reference, packed, and their width."""
+        pool, width, height, n_frames, refs_offset = self._entries[name]
+        strips_per_frame = -(-height // ARCHIVE_STRIP_HEIGHT)
+        numbers = np.frombuffer(
+            self._mm, np.uint32, n_frames * strips_per_frame, refs_offset
+        ).reshape(n_frames, strips_per_frame)
+
+        # Gather all the strips at once, then drop the padding.
+        strips = self._pools[pool][numbers]
+        packed = strips.reshape(n_frames, -1, strips.shape[-1])[:, :height]
+        return packed, width
+
+    def close(self):
+        self._pools = []
+        self._mm.close()
+
+    @staticmethod
+    def write(path: Path, references: Iterable[Tuple[str, np.ndarray, int]]):
+        """
+        Write an archive with the given (name, packed frames, width)
+        references.
+        """
+        pools: Dict[int, Dict[bytes, int]] = {}  # strips by width
+        entries = []
+        for name, packed, width in sorted(references, key=lambda r: r[0]):
+            n_frames, height, packed_width = packed.shape
+            strips_per_frame = -(-height // ARCHIVE_STRIP_HEIGHT)
+            padded = np.zeros(
+                (
+                    n_frames,
+                    strips_per_frame * ARCHIVE_STRIP_HEIGHT,
+                    packed_width,
+                ),
+                np.uint8,
+            )
+            padded[:, :height] = packed
+            strips = pools.setdefault(width, {})
+            numbers = [
+                strips.setdefault(strip.tobytes(), len(strips))
+                for strip in padded.reshape(
+                    -1, ARCHIVE_STRIP_HEIGHT, packed_width
+                )
+            ]
+            entries.append((name.encode(), width, height, n_frames, numbers))
+
+        # Lay out the variable-size sections.
+        names = b"".join(name for name, *_ in entries)
+        offset = _align(
+            ARCHIVE_HEADER.size
+            + len(pools) * ARCHIVE_POOL.size
+            + len(entries) * ARCHIVE_ENTRY.size
+            + len(names)
+        )
+        refs_offsets = []
+        for *_, numbers in entries:
+            refs_offsets.append(offset)
+            offset = _align(offset + 4 * len(numbers))
+        pool_offsets = []
+        for width, strips in pools.items():
+            pool_offsets.append(offset)
+            offset = _align(
+                offset + len(strips) * ARCHIVE_STRIP_HEIGHT * ((width + 1) // 2)
+            )
+
+        data = bytearray(offset)
+        ARCHIVE_HEADER.pack_into(
+            data,
+            0,
+            ARCHIVE_MAGIC,
+            ARCHIVE_VERSION,
+            len(pools),
+            len(entries),
+            len(names),
+        )
+        offset = ARCHIVE_HEADER.size
+        pool_numbers = {}
+        for (width, strips), data_offset in zip(pools.items(), pool_offsets):
+            pool_numbers[width] = len(pool_numbers)
+            ARCHIVE_POOL.pack_into(
+                data,
+                offset,
+                width,
+                ARCHIVE_STRIP_HEIGHT,
+                len(strips),
+                data_offset,
+            )
+            blob = b"".join(strips)  # in insertion (i.e. numbering) order
+            data[data_offset : data_offset + len(blob)] = blob
+            offset += ARCHIVE_POOL.size
+
+        name_offset = 0
+        for entry, refs_offset in zip(entries, refs_offsets):
+            name, width, height, n_frames, numbers = entry
+            ARCHIVE_ENTRY.pack_into(
+                data,
+                offset,
+                name_offset,
+                len(name),
+                pool_numbers[width],
+                width,
+                height,
+                n_frames,
+                refs_offset,
+            )
+            refs = np.array(numbers, np.uint32).tobytes()
+            data[refs_offset : refs_offset + len(refs)] = refs
+            offset += ARCHIVE_ENTRY.size
+            name_offset += len(name)
+        data[offset : offset + len(names)] = names
+
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
@@ -1,30 +1,60 @@
 from __future__ import annotations
 
-from typing import List
+import os
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
 import PIL.Image
 import PIL.ImageSequence
 
-from .channels import PALETTE_IMAGE, ChannelSet
-from .image_utils import test_images_equal
+from . import screenshot_cache
+from .channels import ChannelSet
+from .frame_store import open_store
+from .image_utils import (
+    from_palette_indices,
+    pack_indices,
+    to_palette_indices,
+    unpack_indices,
+    vertical_concat,
+)
+from .reference_archive import ReferenceArchive
+
+# Geometry of the character rows in the screenshots: each row is 10 pixels high
+# and the first one starts after a 2-pixel border.
+_BORDER = 2
+_ROW_HEIGHT = 10
+
+# A rectangular region of a screenshot, as a PIL box (left, top, right, bottom).
+Region = Tuple[int, int, int, int]
 
 
 class Screenshot:
     """
     A static or animated screenshot, in which only some channels are known.
+
+    The frames are stored as palette indices (i.e. ChannelSet values, see
+    image_utils.to_palette_indices) in a single buffer, two pixels per byte.
+    PIL images with PALETTE_IMAGE's palette are only created when requested.
     """
 
+    __slots__ = ("channels", "width", "_packed")
+
+    # If set, load is redirected to this function, e.g. to serve screenshots
+    # that have been loaded in advance (see prefetch).
+    loader: Optional[Callable[[str], Screenshot]] = None
+
+    # If set, references are looked up in this archive before the filesystem,
+    # by their path relative to the tests directory.
+    archive: Optional[ReferenceArchive] = None
+
     def __init__(self, images: List[PIL.Image.Image], channels: ChannelSet):
-        self.images: List[PIL.Image.Image] = []
         for image in images:
             assert image.size == images[0].size
-            self.images.append(
-                image.convert("RGB").quantize(
-                    palette=PALETTE_IMAGE,
-                    dither=PIL.Image.Dither.NONE,
-                )
-            )
-
         self.channels = channels
+        self.width = images[0].width
+        self._packed = pack_indices(
+            np.stack([to_palette_indices(image) for image in images])
+        )
 
     def __repr__(self) -> str:
         channels = self.channels.name
@@ -33,32 +63,93 @@ class Screenshot:
         height = self.height
         return f"Screenshot({channels}#{n_frames} {width}x{height})"
 
+    @staticmethod
+    def from_packed(packed: np.ndarray, width: int, channels: ChannelSet):
+        """
+        Create a screenshot from an array of frames packed by
+        image_utils.pack_indices.
+        """
+        screenshot = Screenshot.__new__(Screenshot)
+        screenshot.channels = channels
+        screenshot.width = width
+        screenshot._packed = packed
+        return screenshot
+
+    @staticmethod
+    def from_arrays(arrays: List[np.ndarray], channels: ChannelSet):
+        """Create a screenshot from arrays of palette indices."""
+        return Screenshot.from_packed(
+            pack_indices(np.stack(arrays)), arrays[0].shape[1], channels
+        )
+
     @staticmethod
     def load(path: str) -> Screenshot:
         """
         Load a still or animated screenshot from a PNG file.
 
-        It is assumed that all the channels are valid.
+        It is assumed that all the channels are valid. The decoded frames are
+        cached (see screenshot_cache), so that each file is only decoded again
+        if it changes. If the file does not exist, the reference is looked up
+        in the store of its directory, if any (see frame_store). Both are
+        skipped for the references contained in Screenshot.archive.
         """
+        if Screenshot.loader is not None:
+            return Screenshot.loader(path)
+        return Screenshot.decode(path)
+
+    @staticmethod
+    def decode(path: str) -> Screenshot:
+        """Like load, but always reading the file (or its cache) right away."""
+        if Screenshot.archive is not None:
+            name = os.path.normpath(path)
+            if name in Screenshot.archive:
+                packed, width = Screenshot.archive.load(name)
+                return Screenshot.from_packed(packed, width, ChannelSet.RGBI)
+
+        # References that have been converted into a store (see frame_store)
+        # are only found in its index.
+        if not os.path.exists(path):
+            store = open_store(Path(path).parent.absolute())
+            if store is not None and Path(path).name in store:
+                packed, width = store.load(Path(path).name)
+                return Screenshot.from_packed(packed, width, ChannelSet.RGBI)
+
+        cached = screenshot_cache.load(path)
+        if cached is not None:
+            packed, width = cached
+            return Screenshot.from_packed(packed, width, ChannelSet.RGBI)
+
         images = PIL.ImageSequence.all_frames(
             PIL.Image.open(
                 path,
                 formats=["png"],
             )
         )
-        return Screenshot(images, channels=ChannelSet.RGBI)
-
-    @property
-    def width(self) -> int:
-        return self.images[0].width
+        screenshot = Screenshot(images, channels=ChannelSet.RGBI)
+        screenshot_cache.store(path, screenshot._packed, screenshot.width)
+        return screenshot
 
     @property
     def height(self) -> int:
-        return self.images[0].height
+        return self._packed.shape[1]
 
     @property
     def n_frames(self) -> int:
-        return len(self.images)
+        return self._packed.shape[0]
+
+    @property
+    def arrays(self) -> List[np.ndarray]:
+        """The palette indices of each frame, unpacked."""
+        return list(unpack_indices(self._packed, self.width))
+
+    @property
+    def images(self) -> List[PIL.Image.Image]:
+        """Each frame as a newly created PIL image."""
+        return [from_palette_indices(indices) for indices in self.arrays]
+
+    def show(self, title: Optional[str] = None):
+        """Show all the frames, one below the other."""
+        vertical_concat(*self.images).show(title)
 
     def save(self, path: str):
         converted = [img.convert("RGB") for img in self.images]
@@ -77,29 +168,74 @@ class Screenshot:
                 save_all=True,
             )
 
-    def create_matcher(self, channels: ChannelSet) -> ScreenshotMatcher:
-        return ScreenshotMatcher(self.images, channels)
-
-
-class _ScreenshotMatcherHelper:
-    def __init__(self, images: List[PIL.Image.Image]):
-        self._images = images
-        self._matched_length = 0
-
-    def advance(self, image: PIL.Image.Image) -> bool:
-        # Try to advance to the next image, if it matches.
-        if test_images_equal(image, self._images[self._matched_length]):
-            self._matched_length += 1
-            return self._matched_length == len(self._images)
-
-        # When we have a repeated match for the same image we've already seen at
-        # the previous iterations, ignore it. Otherwise, we lost the
-        # synchronization and we'll have to restart from the beginning at the
-        # next iteration.
-        if self._matched_length != 0 and not test_images_equal(
-            image, self._images[self._matched_length - 1]
-        ):
-            self._matched_length = 0
+    def rows_region(self, first_y: int, last_y: int) -> Region:
+        """
+        The region covering the given range of character rows (numbered as in
+        R6, i.e. 0 for the service row and 8-31 for the others, inclusive), for
+        the whole width of the screenshot.
+        """
+        first_row, last_row = (
+            0 if y == 0 else y - 7 for y in (first_y, last_y)
+        )
+        return (
+            0,
+            _BORDER + first_row * _ROW_HEIGHT,
+            self.width,
+            _BORDER + (last_row + 1) * _ROW_HEIGHT,
+        )
+
+    def crop(self, region: Region) -> Screenshot:
+        left, top, right, bottom = region
+        return Screenshot.from_arrays(
+            [indices[top:bottom, left:right] for indices in self.arrays],
+            self.channels,
+        )
+
+    def create_matcher(
+        self,
+        channels: ChannelSet,
+        region: Optional[Region] = None,
+        mask: Optional[PIL.Image.Image] = None,
+    ) -> ScreenshotMatcher:
+        return ScreenshotMatcher(self.arrays, channels, region, mask)
+
+
+class _CyclicMatcher:
+    # Finds the occurrences of any rotation of a cyclic sequence of symbols in
+    # a stream, in which repetitions of the same symbol count as one. Symbols
+    # are matched in constant time per symbol, except for those that occur
+    # more than once in the sequence.
+
+    def __init__(self, symbols: List[int]):
+        # Collapse repetitions in the sequence too, including the one between
+        # its last and first symbols.
+        sequence = [s for i, s in enumerate(symbols) if s != symbols[i - 1]]
+        self._sequence = sequence or symbols[:1]
+
+        self._positions: Dict[int, List[int]] = {}
+        for position, symbol in enumerate(self._sequence):
+            self._positions.setdefault(symbol, []).append(position)
+
+        # For each position in the sequence that the last symbol received may
+        # correspond to, how many symbols before it were matched too.
+        self._runs: Dict[int, int] = {}
+        self._prev_symbol: Optional[int] = None
+
+    def advance(self, symbol: Optional[int]) -> bool:
+        # Feed the next symbol (None if not in the sequence) and return whether
+        # a full rotation has just been received.
+        if symbol == self._prev_symbol:
+            return False  # repetition (or still not in the sequence)
+        self._prev_symbol = symbol
+
+        n = len(self._sequence)
+        runs = {}
+        for position in self._positions.get(symbol, ()):
+            length = self._runs.get((position - 1) % n, 0) + 1
+            if length >= n:
+                return True
+            runs[position] = length
+        self._runs = runs
         return False
 
 
@@ -112,19 +248,58 @@ class ScreenshotMatcher:
     stream. In this case, duplicated/redundant frames in the stream will be
     ignored. Furthermore, the stream and the reference screenshot do not need to
     start on the same frame.
+
+    Each incoming image is looked up by its contents in a table of the
+    reference's frames, so that the cost of matching does not depend on the
+    number of frames in the reference.
+
+    The comparison can be restricted to a region of interest and/or to the
+    pixels that are set in a mask (of the same size as the reference). Incoming
+    images can be either full-sized or already cropped to the region.
+
+    The reference images are given as arrays of palette indices (see
+    Screenshot.arrays).
     """
 
-    def __init__(self, images: List[PIL.Image.Image], channels: ChannelSet):
+    def __init__(
+        self,
+        images: List[np.ndarray],
+        channels: ChannelSet,
+        region: Optional[Region] = None,
+        mask: Optional[PIL.Image.Image] = None,
+    ):
         self._channels = channels
+        height, width = images[0].shape
+        self._full_size = (width, height)
+        self._region = region
 
-        # Instantiate an helper class instance for each possible rotation in the
-        # order of the template images. Every instance will try to match a
-        # specific sequence.
-        images_twice = [self._channel_selector(img) for img in images] * 2
-        self._helpers = [
-            _ScreenshotMatcherHelper(images_twice[shift : shift + len(images)])
-            for shift in range(len(images))
+        # What each pixel is ANDed with before comparing it: the bits of the
+        # requested channels or, if excluded by the mask, zero.
+        self._selector = np.uint8(channels.value)
+        if mask is not None:
+            assert mask.size == self._full_size
+            included = self._crop(np.asarray(mask.convert("L"))) != 0
+            self._selector = np.where(included, self._selector, np.uint8(0))
+
+        # Number the distinct reference frames, as they look after stripping
+        # the excluded channels and pixels, and match their sequence.
+        self._frame_ids: Dict[bytes, int] = {}
+        symbols = [
+            self._frame_ids.setdefault(
+                self._channel_selector(self._crop(img)).tobytes(),
+                len(self._frame_ids),
+            )
+            for img in images
         ]
+        self._sequence_matcher = _CyclicMatcher(symbols)
+
+    @property
+    def selector(self) -> np.ndarray:
+        """
+        What each pixel of the region is ANDed with before comparing it, either
+        a scalar or an array.
+        """
+        return self._selector
 
     def advance(self, image: PIL.Image.Image, channels: ChannelSet) -> bool:
         # All the channels that we were asked to compare must be available.
@@ -132,19 +307,27 @@ class ScreenshotMatcher:
 
         # Any other channel needs to be excluded from the comparison.
         image_for_comparison = self._channel_selector(
-            image.convert("RGB").quantize(
-                palette=PALETTE_IMAGE,
-                dither=PIL.Image.Dither.NONE,
-            )
+            self._crop(to_palette_indices(image))
         )
 
-        # Try to match against all the possible rotations; return success if at
-        # least one signals that a full match occurred.
-        for helper in self._helpers:
-            if helper.advance(image_for_comparison):
-                return True
-        return False
+        # Identify the image among the reference's frames, if present, and feed
+        # it to the matcher.
+        frame_id = self._frame_ids.get(image_for_comparison.tobytes())
+        return self._sequence_matcher.advance(frame_id)
+
+    def _crop(self, image: np.ndarray) -> np.ndarray:
+        # Restrict full-sized images to the region of interest, if any.
+        height, width = image.shape
+        if self._region is None:
+            assert (width, height) == self._full_size
+            return image
+        left, top, right, bottom = self._region
+        if (width, height) == self._full_size:
+            return image[top:bottom, left:right]
+        assert (width, height) == (right - left, bottom - top)
+        return image
 
-    def _channel_selector(self, image: PIL.Image.Image) -> PIL.Image.Image:
-        # Strip the channels that should be excluded from the comparison.
-        return image.point(lambda v: v & self._channels.value, mode="P")
+    def _channel_selector(self, image: np.ndarray) -> np.ndarray:
+        # Strip the channels that should be excluded from the comparison, as
+        # well as the pixels that are not in the mask.
+        return image & self._selector
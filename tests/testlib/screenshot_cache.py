@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+from pathlib import Path
+from typing import Optional, Tuple
+import numpy as np
+
+# Cached reference screenshots are stored in this subdirectory of the directory
+# that contains them, with the same name plus this suffix.
+CACHE_DIRNAME = ".screenshot_cache"
+_CACHE_SUFFIX = ".bin"
+
+# Header of a cache file: magic, the mtime (in ns) and size of the PNG file at
+# the time it was cached, its SHA-256 digest, the number of frames and their
+# size. It is followed by the frames' palette indices, as packed by
+# image_utils.pack_indices.
+CACHE_HEADER = struct.Struct("<4sQQ32sHHH")
+CACHE_MAGIC = b"SCC1"
+
+
+def _cache_path(path: Path) -> Path:
+    return path.parent / CACHE_DIRNAME / (path.name + _CACHE_SUFFIX)
+
+
+def _digest(path: Path) -> bytes:
+    return hashlib.sha256(path.read_bytes()).digest()
+
+
+def load(path: str) -> Optional[Tuple[np.ndarray, int]]:
+    """
+    Return the packed frames of the given PNG file and their width, as stored
+    by a previous call to store, or None if they have not been or if the file
+    changed since. The frames are a read-only view of the memory-mapped cache
+    file.
+    """
+    path = Path(path)
+    try:
+        stat = path.stat()
+        with open(_cache_path(path), "rb") as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):  # ValueError: empty file
+        return None
+
+    if len(mm) < CACHE_HEADER.size:
+        mm.close()
+        return None
+    magic, mtime_ns, size, digest, n_frames, width, height = (
+        CACHE_HEADER.unpack_from(mm)
+    )
+    packed_width = (width + 1) // 2
+    if (
+        magic != CACHE_MAGIC
+        or len(mm) != CACHE_HEADER.size + n_frames * height * packed_width
+    ):
+        mm.close()
+        return None
+
+    # Only rehash the file if its metadata changed, e.g. if it was checked out
+    # again with the same contents.
+    if (mtime_ns, size) != (stat.st_mtime_ns, stat.st_size):
+        try:
+            if digest != _digest(path):
+                mm.close()
+                return None
+        except OSError:
+            mm.close()
+            return None
+        _touch(path, stat)
+
+    # The mapping stays open as long as the frames reference it.
+    packed = np.frombuffer(
+        mm,
+        np.uint8,
+        n_frames * height * packed_width,
+        CACHE_HEADER.size,
+    )
+    return packed.reshape(n_frames, height, packed_width), width
+
+
+def store(path: str, packed: np.ndarray, width: int):
+    """
+    Cache the packed frames of the given PNG file. Errors are ignored, as the
+    file can always be decoded again.
+    """
+    path = Path(path)
+    try:
+        stat = path.stat()
+        header = CACHE_HEADER.pack(
+            CACHE_MAGIC,
+            stat.st_mtime_ns,
+            stat.st_size,
+            _digest(path),
+            packed.shape[0],
+            width,
+            packed.shape[1],
+        )
+        _write(_cache_path(path), header + packed.tobytes())
+    except OSError:
+        pass
+
+
+def _touch(path: Path, stat: os.stat_result):
+    # Record the new metadata of a file whose contents did not change.
+    cache_path = _cache_path(path)
+    try:
+        with open(cache_path, "r+b") as fp:
+            fp.seek(4)
+            fp.write(struct.pack("<QQ", stat.st_mtime_ns, stat.st_size))
+    except OSError:
+        pass
+
+
+def _write(cache_path: Path, data: bytes):
+    # Replace the cache file atomically, so that concurrent runs never see it
+    # partially written.
+    cache_path.parent.mkdir(exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent)
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
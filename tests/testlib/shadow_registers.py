@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+from typing import Dict, List, Optional, Tuple
+
+# Indirect registers that can be written through the IND command, by number.
+INDIRECT_REGISTERS = {1: "TGS", 2: "MAT", 3: "PAT", 4: "DOR", 7: "ROR"}
+
+_NOP = 0x91
+
+
+class ShadowStats:
+    """How many requests the shadow registers made unnecessary."""
+
+    def __init__(self):
+        self.elided_writes = 0  # plain register writes
+        self.elided_commands = 0  # command executions
+        self.elided_waits = 0  # waits for the chip to become ready
+
+    @property
+    def round_trips_saved(self) -> int:
+        # Writes do not wait for a reply, but waits always do.
+        return self.elided_waits
+
+    def __repr__(self) -> str:
+        return (
+            f"ShadowStats({self.elided_writes} writes, "
+            f"{self.elided_commands} commands, {self.elided_waits} waits)"
+        )
+
+
+class ShadowRegisters:
+    """
+    The last known value of the direct registers (R0-R7) and of the indirect
+    ones (TGS, MAT, PAT, DOR and ROR), used to elide the writes that cannot
+    change the state of the chip.
+
+    Commands are classified by their side effects: NOP has none, IND only
+    affects the indirect register (or, if reading, R1) and memory access
+    commands (0x00-0x7F) may change R1-R7. Any other command makes all the
+    values unknown, except R0.
+    """
+
+    def __init__(self):
+        self.direct: List[Optional[int]] = [None] * 8
+        self.indirect: Dict[int, Optional[int]] = {}
+        self.idle = False  # whether the chip is known not to be busy
+        self.stats = ShadowStats()
+
+    def invalidate(self):
+        """Forget everything, e.g. after the chip was accessed elsewhere."""
+        self.direct = [None] * 8
+        self.indirect = {}
+        self.idle = False
+
+    def filter_write(
+        self, regnum: int, value: int, execute: bool
+    ) -> Optional[Tuple[int, int, bool]]:
+        """
+        Update the shadow state with the given register write and return the
+        write that must actually be sent, or None if it can be elided.
+        """
+        if execute:
+            command = value if regnum == 0 else self.direct[0]
+            if not self._is_redundant(command, regnum, value):
+                self.direct[regnum] = value
+                self.note_execute(command)
+                return regnum, value, True
+
+            # The register must still hold the new value.
+            self.stats.elided_commands += 1
+            execute = False
+
+        if self.direct[regnum] == value:
+            self.stats.elided_writes += 1
+            return None
+        self.direct[regnum] = value
+        return regnum, value, execute
+
+    def note_read(self, execute: bool):
+        """Update the shadow state with a register read."""
+        if execute:
+            self.note_execute(self.direct[0])
+
+    def filter_wait(self) -> bool:
+        """Return whether a wait for the chip to become ready is needed."""
+        if self.idle:
+            self.stats.elided_waits += 1
+            return False
+        return True
+
+    def _is_redundant(
+        self, command: Optional[int], regnum: int, value: int
+    ) -> bool:
+        # Only commands that would run on an idle chip can be skipped.
+        if command is None or not self.idle:
+            return False
+        if command == _NOP:
+            return True
+        if command & 0xF8 == 0x80 and command & 7 in INDIRECT_REGISTERS:
+            r1 = value if regnum == 1 else self.direct[1]
+            known = self.indirect.get(command & 7)
+            return r1 is not None and known == r1
+        return False
+
+    def note_execute(self, command: Optional[int]):
+        """Update the shadow state with the execution of a command."""
+        self.idle = False
+        if command is None:
+            self._forget_data_registers()
+            self.indirect = {}
+        elif command == _NOP:
+            pass
+        elif command & 0xF8 == 0x80:  # IND, write
+            if command & 7 in INDIRECT_REGISTERS:
+                self.indirect[command & 7] = self.direct[1]
+        elif command & 0xF8 == 0x88:  # IND, read
+            self.direct[1] = None
+        elif command < 0x80:  # memory access
+            self._forget_data_registers()
+        else:
+            self._forget_data_registers()
+            self.indirect = {}
+
+    def _forget_data_registers(self):
+        self.direct[1:] = [None] * 7
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import mmap
+import struct
+import time
+from typing import Iterator, Optional, Union
+import PIL.Image
+
+from .channels import ChannelSet
+from .frame_subscription import Frame
+from .protocol import (
+    SHARED_FRAMES_HEADER,
+    SHARED_FRAMES_MAGIC,
+    SHARED_FRAMES_SLOT_HEADER,
+    parse_packed_screenshot,
+)
+
+# How often the ring should be checked for new frames (which arrive at 50 Hz).
+POLL_INTERVAL = 0.002
+
+# How many times a slot that is being written is read again before giving up
+# until the next poll (e.g. if the server died while writing it).
+_MAX_READ_ATTEMPTS = 1000
+
+# After this many attempts, the processor is yielded before each new one, so
+# that the reader does not compete with the server while it writes the slot.
+_SPIN_READ_ATTEMPTS = 8
+
+# Returned by _read_frame for the slots that have been reused for a newer frame.
+_OVERWRITTEN = object()
+
+
+class SharedFrames:
+    """
+    Reads the frames captured by a server running on the same host, directly
+    from the shared-memory ring that it publishes them to.
+
+    Each slot is protected by a sequence counter, which the server makes odd
+    while it is writing the slot: slots that change while being read are read
+    again. Frames whose contents did not change share the same image object as
+    the previous one.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._n_slots, self._slot_size, _ = (
+            SHARED_FRAMES_HEADER.unpack_from(self._mm)
+        )
+        if magic != SHARED_FRAMES_MAGIC:
+            self._mm.close()
+            raise ValueError("Not a shared frames file")
+
+        self._image_id: Optional[int] = None
+        self._channels = ChannelSet.NONE
+        self._image: Optional[PIL.Image.Image] = None
+
+    def _latest_number(self) -> int:
+        return struct.unpack_from(
+            "<I", self._mm, SHARED_FRAMES_HEADER.size - 4
+        )[0]
+
+    def _read_frame(self, number: int) -> Union[Frame, object, None]:
+        # Returns _OVERWRITTEN if the slot has already been reused for a newer
+        # frame, or None if it could not be read consistently.
+        offset = (
+            SHARED_FRAMES_HEADER.size
+            + (number % self._n_slots) * self._slot_size
+        )
+        data_offset = offset + SHARED_FRAMES_SLOT_HEADER.size
+        for attempt in range(_MAX_READ_ATTEMPTS):
+            if attempt >= _SPIN_READ_ATTEMPTS:
+                time.sleep(0)
+            sequence, slot_number, image_id, timestamp_us, length = (
+                SHARED_FRAMES_SLOT_HEADER.unpack_from(self._mm, offset)
+            )
+            if sequence & 1:
+                continue  # being written right now
+
+            # The image only needs to be copied if it changed.
+            if image_id != self._image_id:
+                data = self._mm[data_offset : data_offset + length]
+
+            if struct.unpack_from("<I", self._mm, offset)[0] == sequence:
+                break  # consistent
+        else:
+            return None
+
+        if slot_number != number:
+            return _OVERWRITTEN
+        if image_id != self._image_id:
+            self._channels, self._image = parse_packed_screenshot(data)
+            self._image_id = image_id
+        return Frame(number, timestamp_us / 1e6, self._channels, self._image)
+
+    def next_frame(self, after: int) -> Optional[Frame]:
+        """
+        Return the first frame whose number is greater than the given one,
+        skipping the ones that have already been overwritten, or None if it has
+        not been published yet (or is still being written).
+        """
+        while True:
+            latest = self._latest_number()
+            if latest <= after:
+                return None
+            after = max(after + 1, latest - self._n_slots + 1)
+            frame = self._read_frame(after)
+            if frame is not _OVERWRITTEN:
+                return frame
+
+    def frames(self, after: int, timeout: float) -> Iterator[Frame]:
+        """
+        Yield the frames whose number is greater than the given one, in order,
+        as they are published. Frames that have already been overwritten by the
+        time they are read are skipped.
+
+        Raises TimeoutError if no new frame is published for the given number
+        of seconds.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            frame = self.next_frame(after)
+            if frame is None:
+                if time.monotonic() > deadline:
+                    raise TimeoutError("No frame received")
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            yield frame
+            deadline = time.monotonic() + timeout
+            after = frame.number
+
+    def close(self):
+        self._mm.close()
@@ -1,8 +1,11 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import inspect
 import os
 import sys
+import time
 import traceback
 from fnmatch import fnmatchcase
 from pathlib import Path
@@ -18,6 +21,17 @@ from typing import (
     Union,
 )
 
+from .async_video_chip import AsyncVideoChip
+from .busy_wait import BusyWaitPolicy, CommandDurations
+from .failure_artifacts import INDEX_NAME, FailureArtifacts
+from .prefetch import (
+    LEARNED_MANIFEST_NAME,
+    SEED_MANIFEST_NAME,
+    ReferencePrefetcher,
+)
+from .protocol import Address
+from .reference_archive import ReferenceArchive
+from .screenshot import Screenshot
 from .video_chip import VideoChip, VideoChipType
 
 _ALL_TESTS: List[_Test] = []
@@ -37,6 +51,9 @@ class _Test:
         self.function = lambda video_chip: function(video_chip, *parameters)
         self.restrict = restrict
 
+        # Coroutine tests ("async def") are given an AsyncVideoChip instead.
+        self.is_async = inspect.iscoroutinefunction(function)
+
 
 class _TestWithLazyParameters:
     def __init__(
@@ -95,7 +112,9 @@ def test(
     return decorator
 
 
-def _host_and_port(text: str) -> Tuple[str, int]:
+def _address(text: str) -> Address:
+    if text.startswith("unix:"):
+        return text[len("unix:") :]
     host, sep, port_str = text.rpartition(":")
     port = int(port_str)
     if port < 1 or port > 65535 or sep != ":":
@@ -118,19 +137,64 @@ def test_main():
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
     parser.add_argument(
-        "--video-chip", metavar="HOST:PORT", required=True, type=_host_and_port
+        "--video-chip",
+        metavar="HOST:PORT|unix:PATH",
+        required=True,
+        type=_address,
+    )
+    parser.add_argument(
+        "--shadow-registers",
+        action="store_true",
+        help="skip the register writes that would not change the chip state",
+    )
+    parser.add_argument(
+        "--prefetch-window",
+        metavar="N",
+        type=int,
+        default=16,
+        help="how many reference screenshots to load ahead (default: 16)",
+    )
+    parser.add_argument(
+        "--reference-archive",
+        metavar="PATH",
+        type=Path,
+        help="load the reference screenshots from this archive, packed by "
+        "scripts/reference-archive.py, instead of their files",
+    )
+    parser.add_argument(
+        "--artifacts-dir",
+        metavar="PATH",
+        type=Path,
+        help="where to save the screenshots of the failed tests, in a "
+        "subdirectory per run (default: tests/.failures)",
     )
     parser.add_argument("filter", nargs="*")
+    default_artifacts_dir = Path(__file__).parent.parent / ".failures"
     args = parser.parse_args()
+    if args.reference_archive is not None:
+        Screenshot.archive = ReferenceArchive(args.reference_archive)
+    artifacts_dir = (args.artifacts_dir or default_artifacts_dir).absolute()
 
     # Change working directory to the tests folder.
     os.chdir(Path(__file__).parent.parent)
 
-    # Connect to the TCP server offering access to the video chip.
-    host, port = args.video_chip
-    video_chip = VideoChip(host, port)
+    # Connect to the server offering access to the video chip.
+    busy_policy = BusyWaitPolicy()
+    video_chip = VideoChip(
+        args.video_chip,
+        busy_policy=busy_policy,
+        shadow=args.shadow_registers,
+    )
     video_chip_type = video_chip.chip_type
 
+    # Start from the command durations learned in the previous runs.
+    durations_path = Path(".busy_durations_%s.json" % video_chip_type.value)
+    busy_policy.durations = CommandDurations.load(durations_path)
+
+    # Coroutine tests run in an event loop, with their own connection.
+    runner = asyncio.Runner()
+    async_video_chip: Optional[AsyncVideoChip] = None
+
     # Full resolve tests with lazy parameters.
     all_tests = []
     for test in _ALL_TESTS:
@@ -147,30 +211,68 @@ def test_main():
         else:
             all_tests.append(test)
 
+    # Select the tests to run.
+    selected_tests = [
+        test
+        for test in all_tests
+        if (
+            len(args.filter) == 0
+            or any(fnmatchcase(test.name, pattern) for pattern in args.filter)
+        )
+        and (not test.restrict or test.restrict == video_chip_type)
+    ]
+
+    # Load the reference screenshots that they used in the previous runs in
+    # the background, ahead of each test. What was learned in this checkout
+    # takes precedence over the seed kept in the repository.
+    prefetcher = ReferencePrefetcher(window=args.prefetch_window)
+    script_name = Path(sys.argv[0]).stem
+    manifest_path = Path(
+        LEARNED_MANIFEST_NAME % (script_name, video_chip_type.value)
+    )
+    prefetcher.load_manifest(
+        Path(SEED_MANIFEST_NAME % video_chip_type.value), section=script_name
+    )
+    prefetcher.load_manifest(manifest_path)
+    prefetcher.plan([test.name for test in selected_tests])
+    Screenshot.loader = prefetcher.load
+
+    # Save the screenshots of the failed expectations in the background.
+    artifacts = FailureArtifacts(
+        artifacts_dir
+        / ("%s_%s" % (time.strftime("%Y%m%d-%H%M%S"), video_chip_type.value))
+    )
+    VideoChip.failure_artifacts = artifacts
+
     # Execute all the tests.
     success_count = 0
     failed_count = 0
-    for test in all_tests:
-        if len(args.filter) != 0 and not any(
-            fnmatchcase(test.name, pattern) for pattern in args.filter
-        ):
-            continue
-        if test.restrict and test.restrict != video_chip_type:
-            continue
-
+    for test in selected_tests:
         # Send NOP and wait, to put the chip into a known initial state.
         video_chip.ER0 = 0x91
         video_chip.wait_not_busy()
 
         print("RUN  : %s" % test.name, file=sys.stderr)
+        prefetcher.start_test(test.name)
+        artifacts.start_test(test.name)
         success = True
         try:
-            test.function(video_chip)
+            if not test.is_async:
+                test.function(video_chip)
+            else:
+                if async_video_chip is None:
+                    async_video_chip = runner.run(
+                        AsyncVideoChip.connect(args.video_chip, busy_policy)
+                    )
+                runner.run(test.function(async_video_chip))
         except KeyboardInterrupt:
             raise
         except:
             traceback.print_exc(file=sys.stderr)
             success = False
+        if test.is_async:
+            video_chip.invalidate_shadows()  # the chip was accessed elsewhere
+        prefetcher.finish_test(success)
         if success:
             print("OK   : %s" % test.name, file=sys.stderr)
             success_count += 1
@@ -178,6 +280,37 @@ def test_main():
             print("FAIL : %s" % test.name, file=sys.stderr)
             failed_count += 1
 
+    if async_video_chip is not None:
+        runner.run(async_video_chip.close())
+    runner.close()
+
+    busy_policy.durations.save(durations_path)
+
+    Screenshot.loader = None
+    prefetcher.close()
+    prefetcher.save_manifest(manifest_path, [test.name for test in all_tests])
+    if Screenshot.archive is not None:
+        Screenshot.archive.close()
+        Screenshot.archive = None
+
+    VideoChip.failure_artifacts = None
+    artifacts.close()
+    if artifacts.n_failures != 0:
+        print(
+            "Screenshots of the failures: %s"
+            % (artifacts.directory / INDEX_NAME),
+            file=sys.stderr,
+        )
+
+    if video_chip.shadow is not None:
+        stats = video_chip.shadow.stats
+        print(
+            f"Shadow registers elided {stats.elided_writes} writes, "
+            f"{stats.elided_commands} commands and {stats.elided_waits} waits "
+            f"({stats.round_trips_saved} round trips saved).",
+            file=sys.stderr,
+        )
+
     total_count = success_count + failed_count
     print(
         f"{success_count} succeeded, {failed_count} failed, {total_count} total.",
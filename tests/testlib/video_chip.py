@@ -1,15 +1,52 @@
 from __future__ import annotations
 
-import base64
+import collections
+import contextlib
 import enum
 import io
-import socket
+import itertools
+import struct
 import time
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+import numpy as np
 import PIL.Image
 
+from .busy_wait import BusyWaitPolicy, busy_timeout_error
 from .channels import ChannelSet
-from .image_utils import test_images_equal, vertical_concat
-from .screenshot import Screenshot
+from .failure_artifacts import FailureArtifacts
+from .frame_subscription import Frame, FrameSubscription
+from .image_utils import pack_indices, to_palette_indices
+from .optimizer import Operation, compile_program, optimize
+from .page import PAGE_ROWS, Page
+from .program import Instruction, Program
+from .protocol import (
+    REGION,
+    VRAM_HEADER,
+    Address,
+    BinaryTransport,
+    Opcode,
+    ProgramOp,
+    RequestError,
+    TextTransport,
+    Transport,
+    connect,
+    parse_packed_screenshot,
+)
+from .screenshot import Region, Screenshot
+from .shadow_registers import ShadowRegisters
+from .shared_frames import SharedFrames
 
 
 class VideoChipType(enum.Enum):
@@ -17,12 +54,325 @@ class VideoChipType(enum.Enum):
     TS9347 = "TS9347"
 
 
+# Maximum number of replies that can be outstanding in pipelined mode. Past
+# this point, the oldest one is waited for before sending new requests, so that
+# neither side can fill up the socket buffers and deadlock.
+_MAX_PENDING_REPLIES = 1024
+
+# How long expect_screenshot waits for a matching frame, after the first one.
+_EXPECT_SCREENSHOT_TIMEOUT = 2.0
+
+# Minimum spacing between the frames returned by screenshot.
+_SCREENSHOT_FRAME_SPACING = 0.1
+
+# How long to wait for the next frame before deciding that the server has
+# stopped sending them.
+_FRAME_TIMEOUT = 5.0
+
+# Font ROM contents already read in this session, keyed by chip type and block.
+_font_rom_cache: Dict[Tuple[VideoChipType, int], bytes] = {}
+
+# Raised (as TimeoutError) when a wait in a register program times out.
+_PROGRAM_TIMEOUT_MESSAGE = "The video chip was still busy after a wait"
+
+# Data registers transferred by each memory access command (without the read
+# and auto-increment flags), in the order in which they are transferred.
+_VRAM_COMMAND_REGISTERS = {
+    0x00: (1, 2, 3),  # KRF/TLM
+    0x02: (1, 2),  # KRG
+    0x30: (1,),  # OCT/TBM
+    0x50: (1, 3),  # KRL
+    0x60: (1, 2),  # TSM
+}
+
+
+class _ScreenshotExpectation:
+    # The state of expect_screenshot, which is fed with the incoming frames.
+
+    def __init__(
+        self,
+        reference: Screenshot,
+        channels: ChannelSet,
+        region: Optional[Region],
+        mask: Optional[PIL.Image.Image],
+    ):
+        self._reference = reference
+        self._channels = channels
+        self._region = region
+        self._matcher = reference.create_matcher(channels, region, mask)
+        self._prev_image = None
+        self._prev_channels_and_size = None  # not known yet
+        # Each unique frame we see in the stream, packed (see pack_indices).
+        self._unique_stream_frames: List[np.ndarray] = []
+
+    def advance(
+        self, elapsed: float, channels: ChannelSet, image: PIL.Image.Image
+    ) -> bool:
+        # Returns True if matched, raises AssertionError if the time is up.
+        if elapsed > _EXPECT_SCREENSHOT_TIMEOUT:
+            self._fail()
+
+        # Skip frames that are known not to have changed.
+        if image is self._prev_image:
+            return False
+        self._prev_image = image
+
+        # Ensure uniformity.
+        if self._prev_channels_and_size is not None:
+            assert (channels, image.size) == self._prev_channels_and_size
+        else:
+            self._prev_channels_and_size = (channels, image.size)
+
+        # Store each unique frame we see in the stream.
+        frame = pack_indices(to_palette_indices(image)[np.newaxis])[0]
+        if len(self._unique_stream_frames) == 0 or not np.array_equal(
+            self._unique_stream_frames[-1], frame
+        ):
+            self._unique_stream_frames.append(frame)
+
+        return self._matcher.advance(image, channels)
+
+    def _fail(self):
+        reference = self._reference
+        if self._region is not None:
+            reference = reference.crop(self._region)
+        channels, (width, _) = self._prev_channels_and_size
+        actual = Screenshot.from_packed(
+            np.stack(self._unique_stream_frames), width, channels
+        )
+        artifacts = VideoChip.failure_artifacts
+        if artifacts is not None:
+            artifacts.record(
+                actual, reference, self._channels, self._matcher.selector
+            )
+        else:
+            actual.show("actual_uniq")
+            reference.show("reference")
+        raise AssertionError("The screenshot did not match")
+
+
+class _ScreenshotCollector:
+    # The state of screenshot, which is fed with the incoming frames.
+
+    def __init__(self, n_frames: int):
+        assert n_frames >= 1
+        self._n_frames = n_frames
+        self._prev_channels_and_size = None  # not known yet
+        self._images = []
+        self._next_elapsed = 0
+
+    def advance(
+        self, elapsed: float, channels: ChannelSet, image: PIL.Image.Image
+    ) -> bool:
+        # Returns True once enough frames have been collected.
+        if elapsed < self._next_elapsed:
+            return False  # too close to the previous one
+        self._next_elapsed = elapsed + _SCREENSHOT_FRAME_SPACING
+
+        # Ensure uniformity.
+        if self._prev_channels_and_size is not None:
+            assert (channels, image.size) == self._prev_channels_and_size
+        else:
+            self._prev_channels_and_size = (channels, image.size)
+
+        self._images.append(image)
+        return len(self._images) == self._n_frames
+
+    @property
+    def screenshot(self) -> Screenshot:
+        # Pack into a Screenshot instance.
+        channels, _ = self._prev_channels_and_size
+        return Screenshot(self._images, channels)
+
+
+class _ScreenshotRequest(NamedTuple):
+    # How to take a screenshot: the request, the parser of its reply and the
+    # region that the result must be cropped to, if the server cannot do it.
+    opcode: Opcode
+    payload: bytes
+    parse: Callable[[bytes], Tuple[ChannelSet, PIL.Image.Image]]
+    crop: Optional[Region]
+
+
+def _screenshot_request(
+    features: FrozenSet[str], region: Optional[Region]
+) -> _ScreenshotRequest:
+    # Let the server crop the image, if supported, to reduce the amount of data
+    # to be transferred, and prefer packed color indices, which need neither PNG
+    # decoding nor quantization.
+    if region is not None and {"PACKED", "CROP"} <= features:
+        return _ScreenshotRequest(
+            Opcode.SCREENSHOT_PACKED,
+            REGION.pack(*region),
+            parse_packed_screenshot,
+            None,
+        )
+    if "PACKED" in features:
+        return _ScreenshotRequest(
+            Opcode.SCREENSHOT_PACKED, b"", parse_packed_screenshot, region
+        )
+    return _ScreenshotRequest(
+        Opcode.SCREENSHOT, b"", VideoChip._parse_screenshot, region
+    )
+
+
+def _open_shared_frames(payload: bytes) -> Optional[SharedFrames]:
+    # Open the ring whose path is in the reply to SHARED_FRAMES, which is only
+    # possible if the server runs on the same host.
+    try:
+        return SharedFrames(bytes(payload).decode())
+    except (OSError, ValueError):
+        return None
+
+
+def _can_subscribe(features: FrozenSet[str]) -> bool:
+    return {"BINARY", "SUBSCRIBE"} <= features
+
+
+class _FrameTimeline:
+    # The state of _frames, which turns the frames of a frame source into the
+    # seconds elapsed since the first one, the channels and the image, cropped
+    # to the region. Frames whose contents did not change yield the same image
+    # object as the previous one.
+
+    def __init__(self, region: Optional[Region]):
+        self._region = region
+        self._start: Optional[float] = None
+        self._prev_image: Optional[PIL.Image.Image] = None
+        self._image: Optional[PIL.Image.Image] = None
+
+    def advance(
+        self, frame: Frame
+    ) -> Tuple[float, ChannelSet, PIL.Image.Image]:
+        if self._start is None:
+            self._start = frame.timestamp
+        if frame.image is not self._prev_image:
+            self._prev_image = self._image = frame.image
+            if self._region is not None:
+                self._image = self._image.crop(self._region)
+        return frame.timestamp - self._start, frame.channels, self._image
+
+
+class _NotBusyWait:
+    # The state of wait_not_busy, which is fed with the status register values
+    # returned by each poll (a WAIT request, if supported, or a read of R0).
+
+    def __init__(
+        self,
+        policy: BusyWaitPolicy,
+        running_command: Optional[Tuple[Optional[int], float]],
+    ):
+        self._policy = policy
+        self.command, self.started = running_command or (None, time.monotonic())
+        self._delays = policy.delays(self.command, self.started)
+
+    @property
+    def wait_request(self) -> bytes:
+        # Let the server poll the BUSY flag for as long as the policy allows.
+        return struct.pack("<H", self._policy.server_timeout_ms)
+
+    def advance(self, status: int) -> Optional[float]:
+        # Returns how long to sleep before polling again, or None if the chip
+        # is not busy anymore. Raises TimeoutError past the policy's deadline.
+        if status & 0x80:
+            return next(self._delays)
+        return None
+
+    def record(self):
+        # Learn how long the command took, once it has completed.
+        if self.command is not None:
+            self._policy.durations.record(
+                self.command, time.monotonic() - self.started
+            )
+
+
+def _text_registers(
+    a: Optional[int],
+    b: Optional[int],
+    y: Optional[int],
+    x: Optional[int],
+    command: Optional[int],
+) -> List[Tuple[int, int]]:
+    # The registers that write_text sets before writing the characters.
+    return [
+        (regnum, value)
+        for regnum, value in [(0, command), (2, b), (3, a), (6, y), (7, x)]
+        if value is not None
+    ]
+
+
+def _resolving(name: str):
+    def method(self: PendingReply, *args):
+        return getattr(self.value, name)(*args)
+
+    return method
+
+
+class PendingReply:
+    """
+    The reply to a request that has been queued but not necessarily received.
+
+    The value is only waited for when it is actually needed, i.e. when the
+    "value" property is accessed or when it is used like an int.
+    """
+
+    def __init__(self, video_chip: VideoChip, parse: Callable[[], object]):
+        self._video_chip = video_chip
+        self._parse = parse
+        self._done = False
+        self._value = None
+
+    @property
+    def value(self):
+        if not self._done:
+            self._video_chip._resolve(self)
+        return self._value
+
+    def _receive(self):
+        self._value = self._parse()
+        self._done = True
+
+    def __repr__(self) -> str:
+        if not self._done:
+            return "PendingReply(<pending>)"
+        return f"PendingReply({self._value!r})"
+
+    # Let register values be used as if they were plain ints.
+    __int__ = _resolving("__int__")
+    __index__ = _resolving("__index__")
+    __bool__ = _resolving("__bool__")
+    __hash__ = _resolving("__hash__")
+    __format__ = _resolving("__format__")
+    __eq__ = _resolving("__eq__")
+    __ne__ = _resolving("__ne__")
+    __lt__ = _resolving("__lt__")
+    __le__ = _resolving("__le__")
+    __gt__ = _resolving("__gt__")
+    __ge__ = _resolving("__ge__")
+    __and__ = _resolving("__and__")
+    __rand__ = _resolving("__rand__")
+    __or__ = _resolving("__or__")
+    __ror__ = _resolving("__ror__")
+    __xor__ = _resolving("__xor__")
+    __rxor__ = _resolving("__rxor__")
+    __add__ = _resolving("__add__")
+    __radd__ = _resolving("__radd__")
+    __sub__ = _resolving("__sub__")
+    __rsub__ = _resolving("__rsub__")
+    __lshift__ = _resolving("__lshift__")
+    __rshift__ = _resolving("__rshift__")
+
+
 class _VideoChipRegisterDescriptor:
     def __init__(self, regnum: int, execute: bool) -> None:
         self._regnum = regnum
         self._execute = execute
 
-    def __get__(self, obj: VideoChip, _objtype: type = None) -> int:
+    def __get__(
+        self, obj: VideoChip, _objtype: type = None
+    ) -> Union[int, PendingReply]:
+        if obj._pipelined:
+            return obj.read_register_deferred(self._regnum, self._execute)
         return obj.read_register(self._regnum, self._execute)
 
     def __set__(self, obj: VideoChip, value: int):
@@ -47,100 +397,282 @@ class VideoChip:
     ER6 = _VideoChipRegisterDescriptor(6, True)
     ER7 = _VideoChipRegisterDescriptor(7, True)
 
-    def __init__(self, host: str, port: int):
-        self._sk = socket.socket(
-            socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP
-        )
-        self._sk.connect((host, port))
-        self._sk.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        self._reader = self._sk.makefile("r")
-        self._writer = self._sk.makefile("w")
+    # If set, the screenshots of failed expectations are saved here instead of
+    # being shown (by this class and by AsyncVideoChip alike).
+    failure_artifacts: Optional[FailureArtifacts] = None
 
-    @property
-    def chip_type(self) -> VideoChipType:
-        self._writer.write("TYPE?\n")
-        self._writer.flush()
-        return VideoChipType(self._reader.readline().strip())
+    def __init__(
+        self,
+        address: Address,
+        binary: bool = True,
+        busy_policy: Optional[BusyWaitPolicy] = None,
+        shadow: bool = False,
+    ):
+        self._sk = connect(address)
+        self._transport: Transport = TextTransport(self._sk)
+        self._address = address
+        self._frame_source: Union[SharedFrames, FrameSubscription, None] = None
 
-    def expect_screenshot(self, reference: Screenshot, channels: ChannelSet):
-        matcher = reference.create_matcher(channels)
+        self._pipelined = False
+        self._pending_replies: Deque[PendingReply] = collections.deque()
+        self._features: Optional[FrozenSet[str]] = None
 
-        prev_header_and_size = channels = None  # not known yet
-        unique_stream_images = []
+        # How to wait for commands, and the command that is currently running
+        # (if known, as the value of R0) with the time at which it started.
+        self.busy_policy = busy_policy or BusyWaitPolicy()
+        self._r0: Optional[int] = None
+        self._running_command: Optional[Tuple[Optional[int], float]] = None
 
-        for i in range(15):  # give up after 15 frames
-            if i != 0:
-                time.sleep(0.1)  # short delay
-            else:
-                time.sleep(0.5)  # longer delay before the initial frame
+        # If enabled, the last known state of the registers, which is used to
+        # skip the writes that would not change it.
+        self.shadow = ShadowRegisters() if shadow else None
 
-            # Request a screenshot:
-            self._writer.write("SCREENSHOT?\n")
-            self._writer.flush()
+        # The last known contents of the page drawn by render_page, if any.
+        self._page: Optional[Page] = None
 
-            # Read the header and the image payload.
-            header = self._reader.readline()
-            data = base64.b64decode(self._reader.readline())
-            image = PIL.Image.open(io.BytesIO(data))
+        # The register accesses captured by optimized() that have not been sent
+        # yet, with the replies to the reads among them.
+        self._recording: Optional[List[Operation]] = None
+        self._recorded_reads: List[PendingReply] = []
+        self._verify_recording = False
 
-            # Ensure uniformity.
-            if prev_header_and_size is not None:
-                assert (header, image.size) == prev_header_and_size
-            else:
-                prev_header_and_size = (header, image.size)
-                channels = ChannelSet.NONE
-                if "R" in header:
-                    channels |= ChannelSet.R
-                if "G" in header:
-                    channels |= ChannelSet.G
-                if "B" in header:
-                    channels |= ChannelSet.B
-                if "I" in header:
-                    channels |= ChannelSet.I
-
-            # Store each unique frame we see in the stream.
-            if len(unique_stream_images) == 0 or not test_images_equal(
-                unique_stream_images[-1], image
-            ):
-                unique_stream_images.append(image)
-
-            if matcher.advance(image, channels):
+        # Switch to the binary protocol, if the server supports it.
+        if binary and "BINARY" in self.features:
+            if self._transport.start_binary():
+                self._transport = BinaryTransport(self._sk)
+
+    @contextlib.contextmanager
+    def pipelined(self) -> Iterator[None]:
+        """
+        Pipeline all the register accesses performed within this context.
+
+        Register writes are buffered instead of being sent immediately and
+        register reads do not wait for the reply, returning a PendingReply
+        instead. Buffered requests are only sent when the value of a pending
+        reply is needed and, in any case, when the context is exited.
+
+        Note that, because writes may be delayed, no timing-dependent operation
+        (e.g. sleeping while a command runs) should be performed in this
+        context.
+        """
+        assert not self._pipelined
+        self._pipelined = True
+        try:
+            yield
+        finally:
+            self._pipelined = False
+            self.sync()
+
+    @contextlib.contextmanager
+    def optimized(self, verify: bool = False) -> Iterator[None]:
+        """
+        Capture the register accesses and waits performed within this context
+        and send them as a single program, after rewriting them into a shorter
+        sequence that reads the same values and executes the same commands with
+        the same register values (see optimizer.optimize). For instance, writes
+        to R6 and R7 that position the cursor where an auto-increment command
+        has already moved it are dropped, as well as writes that are overwritten
+        before being used and waits with no command executed since the previous
+        one.
+
+        Reads return a PendingReply: the captured accesses are sent when its
+        value is needed and, in any case, when the context is exited. No other
+        kind of request can be made in this context.
+
+        If verify is True, the captured accesses are also run as they are,
+        before the optimized ones, and the values they read are compared. This
+        is only meaningful if running them twice gives the same results.
+        """
+        assert self._recording is None and not self._pipelined
+        self._recording = []
+        self._verify_recording = verify
+        try:
+            yield
+            self._flush_recording()
+        finally:
+            self._recording = None
+            self._recorded_reads = []
+
+    def _flush_recording(self):
+        operations, self._recording = self._recording, None
+        replies, self._recorded_reads = self._recorded_reads, []
+        try:
+            if self._verify_recording:
+                expected = self.run_program(compile_program(operations))
+            values = self.run_program(compile_program(optimize(operations)))
+            if self._verify_recording:
+                assert (
+                    values == expected
+                ), "The optimized register accesses read %s instead of %s" % (
+                    values.hex(),
+                    expected.hex(),
+                )
+        finally:
+            self._recording = []
+        for reply, value in zip(replies, values):
+            reply._parse = lambda value=value: value
+            reply._receive()
+
+    def sync(self):
+        """Send all buffered requests and wait for all the pending replies."""
+        self._transport.flush()
+        while self._pending_replies:
+            self._pending_replies.popleft()._receive()
+
+    def _send(self, opcode: Opcode, payload: bytes = b""):
+        assert (
+            self._recording is None
+        ), "Only register accesses can be optimized"
+        self._transport.send(opcode, payload)
+        if not self._pipelined:
+            self._transport.flush()
+
+    def _expect_reply(
+        self, opcode: Opcode, parse: Callable[[bytes], object]
+    ) -> PendingReply:
+        if len(self._pending_replies) >= _MAX_PENDING_REPLIES:
+            self._resolve(self._pending_replies[0])
+        reply = PendingReply(
+            self, lambda: parse(self._transport.receive(opcode))
+        )
+        self._pending_replies.append(reply)
+        return reply
+
+    def _resolve(self, reply: PendingReply):
+        if self._recorded_reads:
+            self._flush_recording()
+            if reply._done:
                 return
 
-        vertical_concat(*unique_stream_images).show("actual_uniq")
-        vertical_concat(*reference.images).show("reference")
-        raise AssertionError("The screenshot did not match")
+        # Replies always arrive in the same order as their requests: receive
+        # all the ones that precede the requested one.
+        self._transport.flush()
+        while not reply._done:
+            self._pending_replies.popleft()._receive()
 
-    def screenshot(self, n_frames: int = 1):
-        assert n_frames >= 1
+    def _query(
+        self,
+        opcode: Opcode,
+        payload: bytes,
+        parse: Callable[[bytes], object],
+    ):
+        self._send(opcode, payload)
+        return self._expect_reply(opcode, parse).value
 
-        prev_header_and_size = None  # not known yet
-        images = []
+    @property
+    def features(self) -> FrozenSet[str]:
+        """The protocol extensions supported by the server."""
+        if self._features is None:
+            try:
+                self._features = self._query(
+                    Opcode.FEATURES,
+                    b"",
+                    lambda payload: frozenset(bytes(payload).decode().split()),
+                )
+            except RequestError:
+                # The server predates protocol extensions.
+                self._features = frozenset()
+        return self._features
 
-        for i in range(n_frames):
-            if i != 0:
-                time.sleep(0.1)  # short delay
-            else:
-                time.sleep(0.5)  # longer delay before the initial frame
+    @property
+    def chip_type(self) -> VideoChipType:
+        return self._query(
+            Opcode.TYPE,
+            b"",
+            lambda payload: VideoChipType(bytes(payload).decode()),
+        )
 
-            # Request a screenshot:
-            self._writer.write("SCREENSHOT?\n")
-            self._writer.flush()
+    def expect_screenshot(
+        self,
+        reference: Screenshot,
+        channels: ChannelSet,
+        region: Optional[Region] = None,
+        mask: Optional[PIL.Image.Image] = None,
+    ):
+        """
+        Wait until the screen matches the reference, in the given channels.
 
-            # Read the header and the image payload.
-            header = self._reader.readline()
-            data = base64.b64decode(self._reader.readline())
-            image = PIL.Image.open(io.BytesIO(data))
+        If given, only the pixels in the region and/or that are set in the mask
+        (of the same size as the reference) are compared.
+        """
+        expectation = _ScreenshotExpectation(reference, channels, region, mask)
+        for elapsed, channels, image in self._frames(region):
+            if expectation.advance(elapsed, channels, image):
+                return
 
-            # Ensure uniformity.
-            if prev_header_and_size is not None:
-                assert (header, image.size) == prev_header_and_size
-            else:
-                prev_header_and_size = (header, image.size)
+    def screenshot(self, n_frames: int = 1, region: Optional[Region] = None):
+        collector = _ScreenshotCollector(n_frames)
+        for elapsed, channels, image in self._frames(region):
+            if collector.advance(elapsed, channels, image):
+                return collector.screenshot
 
-            images.append(image)
+    def frame_number(self) -> int:
+        """
+        The number of the latest frame captured by the server, after all the
+        preceding requests have been executed.
+        """
+        return self._query(
+            Opcode.FRAME_NUMBER,
+            b"",
+            lambda payload: struct.unpack("<I", payload)[0],
+        )
 
-        # Pack into a Screenshot instance.
+    def _frames(
+        self, region: Optional[Region] = None
+    ) -> Iterator[Tuple[float, ChannelSet, PIL.Image.Image]]:
+        # Yield the frames that follow all the preceding requests, together
+        # with the seconds elapsed since the first one, optionally cropping them
+        # to the given region. Frames that are known to be identical to the
+        # previous one are yielded as the same image object.
+        frame_source = self._get_frame_source()
+        if frame_source is None:
+            # Poll the server, giving the chip some time to settle first.
+            time.sleep(0.5)
+            start = time.monotonic()
+            while True:
+                channels, image = self._take_screenshot(region)
+                yield time.monotonic() - start, channels, image
+                time.sleep(_SCREENSHOT_FRAME_SPACING)
+
+        # The frame following the latest one might have already been in
+        # progress while the preceding requests were being executed: skip it.
+        timeline = _FrameTimeline(region)
+        for frame in frame_source.frames(
+            self.frame_number() + 1, _FRAME_TIMEOUT
+        ):
+            yield timeline.advance(frame)
+
+    def _get_frame_source(
+        self,
+    ) -> Union[SharedFrames, FrameSubscription, None]:
+        # Prefer reading frames directly from shared memory, which is only
+        # possible if the server runs on the same host, and then receiving them
+        # through a subscription. Returns None if neither is supported.
+        if self._frame_source is None and "SHARED_FRAMES" in self.features:
+            self._frame_source = self._query(
+                Opcode.SHARED_FRAMES, b"", _open_shared_frames
+            )
+        if self._frame_source is None and _can_subscribe(self.features):
+            self._frame_source = FrameSubscription(self._address)
+        return self._frame_source
+
+    def _take_screenshot(
+        self, region: Optional[Region] = None
+    ) -> Tuple[ChannelSet, PIL.Image.Image]:
+        request = _screenshot_request(self.features, region)
+        channels, image = self._query(
+            request.opcode, request.payload, request.parse
+        )
+        if request.crop is not None:
+            image = image.crop(request.crop)
+        return channels, image
+
+    @staticmethod
+    def _parse_screenshot(
+        payload: bytes,
+    ) -> Tuple[ChannelSet, PIL.Image.Image]:
+        header = bytes(payload[1 : 1 + payload[0]]).decode()
+        data = io.BytesIO(payload[1 + payload[0] :])
         channels = ChannelSet.NONE
         if "R" in header:
             channels |= ChannelSet.R
@@ -150,28 +682,522 @@ class VideoChip:
             channels |= ChannelSet.B
         if "I" in header:
             channels |= ChannelSet.I
-        return Screenshot(images, channels)
+        return channels, PIL.Image.open(data)
+
+    @staticmethod
+    def _parse_byte(payload: bytes) -> int:
+        return payload[0]
 
     def read_register(self, regnum: int, execute: bool) -> int:
+        return self.read_register_deferred(regnum, execute).value
+
+    def read_register_deferred(
+        self, regnum: int, execute: bool
+    ) -> PendingReply:
         assert regnum < 8
 
-        if not execute:
-            self._writer.write("R%d?\n" % regnum)
-        else:
-            self._writer.write("ER%d?\n" % regnum)
-        self._writer.flush()
-        return int(self._reader.readline(), 16)
+        if self._recording is not None:
+            self._recording.append(
+                (ProgramOp.READ, regnum | (8 if execute else 0))
+            )
+            reply = PendingReply(self, lambda: None)
+            self._recorded_reads.append(reply)
+            return reply
+
+        if self.shadow is not None:
+            self.shadow.note_read(execute)
+        if execute:
+            self._note_page_command(self._r0)
+        self._send(
+            Opcode.READ_REGISTER, bytes([regnum | (8 if execute else 0)])
+        )
+        return self._expect_reply(Opcode.READ_REGISTER, self._parse_byte)
 
-    def write_register(self, regnum: int, value: bool, execute: bool) -> int:
+    def write_register(self, regnum: int, value: int, execute: bool):
         assert regnum < 8
         assert 0 <= value < 256
 
-        if not execute:
-            self._writer.write("R%d=%02X\n" % (regnum, value))
-        else:
-            self._writer.write("ER%d=%02X\n" % (regnum, value))
-        self._writer.flush()
+        if self._recording is not None:
+            self._recording.append(
+                (ProgramOp.WRITE, regnum | (8 if execute else 0), value)
+            )
+            return
+
+        if self.shadow is not None:
+            write = self.shadow.filter_write(regnum, value, execute)
+            if write is None:
+                return
+            regnum, value, execute = write
+
+        self._send(
+            Opcode.WRITE_REGISTER,
+            bytes([regnum | (8 if execute else 0), value]),
+        )
+
+        if regnum == 0:
+            self._r0 = value
+        if execute:
+            self._running_command = (self._r0, time.monotonic())
+            self._note_page_command(self._r0)
 
     def wait_not_busy(self):
-        while self.R0 & 0x80:
-            pass  # keep waiting
+        """
+        Wait until the chip is not busy, polling it as dictated by busy_policy.
+
+        The time taken by the command that was last executed is recorded in the
+        policy's table of expected durations, unless pipelined.
+        """
+        if self._recording is not None:
+            self._recording.append((ProgramOp.WAIT,))
+            return
+        if self.shadow is not None and not self.shadow.filter_wait():
+            return  # nothing has been executed since the last wait
+        self._poll_not_busy()
+        if self.shadow is not None:
+            self.shadow.idle = True
+
+    def _poll_not_busy(self):
+        wait = _NotBusyWait(self.busy_policy, self._running_command)
+        self._running_command = None
+
+        if "WAIT" in self.features and self._pipelined:
+            # Let the server poll the BUSY flag. If it gives up, the requests
+            # that follow will have already been executed while the chip was
+            # still busy: the failure is reported when the reply is received.
+            self._send(Opcode.WAIT, wait.wait_request)
+            self._expect_reply(
+                Opcode.WAIT, self._wait_reply_parser(wait.command, wait.started)
+            )
+            return
+
+        while True:
+            if "WAIT" in self.features:
+                # Let the server poll the BUSY flag, asking again if it gives
+                # up.
+                status = self._query(
+                    Opcode.WAIT, wait.wait_request, self._parse_byte
+                )
+            else:
+                status = self.read_register(0, False)
+            delay = wait.advance(status)
+            if delay is None:
+                break
+            time.sleep(delay)
+
+        if not self._pipelined:
+            wait.record()
+
+    def write_text(
+        self,
+        text: Union[str, bytes],
+        *,
+        a: Optional[int] = None,
+        b: Optional[int] = None,
+        y: Optional[int] = None,
+        x: Optional[int] = None,
+        command: Optional[int] = None,
+    ):
+        """
+        Write each character of the given text to ER1, waiting for the chip to
+        become ready after each one.
+
+        Before doing so, the registers corresponding to the given arguments are
+        set: "command" to R0, "b" to R2, "a" to R3, "y" to R6 and "x" to R7.
+        Registers whose argument is None are left untouched. Combined with an
+        auto-increment command, such as KRF/TLM (0x01) or KRL (0x51), this
+        draws the text starting at the given location.
+        """
+        if isinstance(text, str):
+            text = text.encode("latin-1")
+
+        for regnum, value in _text_registers(a, b, y, x, command):
+            self.write_register(regnum, value, False)
+
+        if "TEXT" not in self.features:
+            for c in text:
+                self.ER1 = c
+                self.wait_not_busy()
+            return
+
+        # Let the server run the whole sequence and reply once at the end.
+        if self.shadow is not None:
+            self.shadow.note_execute(self.shadow.direct[0])
+        self._note_page_command(self._r0)
+        self._send(Opcode.TEXT, text)
+        reply = self._expect_reply(
+            Opcode.TEXT, self._wait_reply_parser(self._r0, time.monotonic())
+        )
+        if not self._pipelined:
+            self._resolve(reply)
+
+    def read_vram(
+        self,
+        block: int,
+        rows: Sequence[int],
+        cols: Sequence[int],
+        *,
+        command: int = 0x30,
+        registers: Optional[Sequence[int]] = None,
+    ) -> bytes:
+        """
+        Read a rectangle of video memory through the main pointer.
+
+        The given command (by default OCT/TBM, without the read and
+        auto-increment flags) is executed, in read mode, at each column of each
+        of the given rows. The block number (0-3) is encoded in the top bits of
+        R7, while rows are written to R6 as they are. The returned bytes contain
+        the value of each data register transferred by the command (e.g. R1, R2
+        and R3 for KRF/TLM), for each cell in row-major order.
+
+        The data registers can be given explicitly for commands that are not
+        known by this method.
+        """
+        command, r7_base, registers = self._prepare_vram_access(
+            block, command, registers
+        )
+
+        if "VRAM" not in self.features:
+            values = []
+            with self._pipelined_if_needed():
+                self.R0 = command | 0x08  # set read flag
+                for row in rows:
+                    self.R6 = row
+                    for col in cols:
+                        self.ER7 = r7_base | col
+                        self.wait_not_busy()
+                        for regnum in registers:
+                            values.append(
+                                self.read_register_deferred(regnum, False)
+                            )
+            return bytes(values)
+
+        self._note_vram_command(command | 0x08)
+        return self._query(
+            Opcode.VRAM_READ,
+            self._build_vram_request(
+                command | 0x08, r7_base, rows, cols, registers
+            ),
+            self._vram_reply_parser(command | 0x08),
+        )
+
+    def write_vram(
+        self,
+        block: int,
+        rows: Sequence[int],
+        cols: Sequence[int],
+        data: bytes,
+        *,
+        command: int = 0x30,
+        registers: Optional[Sequence[int]] = None,
+    ):
+        """
+        Write a rectangle of video memory through the main pointer.
+
+        This is the counterpart of read_vram: the given data must contain the
+        value of each data register, for each cell in row-major order.
+        """
+        command, r7_base, registers = self._prepare_vram_access(
+            block, command, registers
+        )
+        if len(data) != len(rows) * len(cols) * len(registers):
+            raise ValueError("Data size does not match the given rectangle")
+
+        if "VRAM" not in self.features:
+            values = iter(data)
+            with self._pipelined_if_needed():
+                self.R0 = command
+                for row in rows:
+                    self.R6 = row
+                    for col in cols:
+                        for regnum in registers:
+                            self.write_register(regnum, next(values), False)
+                        self.ER7 = r7_base | col
+                        self.wait_not_busy()
+            return
+
+        self._note_vram_command(command)
+        self._note_page_command(command)
+        self._send(
+            Opcode.VRAM_WRITE,
+            self._build_vram_request(command, r7_base, rows, cols, registers)
+            + bytes(data),
+        )
+        reply = self._expect_reply(
+            Opcode.VRAM_WRITE,
+            self._wait_reply_parser(command, time.monotonic()),
+        )
+        if not self._pipelined:
+            self._resolve(reply)
+
+    @staticmethod
+    def _prepare_vram_access(
+        block: int, command: int, registers: Optional[Sequence[int]]
+    ):
+        if not 0 <= block <= 3:
+            raise ValueError("Invalid block number: %d" % block)
+        command &= ~0x09  # strip read and auto-increment flags
+        if registers is None:
+            try:
+                registers = _VRAM_COMMAND_REGISTERS[command]
+            except KeyError:
+                raise ValueError(
+                    "Unknown data registers for command %02x" % command
+                ) from None
+        r7_base = (0x80 if (block & 1) else 0) | (0x40 if (block & 2) else 0)
+        return command, r7_base, registers
+
+    @staticmethod
+    def _build_vram_request(
+        command: int,
+        r7_base: int,
+        rows: Sequence[int],
+        cols: Sequence[int],
+        registers: Sequence[int],
+    ) -> bytes:
+        return (
+            VRAM_HEADER.pack(
+                command, r7_base, len(rows), len(cols), len(registers)
+            )
+            + bytes(rows)
+            + bytes(cols)
+            + bytes(registers)
+        )
+
+    @classmethod
+    def _vram_reply_parser(cls, command: int) -> Callable[[bytes], bytes]:
+        parse_wait_reply = cls._wait_reply_parser(command, time.monotonic())
+
+        def parse(payload: bytes) -> bytes:
+            parse_wait_reply(payload)
+            return bytes(payload[1:])
+
+        return parse
+
+    def _note_vram_command(self, command: int):
+        # VRAM requests load R0 with the command and execute it, also setting
+        # R6, R7 and the data registers.
+        if self.shadow is not None:
+            self.shadow.direct[0] = command
+            self.shadow.note_execute(command)
+
+    def _pipelined_if_needed(self):
+        # Enter pipelined mode, unless already in it.
+        if self._pipelined:
+            return contextlib.nullcontext()
+        return self.pipelined()
+
+    def run_program(self, program: Program) -> bytes:
+        """
+        Run the given register program and return all the values that it read.
+
+        If the server supports it, the whole program runs there as a single
+        request. Raises TimeoutError if one of its waits times out.
+        """
+        if "PROGRAM" not in self.features:
+            values = []
+            with self._pipelined_if_needed():
+                self._run_instructions(program.instructions, [], values)
+            return bytes(values)
+
+        if self.shadow is not None:
+            self.shadow.invalidate()
+        self._page = None
+        return self._query(
+            Opcode.PROGRAM, program.encode(), self._parse_program_reply
+        )
+
+    def _run_instructions(
+        self,
+        instructions: Sequence[Instruction],
+        counters: List[int],
+        values: List[PendingReply],
+    ):
+        # Emulate the server's interpreter through individual requests.
+        # "counters" holds the current value of each enclosing loop's counter,
+        # from the outermost to the innermost one.
+        for opcode, *operands in instructions:
+            match opcode:
+                case ProgramOp.WRITE:
+                    regnum, value = operands
+                    self.write_register(regnum & 7, value, bool(regnum & 8))
+                case ProgramOp.WRITE_COUNTER:
+                    regnum, level = operands
+                    self.write_register(
+                        regnum & 7, counters[-1 - level], bool(regnum & 8)
+                    )
+                case ProgramOp.READ:
+                    values.append(
+                        self.read_register_deferred(
+                            operands[0] & 7, bool(operands[0] & 8)
+                        )
+                    )
+                case ProgramOp.WAIT:
+                    self._wait_not_busy_for(operands[0])
+                case ProgramOp.SLEEP:
+                    self.sync()
+                    time.sleep(operands[0] / 1000)
+                case ProgramOp.LOOP:
+                    count, start, step, body = operands
+                    for i in range(count):
+                        counters.append((start + i * step) & 0xFF)
+                        self._run_instructions(body, counters, values)
+                        counters.pop()
+
+    def _wait_not_busy_for(self, timeout_ms: int):
+        # Like wait_not_busy, but giving up after the given time.
+        if "WAIT" in self.features:
+            self._send(Opcode.WAIT, struct.pack("<H", timeout_ms))
+            self._expect_reply(Opcode.WAIT, self._parse_program_reply)
+            return
+
+        command, started = self._running_command or (None, time.monotonic())
+        self._running_command = None
+        delays = self.busy_policy.delays(command, started)
+        deadline = time.monotonic() + timeout_ms / 1000
+        while self.read_register(0, False) & 0x80:
+            if time.monotonic() > deadline:
+                raise TimeoutError(_PROGRAM_TIMEOUT_MESSAGE)
+            time.sleep(next(delays))
+
+    @staticmethod
+    def _parse_program_reply(payload: bytes) -> bytes:
+        if payload[0] & 0x80:
+            raise TimeoutError(_PROGRAM_TIMEOUT_MESSAGE)
+        return bytes(payload[1:])
+
+    def invalidate_shadows(self):
+        """
+        Forget the known state of the registers and of the page, e.g. after the
+        chip has been accessed through another connection.
+        """
+        if self.shadow is not None:
+            self.shadow.invalidate()
+        self._page = None
+
+    def read_page(self, columns: int = 40, block: int = 0) -> Page:
+        """Read back a whole page, which then becomes its known contents."""
+        page = Page(columns, block)
+        data = self.read_vram(
+            block,
+            PAGE_ROWS,
+            [page.encode_column(x) for x in range(columns)],
+            command=page.command,
+            registers=page.registers,
+        )
+        values = iter(data)
+        for y in PAGE_ROWS:
+            for x in range(columns):
+                page[y, x] = [next(values) for _ in page.registers]
+        self._page = page.copy()
+        return page
+
+    def render_page(self, desired: Page) -> int:
+        """
+        Make the video memory contain the given page, only writing the cells
+        that differ from its known contents, in auto-increment runs. Returns the
+        number of cells written.
+
+        The contents are known after the previous render_page or read_page,
+        until a command that may write to the video memory is executed by other
+        means. Otherwise, a 40-column page is first cleared to the desired
+        page's fill cell (through CLF), while an 80-column one is read back.
+
+        The chip must be in a valid video mode (see TGS).
+        """
+        assert not self._pipelined  # clearing needs time
+        known = self._page
+        if known is not None and (known.columns, known.block) != (
+            desired.columns,
+            desired.block,
+        ):
+            known = None
+        if known is None and desired.columns == 40:
+            known = self._clear_page(desired.block, desired.fill)
+        elif known is None:
+            known = self.read_page(desired.columns, desired.block)
+
+        # The writes below must not make the known contents be forgotten.
+        self._page = None
+        _, r7_base, _ = self._prepare_vram_access(
+            desired.block, desired.command, desired.registers
+        )
+        num_cells = 0
+        with self.pipelined():
+            self.R0 = desired.command | 0x01  # with auto-increment
+            for y, x, cells in desired.runs(known):
+                self.R6 = y
+                self.R7 = r7_base | desired.encode_column(x)
+                for attributes, group in itertools.groupby(
+                    cells, key=lambda cell: cell[1:]
+                ):
+                    for regnum, value in zip(desired.registers[1:], attributes):
+                        self.write_register(regnum, value, False)
+                    self.write_text(bytes(cell[0] for cell in group))
+                num_cells += len(cells)
+        self._page = desired.copy()
+        return num_cells
+
+    def _clear_page(self, block: int, fill: Sequence[int]) -> Page:
+        # Fill a 40-column page with the given cell through CLF/CLL, which
+        # keeps running (wrapping around the page) until stopped.
+        _, r7_base, _ = self._prepare_vram_access(block, 0x00, None)
+        self.R1, self.R2, self.R3 = fill
+        self.R6 = 0  # y
+        self.R7 = r7_base  # x
+        self.ER0 = 0x05  # CLF/CLL
+        time.sleep(0.5)
+        self.ER0 = 0x91  # NOP to stop it.
+        self.wait_not_busy()
+        return Page(40, block, fill)
+
+    def _note_page_command(self, command: Optional[int]):
+        # Forget the known contents of the page if the command may have written
+        # to the video memory, i.e. unless it is a memory access command with
+        # the read flag, IND or NOP.
+        if command is None or not (
+            (command < 0x80 and command & 0x08)
+            or command & 0xF0 == 0x80
+            or command == 0x91
+        ):
+            self._page = None
+
+    def dump_font_rom(self, b: int) -> bytes:
+        """
+        Read the given block (0-7) of the character generator ROM through the
+        IND command.
+
+        The returned 2 KiB contain, for each group of four consecutive
+        characters, 64 bytes indexed by slice number and low bits of the
+        character code, i.e. the order in which R6 and R7 address them.
+
+        Since the ROM contents only depend on the chip type, they are only read
+        once per session. The chip must be in a valid video mode (see TGS).
+        """
+        key = (self.chip_type, b)
+        if key not in _font_rom_cache:
+            _, r7_base, _ = self._prepare_vram_access(b & 3, 0x80, (1,))
+            program = Program()
+            program.write(0, 0x88)  # IND, read
+            with program.loop(32, start=0x20 if (b & 4) else 0):
+                program.write_counter(6)
+                with program.loop(16 * 4, start=r7_base):
+                    program.write_counter(7, execute=True)
+                    program.wait_not_busy()
+                    program.read(1)
+            _font_rom_cache[key] = self.run_program(program)
+        return _font_rom_cache[key]
+
+    @staticmethod
+    def _wait_reply_parser(
+        command: Optional[int], started: float
+    ) -> Callable[[bytes], int]:
+        # Parse the status returned by the requests that wait until the chip is
+        # not busy, failing if the server gave up while running the given
+        # command, started at the given time.monotonic() value.
+        def parse(payload: bytes) -> int:
+            status = payload[0]
+            if status & 0x80:
+                raise busy_timeout_error(command, time.monotonic() - started)
+            return status
+
+        return parse